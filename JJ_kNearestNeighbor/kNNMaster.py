@@ -1,6 +1,11 @@
 import numpy as np
 import sqlite3 as sql
 import math
+import sys
+import time
+import scipy.sparse as sparse
+
+from neighborCache import NeighborCache
 
 
 ####################### Functions to grab data ################################
@@ -101,7 +106,7 @@ def makeInvIndex(cursor):
     #grabs the users scores
     scoreMatrix = getUserScores(cursor, userIndexList, animeIndexList)
 
-    return animeIndexList, userIndexList, scoresMatrix
+    return animeIndexList, userIndexList, toSparseScores(scoreMatrix)
 
 ########################## Functions for kNN ##################################
 
@@ -110,109 +115,244 @@ def makeInvIndex(cursor):
 #and 0 otherwise.
 def watchedMatrix(cursor, userScores, numAnime, numUsers):
     print("Calculating the watched matrix:")
-    #size of watched matrix being created with 0s input
-    userWatched = np.zeros(userScoreIndex.shape)
-    #goes through and fills a 1 for anime users have watched
-    for i in range(0,numAnime):
-	    for j in range(0,numUsers):
-		    if (userScores[i,j] != 0):
-			    userWatched[i,j] = 1
+    #1 wherever the user has a score for the show
+    userWatched = toSparseScores(userScores).copy()
+    userWatched.data = np.ones_like(userWatched.data)
     
     return userWatched
 
-def kNN(cursor, animeIndexList, userIndexList, userScores, userWatched, k):
+#converts a dense anime X users score matrix into a sparse CSC matrix.
+#scores of NaN (users that gave a show a status but no score) are
+#treated the same as unwatched shows, like np.nan_to_num does in kNN.
+def toSparseScores(userScores):
+    if sparse.issparse(userScores):
+        return sparse.csc_matrix(userScores)
+    return sparse.csc_matrix(np.nan_to_num(userScores))
+
+#calculates the score distance from the input user to each candidate user
+#using the same measure as kNN: over the shows both users have scored,
+#sum(abs(differences)) / sqrt(sum(differences^2)).
+#candidates with identical scores on every show in common are as close as
+#possible and get a distance of 0, while candidates with no shows in common
+#get a distance of infinity, so they sort after every real neighbor.
+#candidates are compared in blocks of blockSize columns to bound memory.
+def getScoreDistances(userScores, inputUserIndex, candidateIndices,
+                      blockSize=10000):
+    #the transpose of the CSC score matrix is a users X anime CSR matrix,
+    #which makes pulling out rows of users cheap
+    userRows = toSparseScores(userScores).T
+    candidateIndices = np.asarray(candidateIndices, dtype=np.int64)
+
+    #only the shows the input user scored can contribute
+    inputRow = userRows[inputUserIndex]
+    scoredShows = inputRow.indices
+    inputScores = inputRow.data.reshape(1, -1)
+
+    distances = np.empty(len(candidateIndices))
+    for start in range(0, len(candidateIndices), blockSize):
+        block = candidateIndices[start:start + blockSize]
+        candidateScores = userRows[block][:, scoredShows].toarray()
+
+        #differences only count where the candidate scored the show too
+        inCommon = candidateScores != 0
+        diff = np.abs(candidateScores - inputScores) * inCommon
+        numerator = diff.sum(axis=1)
+        denominator = np.sqrt((diff * diff).sum(axis=1))
+
+        blockDistances = np.empty(len(block))
+        blockDistances.fill(np.inf)
+        blockDistances[inCommon.any(axis=1)] = 0
+        nonzero = denominator > 0
+        blockDistances[nonzero] = numerator[nonzero] / denominator[nonzero]
+        distances[start:start + blockSize] = blockDistances
+
+    return distances
+
+def kNN(cursor, animeIndexList, userIndexList, userScores, userWatched, k,
+        inputUserIndex):
     print("Calculating kNN for input user")
     #calculates the number of anime and users
-    numAnime = len(userIndexList[1, :])
-    numUsers = len(animeIndexList[1, :])
+    numAnime = len(animeIndexList[1, :])
+    numUsers = len(userIndexList[1, :])
 
-    userWatchedDistances = getWatchedDistances(userWatched, numUsers, numAnime)
+    userWatchedDistances = getWatchedDistances(userWatched, inputUserIndex)
     
     #number of users we will be wanting to use that are closest to input
-    numFilteredUsers = numUsers / 10
+    numFilteredUsers = min(max(numUsers / 10, k), numUsers - 1)
    
     #filter users by how many shows they've watched in common with input user
-    filteredUserIndices = getFilteredUserIndices(userIndexList, userWatchedDistances, numFilteredUsers)
-    
-    #creates empty matrix for the filtered-users scores
-    filteredUserScores = np.zeros((numAnime, numFilteredUsers))
-    #creates empty matrix for the filtered-users' score distances to input user
-    filteredUserDistance = np.zeros(numFilteredUsers)
-
-    for i in range(0, numFilteredUsers):
-        #fill in this user's scores list from the userScores matrix
-        filteredUserScores[:, i] = userScores[:, filteredUserIndices[i]]
-        
-        #numerator is sum of abs(differences in scores)
-        #between input user and comparison user
-        numerator = 0
-        #denominator is sqrt(sum(differences^2)) in scores
-        #between input user and comparison user
-        denominator = 0
-        #number of shows watched in common TODO: Use this somehow
-        numShowsInCommon = 0
-
-        for j in range(0, numAnime):
-            #if both the input user and the comparison user watched this show
-            if (np.nan_to_num(inputUser[j]) != 0 and np.nan_to_num(filteredUserScores[j, i] != 0):
-                #take the abs(difference) of their shows and add to numerator
-                diff = abs(np.nan_to_num(filteredUserScores[j,i]) - np.nan_to_num(inputUser[j])
-                numerator += diff
-                #add square of difference to denominator
-                denominator += (diff*diff)
-                #increment number of shows watched in common
-                numShowsInCommon += 1
-        denominator = math.sqrt(denominator)
-        
-        filteredUserDistance[i] = numerator/denominator
-    #row of filtered-user indices over row of filtered-user distances
-    filteredUserDistanceIndices = np.vstack([filteredUserIndices, filteredUserDistances])
-
-    #retun the k-nearest neighbors to input user
-    return (filteredUserDistanceIndices[1,:].argsort())[:k]
-
-def getFilteredUserIndices(userIndexList, userWatchedDistances, numFilteredUsers):
-    #row of indices over row of distances
-    userDistanceIndexMatrix = np.vstack([userIndexList[0,:], userDistances[0,:])
+    filteredUserIndices = getFilteredUserIndices(inputUserIndex, userWatchedDistances, numFilteredUsers)
     
-    #TODO change once inputUser is made separate from rest of input
-    return (userDistanceIndexMatrix[1,:].argsort())[1:numFilteredUsers + 1]
-
-def getWatchedDistances(userWatched, numUsers, numAnime):
-    #distance of users to input user list initialized with 0s
-    userDistances = np.zeros((1, numUsers))
-    #TODO just arbitrary input for now
-    inputUserWatched = userWatched[:, 7]
-    
-    #finds the distances of the users to the input user
-    for i in range(0, numUsers):
-        distanceSum = 0
-        for j in range(0, numAnime):
-            if (inputUserWatched[j] == 1 and userWatched[j, i] == 0):
-                distanceSum += 1
-        userDistances[0, i] = distanceSum
-    
-    return userDistances
-
-def main():
+    #score distance of each filtered user to the input user
+    filteredUserDistances = getScoreDistances(userScores, inputUserIndex, filteredUserIndices)
+
+    #retun the k-nearest neighbors to input user and their distances
+    nearest = filteredUserDistances.argsort(kind='mergesort')[:k]
+    return filteredUserIndices[nearest], filteredUserDistances[nearest]
+
+def getFilteredUserIndices(inputUserIndex, userWatchedDistances, numFilteredUsers):
+    #closest users first, leaving out the input user
+    order = userWatchedDistances.argsort(kind='mergesort')
+    order = order[order != inputUserIndex]
+    return order[:numFilteredUsers]
+
+#distance of every user to the input user is the number of shows the input
+#user watched that the other user has not watched
+def getWatchedDistances(userWatched, inputUserIndex):
+    userWatched = sparse.csc_matrix(userWatched)
+    inputUserWatched = userWatched[:, inputUserIndex]
+
+    #shows watched by both is one sparse matrix-vector product
+    watchedInCommon = np.asarray(
+            userWatched.T.dot(inputUserWatched).todense()).ravel()
+    return inputUserWatched.nnz - watchedInCommon
+
+################## Functions for recommending shows ###########################
+
+#turns neighbor score distances into weights. closer neighbors get larger
+#weights, and neighbors with an infinite distance get no weight at all.
+def getNeighborWeights(distances):
+    return 1.0 / (1.0 + np.asarray(distances, dtype=np.float64))
+
+#recommends the numShows shows with the highest predicted scores that the
+#input user has not watched, from the scores of their k nearest neighbors.
+#returns the anime indices of the shows, best first, and their predicted
+#scores.
+def recommendShows(userScores, userWatched, inputUserIndex, neighbors,
+                   distances, numShows, minNeighbors=1):
+    recommendations = recommendShowsBatch(
+            userScores, userWatched, [inputUserIndex], [neighbors],
+            [distances], numShows, minNeighbors)
+    return recommendations[0]
+
+#recommends shows for many input users at once. neighborLists and
+#distanceLists hold the neighbors and distances returned by kNN for each
+#input user.
+#
+#the predicted score of a show for an input user is the weighted average of
+#the scores their neighbors gave it, weighted by getNeighborWeights and only
+#counting neighbors that scored the show. for a batch of input users, the
+#neighbor weights form a sparse users X batch matrix, so the weighted score
+#sums for every show and input user are one sparse matrix product, and the
+#weight sums to divide by are a second one over the scored/not scored
+#matrix. shows the input user already watched, or that fewer than
+#minNeighbors neighbors scored, are never recommended.
+#
+#input users are scored batchSize at a time to bound the size of the dense
+#anime X batch result. returns a list with one (animeIndices,
+#predictedScores) pair per input user, like recommendShows.
+def recommendShowsBatch(userScores, userWatched, inputUserIndices,
+                        neighborLists, distanceLists, numShows,
+                        minNeighbors=1, batchSize=1000):
+    userScores = toSparseScores(userScores)
+    userWatched = sparse.csc_matrix(userWatched)
+    userScored = userScores.copy()
+    userScored.data = np.ones_like(userScored.data)
+    numAnime, numUsers = userScores.shape
+
+    start = time.time()
+    recommendations = []
+    for batchStart in range(0, len(inputUserIndices), batchSize):
+        batchUsers = inputUserIndices[batchStart:batchStart + batchSize]
+        batchNeighbors = neighborLists[batchStart:batchStart + batchSize]
+        batchDistances = distanceLists[batchStart:batchStart + batchSize]
+
+        #sparse matrix of each input user's (column) neighbor weights
+        rows = np.concatenate([np.asarray(n, dtype=np.int64) for n in batchNeighbors])
+        cols = np.repeat(np.arange(len(batchUsers)), [len(n) for n in batchNeighbors])
+        weights = np.concatenate([getNeighborWeights(d) for d in batchDistances])
+        neighborWeights = sparse.csc_matrix((weights, (rows, cols)), shape=(numUsers, len(batchUsers)))
+        neighborCounts = sparse.csc_matrix(((weights > 0).astype(np.float64), (rows, cols)), shape=(numUsers, len(batchUsers)))
+
+        weightedScores = userScores.dot(neighborWeights).toarray()
+        weightSums = userScored.dot(neighborWeights).toarray()
+        raters = userScored.dot(neighborCounts).toarray()
+
+        predictedScores = np.empty(weightedScores.shape)
+        predictedScores.fill(-np.inf)
+        rated = (weightSums > 0) & (raters >= minNeighbors)
+        predictedScores[rated] = weightedScores[rated] / weightSums[rated]
+
+        #never recommend shows the input users have already watched
+        watched = userWatched[:, batchUsers].toarray() != 0
+        predictedScores[watched] = -np.inf
+
+        #only the top numShows of each column need to be sorted
+        n = min(numShows, numAnime)
+        top = np.argpartition(-predictedScores, n - 1, axis=0)[:n]
+        for column in range(len(batchUsers)):
+            columnTop = top[:, column]
+            columnScores = predictedScores[columnTop, column]
+            order = np.argsort(-columnScores, kind='mergesort')
+            columnTop = columnTop[order]
+            columnScores = columnScores[order]
+            valid = np.isfinite(columnScores)
+            recommendations.append((columnTop[valid], columnScores[valid]))
+
+    elapsed = time.time() - start
+    print("Recommended shows for {0} users in {1:.4f}s ({2:.6f}s per user)".format(
+            len(inputUserIndices), elapsed, elapsed / max(len(inputUserIndices), 1)))
+    return recommendations
+
+#recommends shows to each of the given input users, by user name
+def main(inputUserNames):
     print("Starting kNN Anime Recommender:")
     
     #grabs the database of user info (their anime scores)
     con = sql.connect('../small_rating_sets.db')
     cursor = con.cursor()
 
+    kFraction = 50
+
+    #neighbors computed by earlier runs are kept in the cache, as long as the
+    #ratings of the users involved haven't changed
+    cache = NeighborCache('kNN_cache.db')
+
     #creates the user score index matrix
-    animeIndexList, userIndexList, userScores = makeInvIndex(cursor)
+    animeIndexList, userIndexList, userScores = cache.loadScores(cursor)
 
     #calculates the number of anime and users
-    numAnime = len(userIndexList[1, :])
-    numUsers = len(animeIndexList[1, :])
+    numAnime = len(animeIndexList[1, :])
+    numUsers = len(userIndexList[1, :])
 
     #calculate the watched matrix for all the users
     userWatched = watchedMatrix(cursor, userScores, numAnime, numUsers)
 
-    kNNList = kNN(cursor, animeIndexList, userIndexList, userScores, userWatched)
+    #looks up the index of each input user, skipping users not in the database
+    userIndices = dict((name, index) for index, name in enumerate(userIndexList[1, :]))
+    inputUserIndices = []
+    for inputUserName in inputUserNames:
+        if inputUserName in userIndices:
+            inputUserIndices.append(userIndices[inputUserName])
+        else:
+            print("Skipping unknown user {0}".format(inputUserName))
+    if not inputUserIndices:
+        print("No known input users")
+        cache.close()
+        return
+
+    k = max(numUsers / kFraction, 1)
+    cache.setModelVersion('k={0}'.format(k))
+
+    #find the nearest neighbors of each input user, then score them together
+    neighborLists = []
+    distanceLists = []
+    for inputUserIndex in inputUserIndices:
+        kNNList, kNNDistances = cache.getNeighbors(inputUserIndex, lambda: kNN(cursor, animeIndexList, userIndexList, userScores, userWatched, k, inputUserIndex))
+        neighborLists.append(kNNList)
+        distanceLists.append(kNNDistances)
+    cache.printStats()
+
+    recommendations = recommendShowsBatch(userScores, userWatched, inputUserIndices, neighborLists, distanceLists, 10)
+    for inputUserIndex, (shows, scores) in zip(inputUserIndices, recommendations):
+        print(userIndexList[1, inputUserIndex])
+        for show, score in zip(shows, scores):
+            print("    {0} ({1:.2f})".format(animeIndexList[1, show], score))
+    cache.close()
 
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) < 2:
+        print("Usage: python kNNMaster.py USER_NAME [USER_NAME ...]")
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -2,6 +2,8 @@ import numpy as np
 import sqlite3 as sql
 import math
 
+from kNNMaster import recommendShows
+
 con = sql.connect('../data_acq/mal_users.db')
 
 cursor = con.cursor()
@@ -128,4 +130,10 @@ for i in range(0, numNearestNeighbors):
 print kNearestNeighbors 
 
 #PART 3: Finding the next show to watch
-	
+#score every show the input user has not watched with the weighted average
+#of the neighbors' scores on it, all shows at once
+kNearestDistances = np.sort(filteredUserDistance)[:numNearestNeighbors]
+kNearestDistances[np.isnan(kNearestDistances)] = np.inf
+recommendedShows, predictedScores = recommendShows(userScores, userWatched, 7, kNearestNeighbors, kNearestDistances, 10)
+for i in range(0, len(recommendedShows)):
+	print animeIndexList[1, recommendedShows[i]], predictedScores[i]
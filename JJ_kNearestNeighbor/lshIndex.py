@@ -0,0 +1,251 @@
+import numpy as np
+import scipy.sparse as sparse
+import time
+from collections import defaultdict
+
+from kNNMaster import toSparseScores, getScoreDistances
+
+
+################## Approximate neighbors with random projections ##############
+
+#Comparing the input user against every other user is quadratic over the
+#whole user base, so this index hashes each user's score vector with signed
+#random projections (SimHash) and only compares the input user against the
+#users that land in the same buckets.
+#
+#Each of numTables hash tables uses numBits random hyperplanes. A user's key
+#in a table is the pattern of which side of each hyperplane their
+#mean-centered score vector falls on. Users whose centered scores point in
+#similar directions share keys with high probability. Multi-probe lookups
+#also check the buckets one bit flip away from the input user's key,
+#starting with the bits whose projections were closest to zero, so fewer
+#tables are needed for the same recall.
+#
+#Usage, with userScores being the anime X users score matrix from
+#makeInvIndex:
+#   index = LSHIndex(userScores.shape[0], numBits=16, numTables=8)
+#   index.insertUsers(userScores)
+#   neighbors, distances = index.query(userScores, inputUserIndex, k)
+#   measureRecall(index, userScores, k)
+#   index.save('lsh_index.npz')
+class LSHIndex:
+
+    #numAnime - number of rows (shows) in the score matrices to be hashed
+    #numBits - number of hyperplanes (key bits) per hash table
+    #numTables - number of independent hash tables
+    #seed - seed for the random hyperplanes, so indexes can be rebuilt
+    def __init__(self, numAnime, numBits=16, numTables=8, seed=None):
+        if numBits > 62:
+            raise ValueError('numBits must be at most 62')
+
+        self.numAnime = numAnime
+        self.numBits = numBits
+        self.numTables = numTables
+
+        #hyperplanes for every table side by side, one column per key bit
+        rng = np.random.RandomState(seed)
+        self.planes = rng.standard_normal((numAnime, numBits * numTables))
+
+        #keys of every indexed user (row) in every table (column)
+        self.keys = np.zeros((0, numTables), dtype=np.int64)
+        #score matrix column of every indexed user, in insertion order
+        self.userIndices = np.zeros(0, dtype=np.int64)
+
+        self._buildTables()
+
+    #number of users in the index
+    def __len__(self):
+        return len(self.userIndices)
+
+    #adds users to the index. userIndices are the columns of userScores to
+    #hash; every column is hashed if userIndices is None. Newly crawled
+    #users can be inserted this way without rehashing anyone else, as long
+    #as they are appended as new columns of the score matrix.
+    def insertUsers(self, userScores, userIndices=None):
+        userScores = toSparseScores(userScores)
+        if userIndices is None:
+            userIndices = np.arange(userScores.shape[1])
+        userIndices = np.asarray(userIndices, dtype=np.int64)
+        if len(userIndices) == 0:
+            return
+
+        newKeys = self._getKeys(self._project(userScores[:, userIndices]))
+        first = len(self.userIndices)
+        self.keys = np.vstack([self.keys, newKeys])
+        self.userIndices = np.concatenate([self.userIndices, userIndices])
+
+        for table in range(self.numTables):
+            buckets = self.tables[table]
+            for position in range(len(userIndices)):
+                buckets[newKeys[position, table]].append(first + position)
+
+    #returns the score matrix columns of the users sharing a bucket with the
+    #given anime X 1 score vector in any table. numProbes extra buckets, each
+    #one bit flip away from the vector's own key, are checked per table.
+    def getCandidates(self, scoreVector, numProbes=0):
+        projection = self._project(toSparseScores(scoreVector))[0]
+        key = self._getKeys(projection.reshape(1, -1))[0]
+
+        positions = []
+        for table in range(self.numTables):
+            buckets = self.tables[table]
+            for probeKey in self._getProbeKeys(
+                    projection, table, key[table], numProbes):
+                bucket = buckets.get(probeKey)
+                if bucket:
+                    positions.extend(bucket)
+
+        return np.unique(self.userIndices[np.asarray(positions, dtype=np.int64)])
+
+    #finds the approximate k nearest neighbors of the user in column
+    #inputUserIndex of userScores. Candidates from the hash tables are
+    #re-ranked with the exact score distance used by kNN.
+    #returns the neighbors' columns and their distances, nearest first.
+    def query(self, userScores, inputUserIndex, k, numProbes=0):
+        userScores = toSparseScores(userScores)
+        candidates = self.getCandidates(
+                userScores[:, inputUserIndex], numProbes)
+        candidates = candidates[candidates != inputUserIndex]
+
+        distances = getScoreDistances(userScores, inputUserIndex, candidates)
+        nearest = np.argsort(distances, kind='mergesort')[:k]
+        return candidates[nearest], distances[nearest]
+
+    #saves the hyperplanes and keys of the index to a .npz file. The buckets
+    #are rebuilt from the keys when the index is loaded.
+    def save(self, path):
+        np.savez(path, planes=self.planes, keys=self.keys,
+                 userIndices=self.userIndices,
+                 shape=np.array([self.numBits, self.numTables]))
+
+    #loads an index saved with save
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        numBits, numTables = data['shape']
+        index = cls(data['planes'].shape[0], int(numBits), int(numTables))
+        index.planes = data['planes']
+        index.keys = data['keys']
+        index.userIndices = data['userIndices']
+        index._buildTables()
+        return index
+
+    #rebuilds the key -> positions buckets of every table from self.keys
+    def _buildTables(self):
+        self.tables = []
+        for table in range(self.numTables):
+            buckets = defaultdict(list)
+            order = np.argsort(self.keys[:, table], kind='mergesort')
+            sortedKeys = self.keys[order, table]
+            uniqueKeys, starts = np.unique(sortedKeys, return_index=True)
+            ends = np.append(starts[1:], len(sortedKeys))
+            for key, start, end in zip(uniqueKeys, starts, ends):
+                buckets[key] = order[start:end].tolist()
+            self.tables.append(buckets)
+
+    #projects the mean-centered columns of an anime X users sparse score
+    #matrix onto every hyperplane. returns a users X (bits * tables) array.
+    def _project(self, userScores):
+        centered = sparse.csc_matrix(userScores, dtype=np.float64, copy=True)
+        centered.eliminate_zeros()
+
+        #subtract each user's mean score from the shows they scored only,
+        #so unscored shows stay at 0 and don't count as below average
+        counts = np.diff(centered.indptr)
+        sums = np.asarray(centered.sum(axis=0)).ravel()
+        means = sums / np.maximum(counts, 1)
+        centered.data -= np.repeat(means, counts)
+
+        return np.asarray(centered.T.dot(self.planes))
+
+    #packs the signs of the projections into one integer key per table.
+    #returns a users X tables array.
+    def _getKeys(self, projections):
+        bits = (projections > 0).reshape(
+                len(projections), self.numTables, self.numBits)
+        bitValues = np.left_shift(1, np.arange(self.numBits, dtype=np.int64))
+        return bits.dot(bitValues)
+
+    #returns the key of one table followed by up to numProbes keys that each
+    #flip one of its bits, flipping the least certain bits first
+    def _getProbeKeys(self, projection, table, key, numProbes):
+        probeKeys = [key]
+        if numProbes > 0:
+            tableProjection = projection[
+                    table * self.numBits:(table + 1) * self.numBits]
+            for bit in np.argsort(np.abs(tableProjection))[:numProbes]:
+                probeKeys.append(key ^ (1 << int(bit)))
+        return probeKeys
+
+
+########################## Measuring the index ################################
+
+#measures recall@k of the index against the exact kNN score distance.
+#numQueries indexed users are picked at random as input users, and for each
+#one the fraction of its exact k nearest neighbors (among users with a finite
+#distance) that the index also returns is averaged.
+#returns a dict with the recall, the average number of candidates re-ranked
+#per query, and the average seconds per query for both searches.
+def measureRecall(index, userScores, k, numQueries=100, numProbes=0,
+                  seed=None):
+    userScores = toSparseScores(userScores)
+    numUsers = userScores.shape[1]
+    rng = np.random.RandomState(seed)
+    queries = rng.choice(index.userIndices,
+                         min(numQueries, len(index)), replace=False)
+    everyone = np.arange(numUsers)
+
+    recallTotal = 0.0
+    candidateTotal = 0
+    exactTime = 0.0
+    approxTime = 0.0
+    numMeasured = 0
+    for inputUserIndex in queries:
+        start = time.time()
+        distances = getScoreDistances(userScores, inputUserIndex, everyone)
+        distances[inputUserIndex] = np.inf
+        exact = np.argsort(distances, kind='mergesort')[:k]
+        exact = exact[np.isfinite(distances[exact])]
+        exactTime += time.time() - start
+
+        start = time.time()
+        approx, approxDistances = index.query(
+                userScores, inputUserIndex, k, numProbes)
+        approxTime += time.time() - start
+        candidateTotal += len(index.getCandidates(
+                userScores[:, inputUserIndex], numProbes))
+
+        #users without any finite neighbors have nothing to recall
+        if len(exact) == 0:
+            continue
+        recallTotal += len(np.intersect1d(exact, approx)) / float(len(exact))
+        numMeasured += 1
+
+    return {
+        'recall': recallTotal / max(numMeasured, 1),
+        'candidates': float(candidateTotal) / len(queries),
+        'exactSeconds': exactTime / len(queries),
+        'approxSeconds': approxTime / len(queries),
+    }
+
+#builds an index for every combination of bits and tables and prints the
+#recall@k, candidates and query time of each, to help pick the settings
+#for a given user base
+def recallSweep(userScores, bitChoices, tableChoices, k, numQueries=100,
+                numProbes=0, seed=None):
+    print("Measuring LSH recall@{0}:".format(k))
+    userScores = toSparseScores(userScores)
+    results = {}
+    for numBits in bitChoices:
+        for numTables in tableChoices:
+            index = LSHIndex(userScores.shape[0], numBits, numTables, seed)
+            index.insertUsers(userScores)
+            result = measureRecall(index, userScores, k, numQueries,
+                                   numProbes, seed)
+            results[(numBits, numTables)] = result
+            print("bits: {0} tables: {1} recall: {2:.3f} candidates: {3:.1f} "
+                  "exact: {4:.4f}s approx: {5:.4f}s".format(
+                      numBits, numTables, result['recall'],
+                      result['candidates'], result['exactSeconds'],
+                      result['approxSeconds']))
+    return results
@@ -0,0 +1,254 @@
+import hashlib
+import numpy as np
+import os
+import scipy.sparse as sparse
+import sqlite3 as sql
+import time
+from itertools import groupby
+
+
+####################### Persistent neighbor cache #############################
+
+#Computing a user's neighbors means comparing them against a tenth of the
+#user base, so the neighbor lists and their distances are kept in a SQLite
+#database between runs of kNNMaster.main(), keyed by user index and model
+#version. The model version is any string that changes whenever the way the
+#neighbors are computed changes (the actual k, the metric, ...), so lists
+#computed one way are never returned for another. When k depends on the
+#number of users, set the version with setModelVersion after loadScores.
+#
+#Each user keeps the same index (score matrix column) across runs, and a
+#hash of their ratings is stored with it. Every run compares the hashes with
+#the ratings table, so new, updated and deleted scores are all caught. Only
+#the users whose hash changed, plus the users that list one of them as a
+#neighbor, lose their cached neighbors. Everyone else is a cache hit.
+#
+#The score matrix itself is saved next to the cache database, and is only
+#rebuilt when some user's hash changed.
+#
+#Usage:
+#   cache = NeighborCache('kNN_cache.db')
+#   animeIndexList, userIndexList, userScores = cache.loadScores(cursor)
+#   cache.setModelVersion('k=10')
+#   neighbors, distances = cache.getNeighbors(inputUserIndex, computeNeighbors)
+#   cache.printStats()
+class NeighborCache:
+
+    #cachePath - path of the SQLite database to keep the cache in
+    #modelVersion - string identifying how the cached neighbors are computed.
+    #               can be set later with setModelVersion.
+    #ratingsTable, userColumn - table of ratings to build the score matrix
+    #                           from and its column of user names
+    def __init__(self, cachePath, modelVersion=None,
+                 ratingsTable='MALUserScores', userColumn='user_name'):
+        self.cachePath = cachePath
+        self.scoresPath = cachePath + '.scores.npz'
+        self.modelVersion = modelVersion
+        self.ratingsTable = ratingsTable
+        self.userColumn = userColumn
+
+        self.con = sql.connect(cachePath)
+        self._initTables()
+
+        #counters and timings reported by printStats
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.scoresSeconds = 0.0
+        self.invalidateSeconds = 0.0
+        self.computeSeconds = 0.0
+
+    #sets the string identifying how the cached neighbors are computed, such
+    #as the actual k once it is known from the number of users
+    def setModelVersion(self, modelVersion):
+        self.modelVersion = modelVersion
+
+    #returns animeIndexList, userIndexList and the sparse anime X users score
+    #matrix, like makeInvIndex, with the cache's stable user indices. One scan
+    #of the ratings table gives every user's rating history, and the
+    #neighbors of users affected by changed histories are invalidated. The
+    #matrix is loaded from disk if no history changed since it was saved;
+    #otherwise it is rebuilt from the scan.
+    def loadScores(self, cursor):
+        print("Loading user scores:")
+        start = time.time()
+
+        cursor.execute('''SELECT {0}, anime_name, score FROM {1}
+                          WHERE score IS NOT NULL
+                          ORDER BY {0}'''.format(self.userColumn, self.ratingsTable))
+        userRatings = [(user, sorted((r[1], r[2]) for r in rows))
+                       for user, rows in groupby(cursor, lambda r: r[0])]
+
+        #users keep their index from earlier runs; new users are appended
+        userNames = self._assignUserIndices([u for u, ratings in userRatings])
+        userIndices = dict((name, i) for i, name in enumerate(userNames))
+        self.scoresSeconds += time.time() - start
+
+        changed = self._invalidateChanged(userRatings, userIndices)
+        start = time.time()
+        if not changed and os.path.exists(self.scoresPath):
+            saved = np.load(self.scoresPath)
+            if len(saved['userNames']) == len(userNames):
+                animeNames = saved['animeNames']
+                userScores = sparse.csc_matrix(
+                        (saved['data'], saved['indices'], saved['indptr']),
+                        shape=(len(animeNames), len(userNames)))
+                self.scoresSeconds += time.time() - start
+                return (self._indexList(animeNames),
+                        self._indexList(userNames), userScores)
+
+        animeNames = sorted(set(a for u, ratings in userRatings
+                                for a, score in ratings))
+        animeIndices = dict((name, i) for i, name in enumerate(animeNames))
+
+        rows = []
+        cols = []
+        scores = []
+        for user, ratings in userRatings:
+            for anime, score in ratings:
+                rows.append(animeIndices[anime])
+                cols.append(userIndices[user])
+                scores.append(score)
+        userScores = sparse.csc_matrix(
+                (np.asarray(scores, dtype=np.float64), (rows, cols)),
+                shape=(len(animeNames), len(userNames)))
+        userScores.eliminate_zeros()
+
+        np.savez(self.scoresPath,
+                 animeNames=np.array(animeNames), userNames=np.array(userNames),
+                 data=userScores.data, indices=userScores.indices,
+                 indptr=userScores.indptr)
+        self.scoresSeconds += time.time() - start
+        return (self._indexList(animeNames), self._indexList(userNames),
+                userScores)
+
+    #returns the cached neighbors and distances of the user with the given
+    #index. On a miss, computeNeighbors() is called to get them and they are
+    #stored in the cache.
+    def getNeighbors(self, userIndex, computeNeighbors):
+        row = self.con.execute('''SELECT neighbors, distances FROM Neighbors
+                                  WHERE user_index=? AND model_version=?''',
+                               (int(userIndex), self.modelVersion)).fetchone()
+        if row is not None:
+            self.hits += 1
+            return (np.frombuffer(row[0], dtype=np.int64),
+                    np.frombuffer(row[1], dtype=np.float64))
+
+        self.misses += 1
+        start = time.time()
+        neighbors, distances = computeNeighbors()
+        self.computeSeconds += time.time() - start
+        self.putNeighbors(userIndex, neighbors, distances)
+        return neighbors, distances
+
+    #stores the neighbors and distances of the user with the given index
+    def putNeighbors(self, userIndex, neighbors, distances):
+        neighbors = np.asarray(neighbors, dtype=np.int64)
+        distances = np.asarray(distances, dtype=np.float64)
+        with self.con:
+            self._deleteNeighbors([userIndex])
+            self.con.execute('INSERT INTO Neighbors VALUES(?,?,?,?)',
+                             (int(userIndex), self.modelVersion,
+                              sql.Binary(neighbors.tostring()),
+                              sql.Binary(distances.tostring())))
+            self.con.executemany('INSERT INTO NeighborEdges VALUES(?,?,?)',
+                                 ((int(n), int(userIndex), self.modelVersion)
+                                  for n in neighbors))
+
+    #prints the cache hit rate and how long each part of the rebuild took
+    def printStats(self):
+        lookups = self.hits + self.misses
+        hitRate = float(self.hits) / lookups if lookups else 0.0
+        print("Neighbor cache: {0} hits, {1} misses ({2:.1%} hit rate), "
+              "{3} users invalidated".format(
+                  self.hits, self.misses, hitRate, self.invalidated))
+        print("Score matrix: {0:.3f}s, invalidation: {1:.3f}s, "
+              "neighbor computation: {2:.3f}s".format(
+                  self.scoresSeconds, self.invalidateSeconds,
+                  self.computeSeconds))
+
+    def close(self):
+        self.con.close()
+
+    def _initTables(self):
+        with self.con:
+            self.con.execute('''CREATE TABLE IF NOT EXISTS Users (
+                                user_index INTEGER PRIMARY KEY,
+                                user_name TEXT NOT NULL UNIQUE,
+                                history_hash TEXT)''')
+            self.con.execute('''CREATE TABLE IF NOT EXISTS Neighbors (
+                                user_index INTEGER NOT NULL,
+                                model_version TEXT NOT NULL,
+                                neighbors BLOB NOT NULL,
+                                distances BLOB NOT NULL,
+                                PRIMARY KEY (user_index, model_version))''')
+            #reverse lookups: which users list neighbor_index as a neighbor
+            self.con.execute('''CREATE TABLE IF NOT EXISTS NeighborEdges (
+                                neighbor_index INTEGER NOT NULL,
+                                user_index INTEGER NOT NULL,
+                                model_version TEXT NOT NULL)''')
+            self.con.execute('''CREATE INDEX IF NOT EXISTS NeighborEdgesIndex
+                                ON NeighborEdges (neighbor_index)''')
+
+    #gives every user in userNames an index, keeping the indices of users
+    #already in the cache. returns the names of all users, by index.
+    def _assignUserIndices(self, userNames):
+        storedIndices = dict((r[1], r[0]) for r in self.con.execute('SELECT user_index, user_name FROM Users'))
+        newUsers = [name for name in userNames if name not in storedIndices]
+        with self.con:
+            self.con.executemany('INSERT INTO Users (user_index, user_name) VALUES(?,?)',
+                                 enumerate(newUsers, len(storedIndices)))
+        rows = self.con.execute('SELECT user_name FROM Users ORDER BY user_index')
+        return [r[0] for r in rows]
+
+    #compares the hash of every user's ratings with the one stored in the
+    #cache, and deletes the cached neighbors of users whose ratings changed
+    #or who no longer have any ratings, and of users that list them as
+    #neighbors. returns the number of users whose ratings changed.
+    def _invalidateChanged(self, userRatings, userIndices):
+        start = time.time()
+        storedHashes = dict(self.con.execute('SELECT user_index, history_hash FROM Users'))
+
+        changedUsers = []
+        newHashes = []
+        for user, ratings in userRatings:
+            historyHash = hashlib.md5(repr(ratings)).hexdigest()
+            index = userIndices[user]
+            if storedHashes.get(index) != historyHash:
+                changedUsers.append(index)
+                newHashes.append((historyHash, index))
+
+        #users whose ratings were all deleted
+        scoredUsers = set(userIndices[user] for user, ratings in userRatings)
+        for index, historyHash in storedHashes.items():
+            if historyHash is not None and index not in scoredUsers:
+                changedUsers.append(index)
+                newHashes.append((None, index))
+
+        affectedUsers = set(changedUsers)
+        for index in changedUsers:
+            for row in self.con.execute('SELECT user_index FROM NeighborEdges WHERE neighbor_index=?', (index,)):
+                affectedUsers.add(row[0])
+
+        with self.con:
+            self._deleteNeighbors(affectedUsers, allVersions=True)
+            self.con.executemany('UPDATE Users SET history_hash=? WHERE user_index=?', newHashes)
+
+        self.invalidated += len(affectedUsers)
+        self.invalidateSeconds += time.time() - start
+        return len(changedUsers)
+
+    #deletes the cached neighbors of the given users, for this model version
+    #or for every version
+    def _deleteNeighbors(self, userIndices, allVersions=False):
+        versionClause = '' if allVersions else ' AND model_version=?'
+        versionArgs = () if allVersions else (self.modelVersion,)
+        for index in userIndices:
+            args = (int(index),) + versionArgs
+            self.con.execute('DELETE FROM Neighbors WHERE user_index=?' + versionClause, args)
+            self.con.execute('DELETE FROM NeighborEdges WHERE user_index=?' + versionClause, args)
+
+    #row 0: index, row 1: name, like getUsers and getAnimeList
+    def _indexList(self, names):
+        names = np.asarray(names)
+        return np.vstack([np.arange(len(names)), names])
@@ -0,0 +1,202 @@
+# Functions for converting the anime rating data sets into a compact schema
+# keyed by integer IDs.
+
+import numpy as np
+import os
+import sqlite3
+
+from data_acquisition.create_ml_sets import (BulkWriter, create_indexes,
+        fast_load_pragmas, insert_into_table)
+from models.model_util import STATUS_CODES
+
+# Names of the dimension tables that map the integer IDs in the compact schema
+# back to user IDs, anime names, and statuses
+USERS_TABLE_NAME = 'users'
+ANIME_TABLE_NAME = 'anime'
+STATUSES_TABLE_NAME = 'statuses'
+
+
+class SchemaException(Exception):
+    """Indicates that a table could not be converted to the compact schema."""
+    pass
+
+
+def create_compact_db(dest_db_path, source_tables):
+    """Copies the given tables of rating data into a database with a compact
+    schema. Instead of storing the 32 character user ID, the full anime name,
+    and the status label in every row, every table in the compact database
+    stores integer IDs that are mapped back to them by the 'users', 'anime',
+    and 'statuses' dimension tables. All of the tables share the same IDs, so
+    the training, validation, test, implicit feedback, and top-k tables can be
+    loaded together from the compact database.
+
+    Each table keeps its name and is converted by the columns it has:
+        - user_id, anime_name, status, score -> user_id, anime_id, status_id,
+          score (the crawled ratings)
+        - user_id, anime_name, score -> user_id, anime_id, score (the training,
+          validation, and test sets)
+        - user_id, anime_name, status -> user_id, anime_id, status_id (the
+          implicit feedback set)
+        - user_id, anime_name, rand_anime_name or rand_anime_ids ->
+          user_id, anime_id, rand_anime_ids (the top-k test set, with the
+          random anime IDs packed into a blob of 32-bit integers)
+    Converted tables replace tables with the same name in the compact
+    database. IDs are consecutive integers starting from 0, and IDs given out
+    by earlier calls for the same database are kept.
+
+    dest_db_path - A string of the path to the compact database.
+    source_tables - A list of tuples of the path to a source database and the
+                    name of a table in it to convert.
+    """
+    dest_conn = sqlite3.connect(dest_db_path)
+    with dest_conn, fast_load_pragmas(dest_conn):
+        dcur = dest_conn.cursor()
+        init_dimension_tables(dcur)
+        ids = {}
+        for table_name in (USERS_TABLE_NAME, ANIME_TABLE_NAME,
+                           STATUSES_TABLE_NAME):
+            dcur.execute('SELECT * FROM {0}'.format(table_name))
+            ids[table_name] = dict((r[1], r[0]) for r in dcur.fetchall())
+        known_totals = dict((t, len(i)) for t, i in ids.iteritems())
+
+        for source_db_path, table_name in source_tables:
+            source_conn = sqlite3.connect(source_db_path)
+            with source_conn:
+                writer = BulkWriter(dest_conn)
+                convert_table(source_conn.cursor(), dcur, writer, table_name,
+                              ids)
+                writer.flush()
+                writer.report('create_compact_db ({0})'.format(table_name))
+
+        # Add the IDs given out during this conversion to the dimension tables
+        for table_name, table_ids in ids.iteritems():
+            new_ids = sorted((i, name) for name, i in table_ids.iteritems()
+                             if i >= known_totals[table_name])
+            insert_into_table(dcur, table_name, new_ids)
+
+    print 'Compact database size: {0} bytes'.format(
+            os.path.getsize(dest_db_path))
+
+
+def init_dimension_tables(cur):
+    """Creates the dimension tables of the compact schema if needed using the
+    given cursor. The statuses table starts with the MyAnimeList statuses so
+    that they always have the same codes.
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                   user_id INTEGER PRIMARY KEY,
+                   user_md5 TEXT NOT NULL UNIQUE)'''.format(USERS_TABLE_NAME))
+    cur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                   anime_id INTEGER PRIMARY KEY,
+                   anime_name TEXT NOT NULL UNIQUE)'''.format(
+                       ANIME_TABLE_NAME))
+    cur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                   status_id INTEGER PRIMARY KEY,
+                   status TEXT NOT NULL UNIQUE)'''.format(STATUSES_TABLE_NAME))
+    cur.executemany('INSERT OR IGNORE INTO {0} VALUES(?,?)'.format(
+                    STATUSES_TABLE_NAME),
+                    ((code, status) for status, code in STATUS_CODES.items()))
+
+
+def convert_table(source_cur, dest_cur, writer, table_name, ids):
+    """Converts the given table from the source database into the compact
+    schema in the destination database, using and adding to the given dict of
+    dicts of the IDs for each dimension table.
+    """
+    source_cur.execute('PRAGMA table_info({0})'.format(table_name))
+    columns = set(r[1] for r in source_cur.fetchall())
+    user_ids = ids[USERS_TABLE_NAME]
+    anime_ids = ids[ANIME_TABLE_NAME]
+    status_ids = ids[STATUSES_TABLE_NAME]
+
+    def get_id(table_ids, value):
+        if value not in table_ids:
+            table_ids[value] = len(table_ids)
+        return table_ids[value]
+
+    if 'rand_anime_name' in columns or 'rand_anime_ids' in columns:
+        dest_columns = ('user_id INTEGER NOT NULL, anime_id INTEGER NOT NULL, '
+                        'rand_anime_ids BLOB NOT NULL')
+        index_columns = ('user_id', 'anime_id')
+        rows = _get_compact_topk_rows(source_cur, table_name, columns,
+                                      lambda a: get_id(anime_ids, a))
+        rows = ((get_id(user_ids, user), get_id(anime_ids, anime), ids_blob)
+                for user, anime, ids_blob in rows)
+    elif 'score' in columns and 'status' in columns:
+        dest_columns = ('user_id INTEGER NOT NULL, anime_id INTEGER NOT NULL, '
+                        'status_id INTEGER NOT NULL, score INTEGER')
+        index_columns = ('user_id', 'anime_id', 'status_id', 'score')
+        source_cur.execute('''SELECT user_id, anime_name, status, score
+                              FROM {0}'''.format(table_name))
+        rows = ((get_id(user_ids, r[0]), get_id(anime_ids, r[1]),
+                 get_id(status_ids, r[2]), r[3]) for r in source_cur)
+    elif 'score' in columns:
+        dest_columns = ('user_id INTEGER NOT NULL, anime_id INTEGER NOT NULL, '
+                        'score INTEGER')
+        index_columns = ('user_id', 'anime_id', 'score')
+        source_cur.execute('SELECT user_id, anime_name, score FROM {0}'.format(
+                table_name))
+        rows = ((get_id(user_ids, r[0]), get_id(anime_ids, r[1]), r[2])
+                for r in source_cur)
+    elif 'status' in columns:
+        dest_columns = ('user_id INTEGER NOT NULL, anime_id INTEGER NOT NULL, '
+                        'status_id INTEGER NOT NULL')
+        index_columns = ('user_id', 'anime_id', 'status_id')
+        source_cur.execute('SELECT user_id, anime_name, status FROM {0}'.format(
+                table_name))
+        rows = ((get_id(user_ids, r[0]), get_id(anime_ids, r[1]),
+                 get_id(status_ids, r[2])) for r in source_cur)
+    else:
+        raise SchemaException(
+                'Table ({0}) has unknown columns: {1}'.format(
+                    table_name, ', '.join(sorted(columns))))
+
+    dest_cur.execute('DROP TABLE IF EXISTS {0}'.format(table_name))
+    dest_cur.execute('CREATE TABLE {0} ({1})'.format(table_name, dest_columns))
+    writer.add_rows(table_name, rows)
+    writer.flush()
+
+    # Covering index for reading a user's rows, which the incremental builds
+    # and top-k test need, without touching the table
+    create_indexes(dest_cur, table_name, index_columns)
+
+
+def _get_compact_topk_rows(source_cur, table_name, columns, get_anime_id):
+    """Yields (user_id, anime_name, rand_anime_ids blob) rows for the given
+    top-k table in the source database, which can be in the plain form or the
+    compact form created by create_topk_test_db. The random anime IDs in the
+    blobs are IDs from the given get_anime_id function.
+    """
+    if 'rand_anime_ids' in columns:
+        source_cur.execute('''SELECT anime_id, anime_name FROM {0}Anime
+                              '''.format(table_name))
+        id_map = dict((r[0], get_anime_id(r[1])) for r in source_cur.fetchall())
+        id_map_array = np.zeros(max(id_map) + 1 if id_map else 0,
+                                dtype='<i4')
+        for source_id, dest_id in id_map.iteritems():
+            id_map_array[source_id] = dest_id
+
+        source_cur.execute('''SELECT user_id, anime_name, rand_anime_ids
+                              FROM {0}'''.format(table_name))
+        for user, anime, blob in source_cur:
+            rand_ids = id_map_array[np.frombuffer(blob, dtype='<i4')]
+            yield (user, anime, sqlite3.Binary(rand_ids.tostring()))
+        return
+
+    # The plain form has one row per random anime, so group the rows of each
+    # (user, anime) pair back together
+    source_cur.execute('''SELECT user_id, anime_name, rand_anime_name FROM {0}
+                          ORDER BY user_id, anime_name'''.format(table_name))
+    pair = None
+    rand_ids = []
+    for user, anime, rand_anime in source_cur:
+        if (user, anime) != pair:
+            if pair is not None:
+                yield pair + (sqlite3.Binary(
+                        np.array(rand_ids, dtype='<i4').tostring()),)
+            pair = (user, anime)
+            rand_ids = []
+        rand_ids.append(get_anime_id(rand_anime))
+    if pair is not None:
+        yield pair + (sqlite3.Binary(
+                np.array(rand_ids, dtype='<i4').tostring()),)
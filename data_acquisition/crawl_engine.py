@@ -0,0 +1,502 @@
+# Objects for crawling MyAnimeList with a concurrent, rate-limited pipeline.
+
+import BaseHTTPServer
+import httplib
+import md5
+import os
+import Queue
+import random
+import resource
+import socket
+import SocketServer
+import threading
+import time
+from lxml import html
+
+from data_acquisition.crawl_mal import (MAL_RATINGS_DB_NAME,
+        MAL_RATINGS_TABLE_NAME, MAL_RECENT_USERS_URL,
+        MAL_USER_ANIME_LIST_URL_FORMAT, MIN_SCORES_FOR_STORAGE,
+        anime_list_needs_rendering, create_render_session,
+        parse_mal_user_scores, parse_recent_mal_users,
+        recent_users_need_rendering)
+from data_acquisition.crawl_frontier import CrawlFrontier
+from data_acquisition.page_fetch import FetchException, PageFetcher
+from data_acquisition.score_writer import ScoreWriter
+
+# HTTP status codes that mean a request should be tried again later
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class CrawlException(Exception):
+    """Indicates that a page could not be fetched."""
+    pass
+
+
+class TokenBucket:
+    """Object that limits how fast requests are sent by all of the threads of a
+    crawler together.
+
+    The bucket holds up to capacity tokens and gains rate tokens every second.
+    Each request takes one token, waiting until one is available, so requests
+    are sent at most rate times a second on average with bursts of at most
+    capacity requests.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """Constructor for a token bucket.
+
+        rate - Number of tokens added to the bucket every second.
+        capacity - Maximum number of tokens in the bucket. 1 by default, which
+                   spaces every request out evenly.
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_update = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token from the bucket, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CrawlEngine:
+    """Object that crawls the anime lists of MAL users with a pipeline of
+    threads.
+
+    The pipeline has three stages connected by bounded queues: fetch threads
+    download the anime list pages, parse threads turn the pages into
+    MALUserScore objects, and a ScoreWriter stores the scores of users with
+    enough scores in the ratings database in batches. Every request to the server,
+    including retries, takes a token from a shared TokenBucket, so the
+    politeness budget holds no matter how many fetch threads there are. A
+    full queue blocks the stage before it, so a slow stage can't make the
+    others use unbounded memory.
+
+    Pages are fetched as raw HTML over pooled keep-alive connections. A parse
+    thread only renders a page in a dryscrape session if its raw HTML is
+    missing the content to parse.
+
+    Users found on the recent users page go through a CrawlFrontier kept in
+    the ratings database, so users crawled recently are skipped and users
+    left waiting by an earlier crawl are crawled first.
+
+    Usage:
+        engine = CrawlEngine(0.5, fetch_threads=4)
+        engine.crawl(10)
+    """
+
+    def __init__(self, requests_per_second, fetch_threads=4, parse_threads=2,
+                 queue_size=100, max_retries=3, backoff=2.0, burst=1,
+                 recent_users_url=MAL_RECENT_USERS_URL,
+                 user_anime_list_url_format=MAL_USER_ANIME_LIST_URL_FORMAT,
+                 db_path=MAL_RATINGS_DB_NAME,
+                 table_name=MAL_RATINGS_TABLE_NAME, report_interval=10,
+                 session_factory=create_render_session, refresh_days=90):
+        """Constructor for a crawl engine.
+
+        requests_per_second - Maximum average number of requests per second
+                              sent to the server by all of the fetch threads
+                              together. This should be low enough not to spam
+                              MAL's servers.
+        fetch_threads - Number of threads fetching pages. 4 by default.
+        parse_threads - Number of threads parsing pages. 2 by default.
+        queue_size - Maximum number of items waiting in each queue between the
+                     stages. 100 by default.
+        max_retries - Number of times to retry a request that failed with a
+                      network error or a retryable status code before giving
+                      up on the page. 3 by default.
+        backoff - Seconds to wait before the first retry of a request. The
+                  wait doubles with every retry, plus some random jitter. 2.0
+                  by default.
+        burst - Maximum number of requests that can be sent at once after the
+                crawler has been idle. 1 by default.
+        recent_users_url - URL of the page listing recent users. MAL's page by
+                           default, but can point at a local server of saved
+                           pages for testing.
+        user_anime_list_url_format - Format of the URL of a user's anime list
+                                     page, with a {username} field. MAL's
+                                     format by default.
+        db_path - String of the path to the database to store the ratings in.
+                  MAL_RATINGS_DB_NAME by default.
+        table_name - String of the name of the table to store the ratings in.
+                     MAL_RATINGS_TABLE_NAME by default.
+        report_interval - Seconds between progress reports while crawling. 10
+                          by default.
+        session_factory - Function with no arguments that returns a new
+                          browser session to render pages with, or None to
+                          never render pages. create_render_session by
+                          default.
+        refresh_days - Number of days after which a crawled user is crawled
+                       again when they are found. 90 by default.
+        """
+        self.rate_limiter = TokenBucket(requests_per_second, burst)
+        self.fetch_threads = fetch_threads
+        self.parse_threads = parse_threads
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.recent_users_url = recent_users_url
+        self.user_anime_list_url_format = user_anime_list_url_format
+        self.db_path = db_path
+        self.table_name = table_name
+        self.report_interval = report_interval
+        self.session_factory = session_factory
+        self.refresh_days = refresh_days
+
+    def crawl(self, iterations):
+        """Crawls the users on the recent users page the given number of times
+        and stores their ratings in the database.
+
+        Returns a dict of the totals from the crawl: 'pages' fetched, pages
+        'rendered', 'retries', 'failures', 'users' and 'scores' stored, and
+        'seconds'.
+        """
+        self.fetch_queue = Queue.Queue(self.queue_size)
+        self.parse_queue = Queue.Queue(self.queue_size)
+        self.stats_lock = threading.Lock()
+        self.stats = dict(pages=0, rendered=0, retries=0, failures=0, users=0,
+                          scores=0)
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.fetcher = PageFetcher(self.fetch_threads, self.session_factory)
+        self.frontier = CrawlFrontier(self.db_path, self.table_name,
+                                      self.refresh_days)
+        self.writer = ScoreWriter(self.db_path, self.table_name,
+                                  self.frontier, self.queue_size)
+        # Users queued by this crawl, so users still waiting in the pipeline
+        # aren't queued again. Users are only removed if crawling them fails.
+        self.queued_users = set()
+
+        fetchers = self._start_threads(self._fetch_worker, self.fetch_threads)
+        parsers = self._start_threads(self._parse_worker, self.parse_threads)
+        reporter = self._start_threads(self._report_worker, 1)
+
+        try:
+            for i in xrange(iterations):
+                try:
+                    recent_users_page = self._get_page_tree(
+                            self.recent_users_url, self._fetch_page(
+                                self.recent_users_url),
+                            recent_users_need_rendering)
+                    self.frontier.add_users(
+                            parse_recent_mal_users(recent_users_page))
+                except CrawlException as e:
+                    print u'Could not get recent users: {0}'.format(e)
+
+                # Users left waiting by an earlier crawl are queued first
+                for mal_user in self.frontier.get_pending_users(
+                        exclude=self.queued_users):
+                    with self.stats_lock:
+                        self.queued_users.add(mal_user)
+                    self.fetch_queue.put(mal_user)
+        finally:
+            # Shut the stages down in order once the stage before is done, so
+            # every queued page is still parsed and written
+            self._stop_threads(self.fetch_queue, fetchers)
+            self._stop_threads(self.parse_queue, parsers)
+            self.writer.close()
+            self.done.set()
+            reporter[0].join()
+            self.fetcher.close()
+            self.writer.report()
+            self.frontier.print_stats()
+            self.frontier.close()
+
+        self.stats['seconds'] = time.time() - self.start_time
+        self.report()
+        return self.stats
+
+    def fetch(self, url):
+        """Returns the body of the page at the given URL, retrying with
+        exponential backoff if the request fails with a network error or a
+        retryable status code.
+
+        Raises a CrawlException if the page could not be fetched.
+        """
+        for attempt in xrange(self.max_retries + 1):
+            if attempt > 0:
+                self._add_stat('retries')
+                delay = self.backoff * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay))
+
+            self.rate_limiter.acquire()
+            try:
+                body = self.fetcher.fetch(url)
+            except FetchException as e:
+                if e.status not in RETRY_STATUS_CODES:
+                    raise CrawlException(str(e))
+                error = e
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+            else:
+                self._add_stat('pages')
+                return body
+
+        raise CrawlException('{0} failed after {1} retries: {2}'.format(
+                url, self.max_retries, error))
+
+    def report(self):
+        """Prints the pages fetched per second so far and the number of items
+        waiting in each queue.
+        """
+        seconds = max(time.time() - self.start_time, 1e-9)
+        print (u'{0} pages ({1:.2f} pages/sec, {2} rendered), {3} users and '
+               u'{4} scores stored, {5} retries, {6} failures | queued: '
+               u'fetch {7}, parse {8}, write {9}').format(
+                    self.stats['pages'], self.stats['pages'] / seconds,
+                    self.stats['rendered'], self.stats['users'],
+                    self.stats['scores'],
+                    self.stats['retries'], self.stats['failures'],
+                    self.fetch_queue.qsize(), self.parse_queue.qsize(),
+                    self.writer.queue.qsize())
+
+    def _fetch_worker(self):
+        """Fetches the anime list page of each user in the fetch queue."""
+        for mal_user in iter(self.fetch_queue.get, None):
+            url = self.user_anime_list_url_format.format(username=mal_user)
+            try:
+                page_html = self._fetch_page(url)
+            except CrawlException as e:
+                self._record_failure(mal_user, e)
+                continue
+            self.parse_queue.put((mal_user, url, page_html))
+
+    def _parse_worker(self):
+        """Parses the scores from each anime list page in the parse queue.
+        Any error with a page is recorded as a failure of its user, and the
+        worker keeps taking pages so the fetch workers never wait on a full
+        queue and the shutdown sentinel is always reached.
+        """
+        for mal_user, url, page_html in iter(self.parse_queue.get, None):
+            try:
+                self._parse_user(mal_user, url, page_html)
+            except Exception as e:
+                self._record_failure(mal_user, e)
+
+    def _parse_user(self, mal_user, url, page_html):
+        """Parses the scores of the given user from the raw HTML of their
+        anime list page at the given URL and hands them to the writer.
+        """
+        page_tree = self._get_page_tree(url, page_html,
+                                        anime_list_needs_rendering)
+        scores = parse_mal_user_scores(page_tree, mal_user)
+        total_scores = sum(1 for s in scores if s.score is not None)
+        if total_scores < MIN_SCORES_FOR_STORAGE:
+            scores = []
+        self.writer.put(mal_user, scores, total_scores)
+        if scores:
+            self._add_stat('users')
+            self._add_stat('scores', len(scores))
+
+    def _fetch_page(self, url):
+        """Returns the raw HTML of the page at the given URL like fetch(), or
+        None if it could not be fetched but can be rendered instead.
+        """
+        try:
+            return self.fetch(url)
+        except CrawlException as e:
+            if self.session_factory is None:
+                raise
+            print u'Fetching failed, rendering instead: {0}'.format(e)
+            return None
+
+    def _get_page_tree(self, url, page_html, needs_rendering):
+        """Returns an lxml tree of the given raw HTML of the page at the given
+        URL, or of the rendered page if there is no raw HTML, or if
+        needs_rendering returns True for the tree of the raw HTML and pages
+        can be rendered.
+        """
+        if page_html is not None:
+            page_tree = html.fromstring(page_html)
+            if (self.session_factory is None or
+                    not needs_rendering(page_tree)):
+                return page_tree
+
+        self.rate_limiter.acquire()
+        try:
+            page_tree = html.fromstring(self.fetcher.render(url))
+        except Exception as e:
+            raise CrawlException('{0} could not be rendered: {1}'.format(
+                    url, e))
+        self._add_stat('rendered')
+        return page_tree
+
+    def _report_worker(self):
+        """Reports progress every report_interval seconds until the crawl is
+        done.
+        """
+        while not self.done.wait(self.report_interval):
+            self.report()
+
+    def _record_failure(self, mal_user, error):
+        """Records in the frontier that crawling the given user failed with the
+        given error. Errors recording it, such as the database being locked,
+        are printed rather than raised so they don't stop the calling worker.
+        """
+        self._add_stat('failures')
+        print u'Could not crawl user {0}: {1}'.format(
+                md5.new(mal_user).hexdigest(), error)
+        try:
+            self.frontier.record_failure(mal_user)
+        except Exception as record_error:
+            print u'Could not record failure of user {0}: {1}'.format(
+                    md5.new(mal_user).hexdigest(), record_error)
+        finally:
+            with self.stats_lock:
+                self.queued_users.discard(mal_user)
+
+    def _add_stat(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def _start_threads(self, target, total):
+        threads = [threading.Thread(target=target) for i in xrange(total)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _stop_threads(self, queue, threads):
+        """Tells the given threads reading from the given queue to stop once
+        the queue is empty and waits for them.
+        """
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class _SavedPageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler serving the saved pages of a SavedPageServer."""
+
+    def do_GET(self):
+        path = os.path.join(self.server.pages_dir,
+                            self.path.lstrip('/').split('?')[0])
+        if not os.path.isfile(path) and os.path.isfile(path + '.html'):
+            path += '.html'
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as page_file:
+            body = page_file.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SavedPageServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    """Local HTTP server that serves saved MAL pages, so crawlers can be tested
+    without sending requests to MAL.
+
+    A request for /<path> is answered with the file <pages_dir>/<path> or
+    <pages_dir>/<path>.html, e.g. users.php.html for the recent users page and
+    animelist/<username>.html for anime list pages.
+
+    Usage:
+        server = SavedPageServer('saved_pages')
+        engine = CrawlEngine(50, recent_users_url=server.url + '/users.php',
+                user_anime_list_url_format=server.url + '/animelist/{username}')
+        engine.crawl(1)
+        server.stop()
+    """
+    daemon_threads = True
+
+    def __init__(self, pages_dir, port=0):
+        """Starts serving the pages in the given directory in a background
+        thread on the given port of localhost. A free port is picked if the
+        port is 0, which is the default.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           _SavedPageHandler)
+        self.pages_dir = pages_dir
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the server and waits for it to shut down."""
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def benchmark_parsing(pages_dir, render=True):
+    """Parses every saved anime list page in the animelist directory of the
+    given directory with the raw HTML path and, if render is True, with the
+    dryscrape rendering path, and prints the average time per page and the
+    increase in peak memory for each path.
+
+    The raw HTML path reads each page from disk and parses it with the
+    compiled XPaths. The rendering path loads each page from a SavedPageServer
+    in a dryscrape session first, like crawl_mal_ratings did for every page.
+    The peak memory is the peak resident set size of this process, so it does
+    not include the separate webkit_server process that renders the pages.
+
+    Returns a dict mapping 'raw' and 'render' to tuples of the average seconds
+    per page and the increase in peak memory in kilobytes.
+    """
+    list_dir = os.path.join(pages_dir, 'animelist')
+    page_names = sorted(f for f in os.listdir(list_dir) if f.endswith('.html'))
+    if not page_names:
+        print 'No saved pages in {0}'.format(list_dir)
+        return {}
+
+    def parse_pages(get_page):
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        total_scores = 0
+        for page_name in page_names:
+            mal_user = page_name[:-len('.html')]
+            total_scores += len(parse_mal_user_scores(get_page(page_name),
+                                                      mal_user))
+        seconds = (time.time() - start) / len(page_names)
+        memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                  peak_memory)
+        return seconds, memory, total_scores
+
+    def read_page(page_name):
+        with open(os.path.join(list_dir, page_name), 'rb') as page_file:
+            return page_file.read()
+
+    results = {}
+    seconds, memory, total_scores = parse_pages(read_page)
+    results['raw'] = (seconds, memory)
+    print 'Raw HTML: {0:.2f} ms/page, +{1} KB peak memory, {2} scores'.format(
+            seconds * 1000, memory, total_scores)
+
+    if render:
+        server = SavedPageServer(pages_dir)
+        session = create_render_session()
+        try:
+            def render_page(page_name):
+                session.visit('{0}/animelist/{1}'.format(server.url,
+                                                         page_name))
+                return session.body()
+
+            seconds, memory, total_scores = parse_pages(render_page)
+        finally:
+            server.stop()
+        results['render'] = (seconds, memory)
+        print ('Rendered: {0:.2f} ms/page, +{1} KB peak memory, '
+               '{2} scores').format(seconds * 1000, memory, total_scores)
+
+    return results
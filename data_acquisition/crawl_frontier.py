@@ -0,0 +1,284 @@
+# Objects for keeping track of which MAL users have been crawled.
+
+import math
+import md5
+import sqlite3
+import threading
+import time
+
+# Name of the table in the ratings database that holds the crawl frontier
+CRAWL_FRONTIER_TABLE_NAME = u'CrawlFrontier'
+
+# Outcomes of crawling a user recorded in the crawl frontier
+STORED_OUTCOME = u'stored'
+TOO_FEW_SCORES_OUTCOME = u'too_few_scores'
+FAILED_OUTCOME = u'failed'
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class BloomFilter:
+    """Object for a set of MD5 hex digests that answers membership queries in
+    memory using a fixed number of bits.
+
+    Keys that were added are always reported as members, but keys that were not
+    added are also reported as members with a probability of about error_rate
+    once capacity keys have been added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Constructor for a Bloom filter.
+
+        capacity - Number of keys the filter is sized for.
+        error_rate - Probability of a false positive once capacity keys have
+                     been added. 0.01 by default.
+        """
+        capacity = max(capacity, 1)
+        self.total_bits = int(math.ceil(
+                -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.total_hashes = max(1, int(round(
+                self.total_bits * math.log(2) / capacity)))
+        self.bits = bytearray((self.total_bits + 7) // 8)
+
+    def add(self, key):
+        """Adds the given MD5 hex digest to the filter."""
+        for bit in self._get_bits(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[bit >> 3] & (1 << (bit & 7))
+                   for bit in self._get_bits(key))
+
+    def _get_bits(self, key):
+        """Returns the bits for the given MD5 hex digest. The digest is already
+        uniformly distributed, so its two halves are used as the two hashes
+        for double hashing instead of hashing it again.
+        """
+        first = int(key[:16], 16)
+        second = int(key[16:], 16) | 1
+        return [(first + i * second) % self.total_bits
+                for i in xrange(self.total_hashes)]
+
+
+class CrawlFrontier:
+    """Object that keeps the crawl frontier, the record of every MAL user the
+    crawler has found, in a table of the ratings database.
+
+    Each user is stored by the MD5 hex digest of their username with the time
+    they were last crawled, the outcome, and whether they are waiting to be
+    crawled. Usernames are only kept while a user is waiting, since they are
+    needed to fetch the user's anime list, so a crawl that stops early resumes
+    with the same users when it is restarted.
+
+    Users that were crawled less than refresh_days ago are skipped when they
+    are found again. Their MD5 digests are kept in a BloomFilter, so most of
+    them are skipped without querying the database. Users crawled longer ago
+    are crawled again, and their old ratings are replaced.
+    """
+
+    def __init__(self, db_path, ratings_table_name, refresh_days=90,
+                 max_attempts=3, expected_new_users=100000, error_rate=0.01):
+        """Constructor for a crawl frontier. Creates the frontier table if
+        needed, adding every user already in the ratings table to it as
+        crawled now.
+
+        db_path - String of the path to the ratings database.
+        ratings_table_name - String of the name of the table of ratings.
+        refresh_days - Number of days after which a crawled user is crawled
+                       again when they are found. 90 by default.
+        max_attempts - Number of times to try crawling a user before giving up
+                       on them until refresh_days have passed. 3 by default.
+        expected_new_users - Number of users the crawler is expected to add to
+                             the frontier in this run, used with the users
+                             already in it to size the Bloom filter. 100000 by
+                             default.
+        error_rate - Rate of users wrongly skipped by the Bloom filter once
+                     it is full. 0.01 by default.
+        """
+        self.ratings_table_name = ratings_table_name
+        self.refresh_seconds = refresh_days * SECONDS_PER_DAY
+        self.max_attempts = max_attempts
+
+        # The connection is shared by the threads of a crawl engine
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            self._init_table(cur)
+
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(
+                    CRAWL_FRONTIER_TABLE_NAME))
+            self.recent_users = BloomFilter(
+                    cur.fetchone()[0] + expected_new_users, error_rate)
+            cur.execute('''SELECT user_id FROM {0}
+                           WHERE pending = 0 AND crawled_at >= ?'''.format(
+                               CRAWL_FRONTIER_TABLE_NAME),
+                        (time.time() - self.refresh_seconds,))
+            for row in cur:
+                self.recent_users.add(row[0])
+
+    def add_users(self, mal_users):
+        """Adds the given usernames to the frontier to be crawled, skipping
+        users that are already waiting or were crawled recently.
+
+        Returns the number of users added.
+        """
+        total_added = 0
+        now = time.time()
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            for mal_user in mal_users:
+                user_id = md5.new(mal_user).hexdigest()
+                if user_id in self.recent_users:
+                    continue
+
+                cur.execute('''SELECT pending, crawled_at FROM {0}
+                               WHERE user_id = ?'''.format(
+                                   CRAWL_FRONTIER_TABLE_NAME), (user_id,))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute('''INSERT INTO {0} (user_id, username,
+                                   pending, attempts, added_at)
+                                   VALUES(?,?,1,0,?)'''.format(
+                                       CRAWL_FRONTIER_TABLE_NAME),
+                                (user_id, mal_user.decode('utf-8'), now))
+                elif row[0]:
+                    continue
+                elif row[1] is not None and row[1] >= now - self.refresh_seconds:
+                    self.recent_users.add(user_id)
+                    continue
+                else:
+                    cur.execute('''UPDATE {0} SET username = ?, pending = 1,
+                                   attempts = 0, added_at = ?
+                                   WHERE user_id = ?'''.format(
+                                       CRAWL_FRONTIER_TABLE_NAME),
+                                (mal_user.decode('utf-8'), now, user_id))
+                total_added += 1
+        return total_added
+
+    def get_pending_users(self, limit=None, exclude=()):
+        """Returns a list of the usernames waiting to be crawled, oldest first.
+
+        limit - Maximum number of usernames to return, or None for all of
+                them. None by default.
+        exclude - Collection of usernames to leave out, such as users already
+                  queued by a crawl engine. Empty by default.
+        """
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('''SELECT username FROM {0} WHERE pending = 1
+                           ORDER BY added_at'''.format(
+                               CRAWL_FRONTIER_TABLE_NAME))
+            mal_users = []
+            for row in cur:
+                mal_user = row[0].encode('utf-8')
+                if mal_user in exclude:
+                    continue
+                mal_users.append(mal_user)
+                if limit is not None and len(mal_users) >= limit:
+                    break
+        return mal_users
+
+    def record_crawl(self, cur, mal_user, total_scores, stored):
+        """Records that the given user was crawled using the given cursor, so
+        it is committed with the user's ratings. If this crawl's ratings are
+        stored, ratings stored by an earlier crawl of the user are deleted, so
+        only the ratings from this crawl are kept. Otherwise the earlier
+        ratings are left alone, since a list that went private or failed to
+        parse says nothing about them.
+
+        cur - Cursor of the connection the user's ratings are written with.
+              The caller commits the changes.
+        mal_user - String of the username of the crawled user.
+        total_scores - Number of scores found for the user.
+        stored - Boolean indicating whether the user's ratings are stored.
+        """
+        user_id = md5.new(mal_user).hexdigest()
+        if stored:
+            cur.execute('DELETE FROM {0} WHERE user_id = ?'.format(
+                        self.ratings_table_name), (user_id,))
+
+        cur.execute('''INSERT OR REPLACE INTO {0} (user_id, username, pending,
+                       crawled_at, outcome, total_scores, attempts, added_at)
+                       VALUES(?, NULL, 0, ?, ?, ?, 0, ?)'''.format(
+                           CRAWL_FRONTIER_TABLE_NAME),
+                    (user_id, time.time(),
+                     STORED_OUTCOME if stored else TOO_FEW_SCORES_OUTCOME,
+                     total_scores, time.time()))
+        self.recent_users.add(user_id)
+
+    def record_failure(self, mal_user):
+        """Records that crawling the given user failed. The user stays waiting
+        to be crawled until they have failed max_attempts times.
+        """
+        user_id = md5.new(mal_user).hexdigest()
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            cur.execute('''UPDATE {0} SET attempts = attempts + 1
+                           WHERE user_id = ?'''.format(
+                               CRAWL_FRONTIER_TABLE_NAME), (user_id,))
+            cur.execute('''UPDATE {0} SET username = NULL, pending = 0,
+                           crawled_at = ?, outcome = ?
+                           WHERE user_id = ? AND attempts >= ?'''.format(
+                               CRAWL_FRONTIER_TABLE_NAME),
+                        (time.time(), FAILED_OUTCOME, user_id,
+                         self.max_attempts))
+
+    def print_stats(self):
+        """Prints the number of users waiting to be crawled and the number of
+        crawled users with each outcome.
+        """
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM {0} WHERE pending = 1'.format(
+                        CRAWL_FRONTIER_TABLE_NAME))
+            total_pending = cur.fetchone()[0]
+            cur.execute('''SELECT outcome, COUNT(*) FROM {0} WHERE pending = 0
+                           GROUP BY outcome'''.format(
+                               CRAWL_FRONTIER_TABLE_NAME))
+            outcomes = ', '.join('{0}: {1}'.format(o, n)
+                                 for o, n in cur.fetchall())
+        print u'Crawl frontier: {0} pending | {1}'.format(total_pending,
+                                                          outcomes)
+
+    def close(self):
+        self.conn.close()
+
+    def _init_table(self, cur):
+        """Creates the frontier table if it doesn't exist, adding the users
+        already in the ratings table to it.
+        """
+        if self._table_exists(cur, CRAWL_FRONTIER_TABLE_NAME):
+            return
+
+        cur.execute('''CREATE TABLE {0} (
+                       user_id TEXT PRIMARY KEY,
+                       username TEXT,
+                       pending INTEGER NOT NULL,
+                       crawled_at REAL,
+                       outcome TEXT,
+                       total_scores INTEGER,
+                       attempts INTEGER NOT NULL,
+                       added_at REAL NOT NULL)'''.format(
+                           CRAWL_FRONTIER_TABLE_NAME))
+        cur.execute('''CREATE INDEX {0}Pending ON {0} (pending, added_at)
+                       '''.format(CRAWL_FRONTIER_TABLE_NAME))
+
+        if not self._table_exists(cur, self.ratings_table_name):
+            return
+
+        # Replacing the ratings of a crawled user looks them up by user
+        cur.execute('''CREATE INDEX IF NOT EXISTS {0}UserIndex
+                       ON {0} (user_id)'''.format(self.ratings_table_name))
+        now = time.time()
+        cur.execute('''INSERT INTO {0} (user_id, pending, crawled_at, outcome,
+                       attempts, added_at)
+                       SELECT DISTINCT user_id, 0, ?, ?, 0, ? FROM {1}
+                       '''.format(CRAWL_FRONTIER_TABLE_NAME,
+                                  self.ratings_table_name),
+                    (now, STORED_OUTCOME, now))
+
+    def _table_exists(self, cur, table_name):
+        cur.execute('''SELECT COUNT(*) FROM sqlite_master
+                       WHERE type = 'table' AND name = ?''', (table_name,))
+        return cur.fetchone()[0] > 0
@@ -1,11 +1,15 @@
 # Functions for crawling public anime rating data on MyAnimeList.
 
-import dryscrape
+import httplib
 import md5
-import sqlite3
-from lxml import html
+import socket
+from lxml import etree, html
 from time import sleep
 
+from data_acquisition.crawl_frontier import CrawlFrontier
+from data_acquisition.page_fetch import FetchException, PageFetcher
+from data_acquisition.score_writer import ScoreWriter
+
 # URL for the page on MyAnimeList that lists users that have recently logged in
 MAL_RECENT_USERS_URL = 'http://myanimelist.net/users.php'
 
@@ -40,6 +44,16 @@ GET_TABLE_ANIME_NAME_XPATH = './/*[@class="animetitle"]/span/text()'
 # XPath for getting the score from an entry in a table in a user's anime list
 GET_TABLE_ANIME_SCORE_XPATH = './/td[3]/text()'
 
+# Compiled versions of the XPaths above, which are evaluated for every page
+# and every table in an anime list
+_RECENT_USERS = etree.XPath(RECENT_USERS_XPATH)
+_ANIME_LIST_TABLES = etree.XPath(ANIME_LIST_TABLES_XPATH)
+_GET_TABLE_STATUS = etree.XPath(GET_TABLE_STATUS_XPATH)
+_GET_TABLE_HEADER = etree.XPath(GET_TABLE_HEADER_XPATH)
+_GET_TABLE_CATEGORY_TOTALS = etree.XPath(GET_TABLE_CATEGORY_TOTALS_XPATH)
+_GET_TABLE_ANIME_NAME = etree.XPath(GET_TABLE_ANIME_NAME_XPATH)
+_GET_TABLE_ANIME_SCORE = etree.XPath(GET_TABLE_ANIME_SCORE_XPATH)
+
 
 # Name of the sqlite3 database to store the anime rating data
 MAL_RATINGS_DB_NAME = u'data_acquisition/temp_ratings.db'
@@ -69,42 +83,113 @@ class MALUserScore:
         """Uses the given cursor to add a row to the given table with this
         object's score information.
         """
+        cursor.execute(u'''INSERT INTO {0} (user_id, anime_name, status, score)
+                          VALUES(?,?,?,?)'''.format(table_name),
+                       self.get_db_row());
+
+    def get_db_row(self):
+        """Returns a tuple of the values of the row for this object's score
+        information in a table of scores.
+        """
         db_score = self.score if self.score is None else self.score.decode('utf-8')
-        cursor.execute(u'INSERT INTO {0} VALUES(?,?,?,?)'.format(table_name),
-                       [self.user_id.decode('utf-8'),
-                        self.anime_name.decode('utf-8'),
-                        self.status.decode('utf-8'),
-                        db_score]);
+        return (self.user_id.decode('utf-8'), self.anime_name.decode('utf-8'),
+                self.status.decode('utf-8'), db_score)
 
     def __repr__(self):
         return '{0}\t{1}\t{2}\t{3}'.format(self.user_id, self.anime_name,
                                            self.status, self.score)
 
 
+def create_render_session():
+    """Returns a new dryscrape session for rendering pages. dryscrape is only
+    imported here, since it starts WebKit and most pages are never rendered.
+    """
+    import dryscrape
+    session = dryscrape.Session()
+    session.set_attribute('auto_load_images', False)
+    return session
+
+def get_page_tree(session, url, needs_rendering):
+    """Returns an lxml tree of the page at the given URL.
+
+    session - a PageFetcher object, or a dryscrape session object to render
+              every page. A PageFetcher only fetches the raw HTML of the page,
+              and renders the page only if needs_rendering returns True for
+              the tree of the raw HTML, or if the page could not be fetched.
+    url - a string of the URL of the page.
+    needs_rendering - function taking the lxml tree of a page that returns
+                      whether the page is missing content that only appears
+                      once it is rendered.
+    """
+    if not isinstance(session, PageFetcher):
+        session.visit(url)
+        return html.fromstring(session.body())
+
+    try:
+        page_tree = html.fromstring(session.fetch(url))
+    except (FetchException, httplib.HTTPException, socket.error):
+        if not session.can_render():
+            raise
+        return html.fromstring(session.render(url))
+    if needs_rendering(page_tree):
+        page_tree = html.fromstring(session.render(url))
+    return page_tree
+
+def recent_users_need_rendering(page_tree):
+    """Returns whether the given lxml tree of MAL's recent users page is
+    missing the list of users.
+    """
+    return len(_RECENT_USERS(page_tree)) == 0
+
+def anime_list_needs_rendering(page_tree):
+    """Returns whether the given lxml tree of a user's anime list page is
+    missing the anime list tables.
+    """
+    return len(_ANIME_LIST_TABLES(page_tree)) == 0
+
 def get_recent_mal_users(session):
     """Returns a list of users from MAL's recent users page.
 
-    session - a dryscrape session object that can be used for the crawling.
+    session - a PageFetcher object or a dryscrape session object that can be
+              used for the crawling.
     """
-    session.visit(MAL_RECENT_USERS_URL)
-    page_tree = html.fromstring(session.body())
-    return [u.encode('utf-8') for u in page_tree.xpath(RECENT_USERS_XPATH)]
+    return parse_recent_mal_users(get_page_tree(
+            session, MAL_RECENT_USERS_URL, recent_users_need_rendering))
+
+def parse_recent_mal_users(page):
+    """Returns a list of users from MAL's recent users page, given as either a
+    string of its HTML or an lxml tree of it.
+    """
+    page_tree = html.fromstring(page) if isinstance(page, basestring) else page
+    return [u.encode('utf-8') for u in _RECENT_USERS(page_tree)]
 
 def get_mal_user_scores(session, mal_user):
     """Returns a list of MALUserScore objects with the scores for the given
     MAL user.
 
-    session - a dryscape session object that can be used for the crawling.
+    session - a PageFetcher object or a dryscrape session object that can be
+              used for the crawling.
+    mal_user - a string of the username for a MAL user.
+    """
+    return parse_mal_user_scores(get_page_tree(
+            session, MAL_USER_ANIME_LIST_URL_FORMAT.format(username=mal_user),
+            anime_list_needs_rendering), mal_user)
+
+def parse_mal_user_scores(page, mal_user):
+    """Returns a list of MALUserScore objects with the scores for the given
+    MAL user from the user's anime list page.
+
+    page - a string of the HTML of the user's anime list page, or an lxml tree
+           of it.
     mal_user - a string of the username for a MAL user.
     """
     # Generate anonymous user ID for this user to associate with their ratings
     user_id = md5.new(mal_user).hexdigest().encode('utf-8')
 
     anime_scores = []
-    session.visit(MAL_USER_ANIME_LIST_URL_FORMAT.format(username=mal_user))
-    page_tree = html.fromstring(session.body())
+    page_tree = html.fromstring(page) if isinstance(page, basestring) else page
 
-    page_tables = page_tree.xpath(ANIME_LIST_TABLES_XPATH)
+    page_tables = _ANIME_LIST_TABLES(page_tree)
     # There will be no table objects on the page if the user made their anime
     # list private.
     if len(page_tables) == 0:
@@ -113,7 +198,7 @@ def get_mal_user_scores(session, mal_user):
     page_tables.pop(0)  # The first table is a navigation bar
     for table in page_tables:
         # Check if the table holds a status type
-        table_status = table.xpath(GET_TABLE_STATUS_XPATH)
+        table_status = _GET_TABLE_STATUS(table)
         if len(table_status) > 0:
             # The text attribute is None when the element has no text in it
             if table_status[0].text is None:
@@ -126,17 +211,17 @@ def get_mal_user_scores(session, mal_user):
             continue
 
         # Skip over the table holding the table headers
-        if len(table.xpath(GET_TABLE_HEADER_XPATH)) > 0:
+        if len(_GET_TABLE_HEADER(table)) > 0:
             continue
 
         # Skip over the table category totals information
-        if len(table.xpath(GET_TABLE_CATEGORY_TOTALS_XPATH)) > 0:
+        if len(_GET_TABLE_CATEGORY_TOTALS(table)) > 0:
             continue
 
         # Create MALUserScore object with the score info from this table
         try:
-            anime_name = table.xpath(GET_TABLE_ANIME_NAME_XPATH)[0].encode('utf-8')
-            score = table.xpath(GET_TABLE_ANIME_SCORE_XPATH)[0].encode('utf-8')
+            anime_name = _GET_TABLE_ANIME_NAME(table)[0].encode('utf-8')
+            score = _GET_TABLE_ANIME_SCORE(table)[0].encode('utf-8')
         except IndexError:
             # If an IndexError occurs, the anime list page uses custom
             # formatting instead of the default, so don't try to parse it
@@ -148,43 +233,72 @@ def get_mal_user_scores(session, mal_user):
 
     return anime_scores
 
-def crawl_mal_ratings(request_delay, iterations):
+def crawl_mal_ratings(request_delay, iterations, render_all_pages=False,
+                      refresh_days=90):
     """Crawl MAL user ratings and insert them into a database.
 
+    The users found on the recent users page are added to a crawl frontier
+    kept in the database, and each iteration crawls every user waiting in the
+    frontier, including users left over from an earlier crawl that stopped
+    early. Users crawled within the last refresh_days days are not crawled
+    again. The scores are written to the database in batches by a
+    ScoreWriter in the background.
+
     request_delay - the number of seconds to wait between each request to MAL.
                     This should at least be 30-60 seconds to ensure that the
                     crawler doesn't send requests any faster than a human could
                     so that it doens't spam MAL's servers.
     iterations - the number of crawling iterations to do. Each iteration checks
                  15 MAL users.
+    render_all_pages - boolean indicating whether every page should be
+                       rendered in a dryscrape session. If False, the raw HTML
+                       of each page is fetched over a plain HTTP connection,
+                       and a page is only rendered if the raw HTML is missing
+                       the content to parse. False by default.
+    refresh_days - the number of days after which a crawled user is crawled
+                   again if they are found on the recent users page. Their
+                   earlier ratings are replaced. 90 by default.
     """
-    conn = sqlite3.connect(MAL_RATINGS_DB_NAME)
-    cur = conn.cursor()
-
-    session = dryscrape.Session()
-    session.set_attribute('auto_load_images', False)
+    if render_all_pages:
+        session = create_render_session()
+    else:
+        session = PageFetcher(1, create_render_session)
+    frontier = CrawlFrontier(MAL_RATINGS_DB_NAME, MAL_RATINGS_TABLE_NAME,
+                             refresh_days)
+    writer = ScoreWriter(MAL_RATINGS_DB_NAME, MAL_RATINGS_TABLE_NAME, frontier)
     for i in range(iterations):
-        mal_users = get_recent_mal_users(session)
-
-        for mal_user in mal_users:
+        try:
+            mal_users = get_recent_mal_users(session)
+        except Exception as e:
+            print u'Could not get recent users: {0}\n'.format(e)
+        else:
+            print u'Added {0} new users to the crawl frontier.\n'.format(
+                    frontier.add_users(mal_users))
+
+        # Users stay pending in the frontier until the writer has written
+        # them, so wait for it before getting the pending users
+        writer.flush()
+        for mal_user in frontier.get_pending_users():
             # Space out requests to avoid spamming MAL servers
             sleep(request_delay)
             print u'Crawling scores for user: {0}'.format(
                     md5.new(mal_user).hexdigest())
-            scores = get_mal_user_scores(session, mal_user)
+            try:
+                scores = get_mal_user_scores(session, mal_user)
+            except Exception as e:
+                print u'Could not crawl user: {0}\n'.format(e)
+                frontier.record_failure(mal_user)
+                continue
 
             # Only keep users that have at least the minimum number of scores
             total_scores = sum(1 for s in scores if s.score is not None)
             print u'User had {0} scores.\n'.format(total_scores)
             if total_scores < MIN_SCORES_FOR_STORAGE:
-                continue
+                scores = []
+            writer.put(mal_user, scores, total_scores)
 
-            try:
-                for score in scores:
-                    score.write_to_db(cur, MAL_RATINGS_TABLE_NAME)
-            except:
-                conn.close()
-                raise
-            conn.commit()
-    conn.close()
+    writer.close()
+    writer.report()
+    frontier.print_stats()
+    frontier.close()
 
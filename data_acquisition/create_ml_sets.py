@@ -1,9 +1,36 @@
 # Functions for creating the data sets from anime rating data for machine
 # learning.
 
+import hashlib
+import numpy as np
 import sqlite3
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain, groupby, imap, islice
 from math import ceil, floor
-from random import shuffle
+from multiprocessing import Pool
+from random import randint, shuffle
+
+# Default number of rows to insert into the destination database between each
+# commit when building the data sets
+DEFAULT_ROWS_PER_TRANSACTION = 50000
+
+# Name of the table in each destination database that records how far into
+# each source table the data sets have been built
+WATERMARK_TABLE_NAME = 'BuildWatermarks'
+
+# Name of the column declared INTEGER PRIMARY KEY AUTOINCREMENT in the tables
+# that incremental builds read from, so their rowids are never reused
+ROW_ID_COLUMN = 'row_id'
+
+# Column definitions of the table of crawled ratings
+RATINGS_COLUMN_DEFS = ('user_id TEXT NOT NULL, anime_name TEXT NOT NULL, '
+                       'status TEXT, score INT')
+
+# Page cache size (in KiB, as a negative number for the cache_size PRAGMA) to
+# use for the destination database while building the data sets
+FAST_LOAD_CACHE_SIZE = -200000
 
 class BadRatiosException(Exception):
     """Indicates that the ratios given to one of the functions for creating the
@@ -12,13 +39,73 @@ class BadRatiosException(Exception):
     pass
 
 
+class BulkWriter:
+    """Buffers rows to be inserted into tables of a database and inserts them
+    with executemany, committing once every rows_per_transaction rows instead
+    of once per row or user.
+    """
+
+    def __init__(self, conn, rows_per_transaction=DEFAULT_ROWS_PER_TRANSACTION):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.rows_per_transaction = rows_per_transaction
+        self.pending_rows = defaultdict(list)
+        self.total_pending = 0
+        self.total_written = 0
+        self.start_time = time.time()
+
+    def add_rows(self, table_name, rows):
+        """Adds the rows from the given iterable to be inserted into the given
+        table. Rows are pulled from the iterable only as they are needed, so
+        generators and cursors are not loaded into memory all at once.
+        """
+        rows = iter(rows)
+        while True:
+            space = self.rows_per_transaction - self.total_pending
+            chunk = list(islice(rows, space))
+            if not chunk:
+                break
+            self.pending_rows[table_name].extend(chunk)
+            self.total_pending += len(chunk)
+            if self.total_pending >= self.rows_per_transaction:
+                self.flush()
+
+    def flush(self):
+        """Inserts all of the buffered rows in a single transaction."""
+        for table_name, rows in self.pending_rows.iteritems():
+            insert_into_table(self.cur, table_name, rows)
+        self.conn.commit()
+        self.total_written += self.total_pending
+        self.pending_rows = defaultdict(list)
+        self.total_pending = 0
+
+    def report(self, builder_name):
+        """Prints how many rows have been written and the rate they were
+        written at.
+        """
+        elapsed = time.time() - self.start_time
+        print '{0}: {1} rows in {2:.1f}s ({3:.0f} rows/sec)'.format(
+                builder_name, self.total_written, elapsed,
+                self.total_written / elapsed if elapsed > 0 else 0)
+
+
 def create_topk_test_db(source_db_path, dest_db_path, val_table_name,
                         anime_table_name, topk_percent, topk_min, topk_max,
-                        rand_anime_amount):
+                        rand_anime_amount,
+                        rows_per_transaction=DEFAULT_ROWS_PER_TRANSACTION,
+                        seed=None, processes=None, compact=False,
+                        incremental=False):
     """Creates a data set that can be used for the top-k test proposed by
     Yehuda Koren in his "Factorization Meets the Neighborhood: a Multifaceted
     Collaborative Filtering Model" paper.
 
+    The random anime for each top rated anime are sampled without replacement
+    from the integer IDs of the anime, excluding the top rated anime itself,
+    by a random number generator seeded from the seed and the user ID, so the
+    same seed always gives the same data set. Users are processed in a pool of
+    worker processes. Top rated anime that are not in the anime table are
+    skipped since they can't be ranked among the random anime.
+
     source_db_path - A string of the path to the database with the rating data
                      to be used for the top-k test.
     dest_db_path - A string of the path to the database where the created data
@@ -37,74 +124,204 @@ def create_topk_test_db(source_db_path, dest_db_path, val_table_name,
                in the top-k data set.
     rand_anime_amount - The amount of random anime that should be selected for
                         each user rating for the top-k test.
+    rows_per_transaction - The number of rows to insert into the destination
+                           database between each commit.
+    seed - Integer seed for selecting the random anime. If None, a random seed
+           is used. None by default.
+    processes - Number of worker processes to select the random anime with. If
+                None, one process per CPU is used. If 1, no worker processes
+                are started. None by default.
+    compact - Boolean indicating whether to store the data set in compact
+              form. If True, the top-k table has one row per top rated anime
+              with the IDs of its random anime packed into a blob of 32-bit
+              integers in the rand_anime_ids column, and the anime names for
+              the IDs are stored in a table with the same name plus 'Anime'.
+              topk_test reads either form. False by default.
+    incremental - Boolean indicating whether to only add the users with
+                  validation ratings added since the last build of the top-k
+                  data set, instead of rebuilding it. Existing rows of those
+                  users are replaced and all other rows are left untouched.
+                  The compact argument must match the last build. False by
+                  default.
     """
     topk_test_table_name = 'TopKTestData'
+    topk_anime_table_name = topk_test_table_name + 'Anime'
+    if seed is None:
+        seed = randint(0, 2 ** 32 - 1)
 
     source_conn = sqlite3.connect(source_db_path)
     dest_conn = sqlite3.connect(dest_db_path)
-    with source_conn, dest_conn:
+    with source_conn, dest_conn, fast_load_pragmas(dest_conn):
         scur = source_conn.cursor()
         dcur = dest_conn.cursor()
 
-        # Create table to hold the top-k data set if needed
-        dcur.execute('DROP TABLE IF EXISTS {0}'.format(topk_test_table_name))
-        dcur.execute('''CREATE TABLE {0} (
-                       user_id TEXT NOT NULL,
-                       anime_name TEXT NOT NULL,
-                       rand_anime_name TEXT NOT NULL)'''.format(
-                           topk_test_table_name))
-
         # Get pool of anime to select random anime from for each user rating
         # for the top-k test
         scur.execute('''SELECT DISTINCT anime_name FROM {0}'''.format(
                 anime_table_name))
         all_anime = [r[0] for r in scur.fetchall()]
 
-        # Get the users to select ratings from for the top-k test
-        scur.execute('''SELECT DISTINCT user_id FROM {0}'''.format(
-                val_table_name))
-        all_users = [r[0] for r in scur.fetchall()]
+        # Create table to hold the top-k data set if needed
+        if not incremental:
+            dcur.execute('DROP TABLE IF EXISTS {0}'.format(
+                    topk_test_table_name))
+            dcur.execute('DROP TABLE IF EXISTS {0}'.format(
+                    topk_anime_table_name))
+        if compact:
+            dcur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                           user_id TEXT NOT NULL,
+                           anime_name TEXT NOT NULL,
+                           rand_anime_ids BLOB NOT NULL)'''.format(
+                               topk_test_table_name))
+            dcur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                           anime_id INTEGER PRIMARY KEY,
+                           anime_name TEXT NOT NULL)'''.format(
+                               topk_anime_table_name))
+
+            # Anime keep the IDs they were given by earlier builds, and new
+            # anime are given the next IDs
+            dcur.execute('''SELECT anime_name FROM {0}
+                            ORDER BY anime_id'''.format(topk_anime_table_name))
+            known_anime = [r[0] for r in dcur.fetchall()]
+            known_set = set(known_anime)
+            new_anime = [a for a in all_anime if a not in known_set]
+            insert_into_table(dcur, topk_anime_table_name,
+                              enumerate(new_anime, len(known_anime)))
+            all_anime = known_anime + new_anime
+        else:
+            dcur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                           user_id TEXT NOT NULL,
+                           anime_name TEXT NOT NULL,
+                           rand_anime_name TEXT NOT NULL)'''.format(
+                               topk_test_table_name))
+
+        # Get the top ratings of each user in a single scan of the validation
+        # ratings ordered by user, only including users with ratings added
+        # since the last build if building incrementally. The pool reads its
+        # tasks from another thread, so they are read into a list rather than
+        # streamed from the cursor.
+        watermark, max_rowid = get_build_range(
+                scur, dcur, val_table_name, 'topk', incremental)
+        scur.execute('''SELECT user_id, anime_name, score FROM {0}
+                        WHERE user_id IN (SELECT user_id FROM {0}
+                                          WHERE rowid > ? AND rowid <= ?)
+                        ORDER BY user_id'''.format(val_table_name),
+                     (watermark, max_rowid))
+        user_top_anime = [
+                (user, get_top_anime(list(rows), topk_percent, topk_min,
+                                     topk_max), seed)
+                for user, rows in groupby(scur, lambda r: r[0])]
+        if incremental:
+            delete_user_rows(dcur, (topk_test_table_name,),
+                             [u[0] for u in user_top_anime])
+
+        worker_args = (all_anime, rand_anime_amount, compact)
+        if processes == 1:
+            _init_topk_worker(*worker_args)
+            user_rows = imap(_select_topk_rows, user_top_anime)
+        else:
+            pool = Pool(processes, _init_topk_worker, worker_args)
+            user_rows = pool.imap(_select_topk_rows, user_top_anime,
+                                  chunksize=20)
 
+        writer = BulkWriter(dest_conn, rows_per_transaction)
         cntr = 0
-        for user in all_users:
-            scur.execute('''SELECT anime_name, score FROM {0}
-                            WHERE user_id=?'''.format(val_table_name),
-                            [user,])
-            user_scores = scur.fetchall()
-
-            # Determine how many top ratings to take from this user for the
-            # top-k test
-            topk_amount = max(topk_min,
-                    min(topk_max, int(round(len(user_scores) * topk_percent))))
-
-            # Select the random anime to use for each of the top ratings for
-            # this user
-            sorted_scores = sorted(
-                    user_scores, key=lambda r: r[1], reverse=True)
-            for score_pair in sorted_scores[:topk_amount]:
-                shuffle(all_anime)
-
-                # Make sure the top scoring anime for the user is not also in
-                # the randomly selected anime
-                scored_anime_index = all_anime.index(score_pair[0])
-                if scored_anime_index < rand_anime_amount:
-                    all_anime[scored_anime_index], \
-                            all_anime[rand_anime_amount] = \
-                            all_anime[rand_anime_amount], \
-                            all_anime[scored_anime_index]
-
-                for rand_anime in all_anime[:rand_anime_amount]:
-                    insert_into_table(dcur, topk_test_table_name,
-                            ((user, score_pair[0], rand_anime),))
-
-            dest_conn.commit()
+        for rows in user_rows:
+            if compact:
+                rows = ((user, anime, sqlite3.Binary(ids))
+                        for user, anime, ids in rows)
+            writer.add_rows(topk_test_table_name, rows)
+
             cntr += 1
             if cntr % 50 == 0:
                 print cntr
 
+        if processes != 1:
+            pool.close()
+            pool.join()
+
+        writer.flush()
+        create_indexes(dcur, topk_test_table_name, ('user_id', 'anime_name'))
+        set_watermark(dcur, val_table_name, 'topk', max_rowid)
+        writer.report('create_topk_test_db')
+
+
+def get_top_anime(user_scores, topk_percent, topk_min, topk_max):
+    """Returns the names of the top rated anime to use in the top-k test from
+    the given list of (user_id, anime_name, score) rows for a user.
+    """
+    # Determine how many top ratings to take from this user for the top-k
+    # test
+    topk_amount = max(topk_min,
+            min(topk_max, int(round(len(user_scores) * topk_percent))))
+    sorted_scores = sorted(user_scores, key=lambda r: r[2], reverse=True)
+    return [r[1] for r in sorted_scores[:topk_amount]]
+
+# Anime pool and settings for the current top-k worker process
+_topk_worker_state = {}
+
+def _init_topk_worker(all_anime, rand_anime_amount, compact):
+    """Stores the anime pool and settings for selecting random anime in the
+    current process.
+    """
+    _topk_worker_state['all_anime'] = all_anime
+    _topk_worker_state['anime_ids'] = dict(
+            (name, i) for i, name in enumerate(all_anime))
+    _topk_worker_state['rand_anime_amount'] = min(rand_anime_amount,
+                                                  len(all_anime) - 1)
+    _topk_worker_state['compact'] = compact
+
+def _sample_ids(rng, total, amount):
+    """Returns a numpy array of the given amount of distinct IDs sampled
+    uniformly from range(total) with the given RandomState. The time and
+    memory used grow with the amount rather than with the total.
+    """
+    if 2 * amount > total:
+        return rng.permutation(total)[:amount]
+
+    # Draw with replacement and keep the first occurrence of each ID,
+    # drawing more until there are enough distinct IDs
+    ids = np.empty(0, dtype=np.int64)
+    while len(ids) < amount:
+        draws = np.concatenate([ids, rng.randint(0, total, 2 * amount)])
+        first = np.sort(np.unique(draws, return_index=True)[1])
+        ids = draws[first]
+    return ids[:amount]
+
+def _select_topk_rows(user_top_anime):
+    """Selects the random anime for each top rated anime of a user given as a
+    (user_id, top anime names, seed) tuple. Returns a list of the rows to
+    insert into the top-k table for the user.
+    """
+    user, top_anime, seed = user_top_anime
+    all_anime = _topk_worker_state['all_anime']
+    anime_ids = _topk_worker_state['anime_ids']
+    rand_anime_amount = _topk_worker_state['rand_anime_amount']
+
+    top_anime = [a for a in top_anime if a in anime_ids]
+    if not top_anime or rand_anime_amount <= 0:
+        return []
+    top_ids = np.array([anime_ids[a] for a in top_anime])
+
+    # Sample without replacement from every ID except the top rated anime by
+    # sampling from one fewer IDs and shifting the IDs at or above it up
+    rng = np.random.RandomState(int(hash_fraction(user, seed) * 2 ** 32))
+    rand_ids = np.array([_sample_ids(rng, len(all_anime) - 1,
+                                     rand_anime_amount)
+                         for i in xrange(len(top_ids))])
+    rand_ids += rand_ids >= top_ids[:, np.newaxis]
+
+    if _topk_worker_state['compact']:
+        return [(user, anime, ids.astype('<i4').tostring())
+                for anime, ids in zip(top_anime, rand_ids)]
+    return [(user, anime, all_anime[i])
+            for anime, ids in zip(top_anime, rand_ids) for i in ids]
+
 
 def create_implicit_feedback_set(source_db_path, dest_db_path,
-                                 ratings_table_name):
+                                 ratings_table_name,
+                                 rows_per_transaction=DEFAULT_ROWS_PER_TRANSACTION,
+                                 incremental=False):
     """Creates a data set of the implicit feedback data from ratings with null
     scores in the source database of ratings.
 
@@ -115,33 +332,59 @@ def create_implicit_feedback_set(source_db_path, dest_db_path,
     ratings_table_name - A string of the name of the table in the source
                          database that contains the ratings data that should be
                          used to create the implicit feedback data set.
+    rows_per_transaction - The number of rows to insert into the destination
+                           database between each commit.
+    incremental - Boolean indicating whether to only add the users with
+                  ratings added to the source table since the last build,
+                  instead of rebuilding the data set. Existing rows of those
+                  users are replaced and all other rows are left untouched.
+                  False by default.
     """
     imp_table_name = ratings_table_name + 'Imp'
 
     source_conn = sqlite3.connect(source_db_path)
     dest_conn = sqlite3.connect(dest_db_path)
-    with source_conn, dest_conn:
+    with source_conn, dest_conn, fast_load_pragmas(dest_conn):
         scur = source_conn.cursor()
         dcur = dest_conn.cursor()
 
 
         # Create table to store the implicit feedback data set if needed
-        dcur.execute('DROP TABLE IF EXISTS {0}'.format(imp_table_name))
-        dcur.execute('''CREATE TABLE {0} (
+        if not incremental:
+            dcur.execute('DROP TABLE IF EXISTS {0}'.format(imp_table_name))
+        dcur.execute('''CREATE TABLE IF NOT EXISTS {0} (
                        user_id TEXT NOT NULL,
                        anime_name TEXT NOT NULL,
                        status TEXT NOT NULL)'''.format(imp_table_name))
 
+        watermark, max_rowid = get_build_range(
+                scur, dcur, ratings_table_name, 'imp', incremental)
+        if incremental:
+            scur.execute('''SELECT DISTINCT user_id FROM {0}
+                            WHERE rowid > ? AND rowid <= ?'''.format(
+                         ratings_table_name), (watermark, max_rowid))
+            delete_user_rows(dcur, (imp_table_name,),
+                             [r[0] for r in scur.fetchall()])
+
         # Insert the ratings with a null score into the implicit feedback data
-        # set
+        # set, streaming them from the source cursor
         scur.execute('''SELECT user_id, anime_name, status FROM {0}
-                        WHERE score IS NULL'''.format(ratings_table_name))
-        insert_into_table(dcur, imp_table_name, scur.fetchall())
-        source_conn.commit()
+                        WHERE score IS NULL
+                        AND rowid > ? AND rowid <= ?'''.format(
+                     ratings_table_name), (watermark, max_rowid))
+        writer = BulkWriter(dest_conn, rows_per_transaction)
+        writer.add_rows(imp_table_name, scur)
+        writer.flush()
+        create_indexes(dcur, imp_table_name, ('user_id',))
+        set_watermark(dcur, ratings_table_name, 'imp', max_rowid)
+        writer.report('create_implicit_feedback_set')
 
 
 def create_ml_sets(source_db_path, dest_db_path, ratings_table_name,
-                   train_percent, valid_percent, max_users=None):
+                   train_percent, valid_percent, max_users=None,
+                   rows_per_transaction=DEFAULT_ROWS_PER_TRANSACTION,
+                   split_seed=None, shard_index=0, total_shards=1,
+                   incremental=False):
     """Splits the source rating data into a training, validation, and test set
     using the given ratios.
 
@@ -150,12 +393,38 @@ def create_ml_sets(source_db_path, dest_db_path, ratings_table_name,
     validation sets respectively. The remaining data will then go into the test
     set. Therefore, train_percent + valid_percent must be less than 1.
 
+    The source ratings are read in a single scan ordered by user, and each
+    user's ratings are split in memory and streamed to the destination tables.
+    By default, each user's ratings are shuffled and split with exactly the
+    given ratios. If split_seed is given, each rating is instead assigned by a
+    hash of its user, anime, and the seed, so the same split is produced every
+    time and users can be split in separate shards (for example, in parallel
+    into separate databases).
+
     source_db_path - A string with the path to the source database.
     dest_db_paht - A string with the path to the destination database.
     ratings_table_name - The name of the table with all of the rating data in
                          the source database.
     max_users_to_use - If given, no more than this number of users will be used
-                       from the source table when creating the ML tables.
+                       from the source table when creating the ML tables. When
+                       building incrementally, the build watermark is not
+                       moved if users were left out, so the next build splits
+                       them.
+    rows_per_transaction - The number of rows to insert into the destination
+                           database between each commit.
+    split_seed - If given, ratings are assigned to the sets by a hash of their
+                 user, anime, and this seed instead of by shuffling.
+    shard_index - Index of the shard of users to split, between 0 and
+                  total_shards - 1. Users are assigned to shards by a hash of
+                  their user ID.
+    total_shards - Total number of shards the users are divided between. 1 by
+                   default, so every user is split.
+    incremental - Boolean indicating whether to only split the users with
+                  ratings added to the source table since the last build,
+                  instead of rebuilding the sets. Those users' existing rows
+                  are replaced by a split of their newly added ratings (a
+                  recrawl adds all of a user's ratings again) and all other
+                  rows are left untouched. False by default.
     """
     if not (train_percent + valid_percent < 1.0):
         raise BadRatiosException(
@@ -167,79 +436,278 @@ def create_ml_sets(source_db_path, dest_db_path, ratings_table_name,
 
     source_conn = sqlite3.connect(source_db_path)
     dest_conn = sqlite3.connect(dest_db_path)
-    with source_conn, dest_conn:
+    with source_conn, dest_conn, fast_load_pragmas(dest_conn):
         scur = source_conn.cursor()
         dcur = dest_conn.cursor()
 
         # Create train, valid, and test tables if needed
         init_ml_tables(dcur, train_table_name, valid_table_name,
-                       test_table_name)
-
-        scur.execute('SELECT DISTINCT user_id FROM {0}'.format(
-            ratings_table_name))
-        user_rows = scur.fetchall()
-        if max_users is None:
-            total_users = len(user_rows)
-        else:
-            total_users = min(max_users, len(user_rows))
-
+                       test_table_name, not incremental)
+        ml_table_names = (train_table_name, valid_table_name, test_table_name)
+
+        # Scan the ratings once in user order so each user's ratings can be
+        # grouped together as they are read. Ratings without a score are
+        # read too, so users whose recrawl has no scores still lose the rows
+        # of their earlier crawl when building incrementally.
+        watermark, max_rowid = get_build_range(
+                scur, dcur, ratings_table_name, 'ml_sets', incremental)
+        scur.execute('''SELECT user_id, anime_name, score FROM {0}
+                        WHERE rowid > ? AND rowid <= ?
+                        ORDER BY user_id'''.format(ratings_table_name),
+                     (watermark, max_rowid))
+
+        writer = BulkWriter(dest_conn, rows_per_transaction)
         cntr = 0
-        for user_row in user_rows[:total_users]:
-            scur.execute('''SELECT user_id, anime_name, score FROM {0}
-                            WHERE user_id=? and score IS NOT NULL'''.format(
-                        ratings_table_name), user_row)
-            user_ratings = scur.fetchall()
-            total_ratings = len(user_ratings)
-
-            # Randomly partition user ratings between train, valid, and test sets
-            shuffle(user_ratings)
-            train_split = int(ceil(total_ratings * train_percent))
-            valid_split = train_split + int(floor(total_ratings * valid_percent))
+        skipped_users = False
+        for user_id, user_rows in groupby(scur, lambda r: r[0]):
+            if max_users is not None and cntr >= max_users:
+                skipped_users = True
+                break
+            if (total_shards > 1 and
+                    int(hash_fraction(user_id) * total_shards) != shard_index):
+                continue
+
+            # Only the users being split again lose their existing rows
+            if incremental:
+                delete_user_rows(dcur, ml_table_names, [user_id])
+            user_rows = [r for r in user_rows if r[2] is not None]
+            if not user_rows:
+                continue
+
+            # Partition user ratings between train, valid, and test sets
+            train_ratings, valid_ratings, test_ratings = split_user_ratings(
+                    user_rows, train_percent, valid_percent, split_seed)
 
             # Insert ratings into train, valid, and test tables
-            train_ratings = user_ratings[:train_split]
-            insert_into_table(dcur, train_table_name, train_ratings)
-            valid_ratings = user_ratings[train_split:valid_split]
-            insert_into_table(dcur, valid_table_name, valid_ratings)
-            test_ratings = user_ratings[valid_split:]
-            insert_into_table(dcur, test_table_name, test_ratings)
-
-            dest_conn.commit()
+            writer.add_rows(train_table_name, train_ratings)
+            writer.add_rows(valid_table_name, valid_ratings)
+            writer.add_rows(test_table_name, test_ratings)
+
             cntr += 1
             if cntr % 50 == 0:
                 print cntr
 
-def init_ml_tables(cur, train_table_name, valid_table_name, test_table_name):
+        writer.flush()
+        for table_name in ml_table_names:
+            create_indexes(dcur, table_name, ('user_id',))
+
+        # Users left out by max_users have rows in the range that weren't
+        # split, so the range is built again next time instead of skipped
+        if not skipped_users:
+            set_watermark(dcur, ratings_table_name, 'ml_sets', max_rowid)
+        writer.report('create_ml_sets')
+
+def split_user_ratings(user_ratings, train_percent, valid_percent,
+                       split_seed=None):
+    """Partitions the given list of rating rows for a user between the
+    training, validation, and test sets. Returns a tuple of lists of the rows
+    for each set.
+
+    If split_seed is None, the rows are shuffled and split with exactly the
+    given ratios. Otherwise, each row is assigned by a hash of its user ID,
+    anime name, and the seed, which gives the same split every time.
+    """
+    if split_seed is None:
+        total_ratings = len(user_ratings)
+        shuffle(user_ratings)
+        train_split = int(ceil(total_ratings * train_percent))
+        valid_split = train_split + int(floor(total_ratings * valid_percent))
+        return (user_ratings[:train_split],
+                user_ratings[train_split:valid_split],
+                user_ratings[valid_split:])
+
+    train_ratings = []
+    valid_ratings = []
+    test_ratings = []
+    for row in user_ratings:
+        fraction = hash_fraction(row[0], row[1], split_seed)
+        if fraction < train_percent:
+            train_ratings.append(row)
+        elif fraction < train_percent + valid_percent:
+            valid_ratings.append(row)
+        else:
+            test_ratings.append(row)
+    return (train_ratings, valid_ratings, test_ratings)
+
+def hash_fraction(*values):
+    """Returns a float between 0 and 1 determined by a hash of the given
+    values. The same values always give the same float.
+    """
+    key = u'\t'.join(unicode(v) for v in values).encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:13], 16) / float(16 ** 13)
+
+def init_ml_tables(cur, train_table_name, valid_table_name, test_table_name,
+                   drop_existing=True):
     """Creates the tables if needed for ratings for the training, validation,
     and test sets for machine learning using the given cursor and table names.
+    Existing tables are emptied first unless drop_existing is False. They are
+    emptied rather than dropped so their rowids keep increasing, since the
+    top-k data set is built incrementally from the validation set. Their
+    indexes are dropped along with their rows so the load does not update
+    them, and are rebuilt by create_indexes after it.
     """
-    cur.execute('DROP TABLE IF EXISTS {0}'.format(train_table_name))
-    cur.execute('''CREATE TABLE {0} (
-                   user_id TEXT NOT NULL,
-                   anime_name TEXT NOT NULL,
-                   score INT)'''.format(train_table_name))
-    cur.execute('DROP TABLE IF EXISTS {0}'.format(valid_table_name))
-    cur.execute('''CREATE TABLE {0} (
-                    user_id TEXT NOT NULL,
-                    anime_name TEXT NOT NULL,
-                    score INT)'''.format(valid_table_name))
-    cur.execute('DROP TABLE IF EXISTS {0}'.format(test_table_name))
+    for table_name in (train_table_name, valid_table_name, test_table_name):
+        init_row_id_table(cur, table_name, (
+                'user_id TEXT NOT NULL, anime_name TEXT NOT NULL, score INT'))
+        if drop_existing:
+            drop_indexes(cur, table_name)
+            cur.execute('DELETE FROM {0}'.format(table_name))
+
+def init_row_id_table(cur, table_name, column_defs):
+    """Creates the given table if needed with the given column definitions and
+    a row_id column declared INTEGER PRIMARY KEY AUTOINCREMENT.
+
+    Without AUTOINCREMENT, SQLite gives new rows the rowids of the last rows
+    of a table after they are deleted, so a user whose rows were replaced
+    could get rowids at or below the watermark of an incremental build and be
+    skipped by it. An existing table without the column is rebuilt with it,
+    keeping its rowids and indexes.
+    """
+    cur.execute('''SELECT sql FROM sqlite_master
+                   WHERE type = 'table' AND name = ?''', (table_name,))
+    row = cur.fetchone()
+    if row is not None and 'AUTOINCREMENT' in row[0].upper():
+        return
+
+    legacy_table_name = table_name + 'Legacy'
+    if row is not None:
+        cur.execute('''SELECT sql FROM sqlite_master
+                       WHERE type = 'index' AND tbl_name = ?
+                       AND sql IS NOT NULL''', (table_name,))
+        index_sqls = [r[0] for r in cur.fetchall()]
+        columns = ', '.join(get_insert_columns(cur, table_name))
+        cur.execute('ALTER TABLE {0} RENAME TO {1}'.format(
+                    table_name, legacy_table_name))
+
     cur.execute('''CREATE TABLE {0} (
-                   user_id TEXT NOT NULL,
-                   anime_name TEXT NOT NULL,
-                   score INT)'''.format(test_table_name))
+                   {1} INTEGER PRIMARY KEY AUTOINCREMENT,
+                   {2})'''.format(table_name, ROW_ID_COLUMN, column_defs))
+
+    if row is not None:
+        cur.execute('''INSERT INTO {0} ({1}, {2})
+                       SELECT rowid, {2} FROM {3}'''.format(
+                           table_name, ROW_ID_COLUMN, columns,
+                           legacy_table_name))
+        cur.execute('DROP TABLE {0}'.format(legacy_table_name))
+        for index_sql in index_sqls:
+            cur.execute(index_sql)
+
+def drop_indexes(cur, table_name):
+    """Drops the indexes created on the given table using the given cursor,
+    leaving the automatic indexes of its constraints.
+    """
+    cur.execute('''SELECT name FROM sqlite_master
+                   WHERE type = 'index' AND tbl_name = ?
+                   AND sql IS NOT NULL''', (table_name,))
+    for (index_name,) in cur.fetchall():
+        cur.execute('DROP INDEX {0}'.format(index_name))
+
+def get_insert_columns(cur, table_name):
+    """Returns the list of the columns of the given table that rows are
+    inserted into, which is every column but the row_id column.
+    """
+    cur.execute('PRAGMA table_info({0})'.format(table_name))
+    return [r[1] for r in cur.fetchall() if r[1] != ROW_ID_COLUMN]
+
+def get_build_range(source_cur, dest_cur, source_table_name, builder_name,
+                    incremental):
+    """Returns a tuple of the range of rowids (exclusive start, inclusive end)
+    of the source table to build a data set from. The range starts after the
+    watermark recorded by the last build of the data set if building
+    incrementally, and from the start of the table otherwise. It ends at the
+    current last row of the table, so rows added during the build are left for
+    the next one.
+    """
+    source_cur.execute('SELECT MAX(rowid) FROM {0}'.format(source_table_name))
+    max_rowid = source_cur.fetchone()[0] or 0
+    if not incremental:
+        return (0, max_rowid)
+    return (get_watermark(dest_cur, source_table_name, builder_name),
+            max_rowid)
+
+def get_watermark(cur, source_table_name, builder_name):
+    """Returns the last rowid of the source table that the given data set
+    builder has built from, or 0 if it has not built from the table yet.
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                   source_table TEXT NOT NULL,
+                   builder TEXT NOT NULL,
+                   max_rowid INTEGER NOT NULL,
+                   PRIMARY KEY (source_table, builder))'''.format(
+                       WATERMARK_TABLE_NAME))
+    cur.execute('''SELECT max_rowid FROM {0}
+                   WHERE source_table=? AND builder=?'''.format(
+                       WATERMARK_TABLE_NAME),
+                (source_table_name, builder_name))
+    row = cur.fetchone()
+    return 0 if row is None else row[0]
+
+def set_watermark(cur, source_table_name, builder_name, max_rowid):
+    """Records the last rowid of the source table that the given data set
+    builder has built from.
+    """
+    get_watermark(cur, source_table_name, builder_name)  # Creates the table
+    cur.execute('INSERT OR REPLACE INTO {0} VALUES(?,?,?)'.format(
+                WATERMARK_TABLE_NAME),
+                (source_table_name, builder_name, max_rowid))
+
+def delete_user_rows(cur, table_names, user_ids):
+    """Deletes the rows of the given users from each of the given tables."""
+    for table_name in table_names:
+        cur.executemany('DELETE FROM {0} WHERE user_id=?'.format(table_name),
+                        ((u,) for u in user_ids))
 
 def insert_into_table(cur, table_name, rows):
-    """Inserts the given list of rows into the given table using the given
-    cursor.
+    """Inserts the given rows into the given table using the given cursor. The
+    rows can be any iterable of rows, including a generator, and are inserted
+    with a single executemany call.
     """
+    rows = iter(rows)
+    try:
+        first_row = next(rows)
+    except StopIteration:
+        return
+
     row_format_list = ['(?']
-    for i in xrange(1, len(rows[0])):
+    for i in xrange(1, len(first_row)):
         row_format_list.append(',?')
     row_format_list.append(')')
     row_format_str = ''.join(row_format_list)
 
-    for row in rows:
-        cur.execute('INSERT INTO {0} VALUES{1}'.format(
-                    table_name, row_format_str), row)
+    cur.executemany('INSERT INTO {0} ({1}) VALUES{2}'.format(
+                    table_name, ', '.join(get_insert_columns(cur, table_name)),
+                    row_format_str), chain((first_row,), rows))
+
+def create_indexes(cur, table_name, columns):
+    """Creates an index on the given tuple of columns of the given table using
+    the given cursor. Indexes should be created after a table is loaded since
+    it is much faster than updating them with every insert.
+    """
+    cur.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_index ON {0} ({2})'.format(
+                table_name, '_'.join(columns), ', '.join(columns)))
+
+@contextmanager
+def fast_load_pragmas(conn, cache_size=FAST_LOAD_CACHE_SIZE):
+    """Context manager that sets PRAGMAs on the given connection for quickly
+    loading large amounts of data while in the context, and restores their
+    previous values after. The journal is kept in memory and writes are not
+    synced to disk, so a crash while building a data set can leave the
+    database corrupt, but the data sets can always be rebuilt.
+    """
+    pragmas = ('journal_mode', 'synchronous', 'cache_size')
+    conn.commit()  # The journal mode can't be changed within a transaction
+    cur = conn.cursor()
+    saved_values = dict(
+            (p, cur.execute('PRAGMA {0}'.format(p)).fetchone()[0])
+            for p in pragmas)
+
+    cur.execute('PRAGMA journal_mode=MEMORY')
+    cur.execute('PRAGMA synchronous=OFF')
+    cur.execute('PRAGMA cache_size={0}'.format(cache_size))
+    try:
+        yield
+    finally:
+        conn.commit()
+        for p in pragmas:
+            cur.execute('PRAGMA {0}={1}'.format(p, saved_values[p]))
 
@@ -0,0 +1,203 @@
+# Objects for fetching the raw HTML of web pages over pooled HTTP connections.
+
+import httplib
+import Queue
+import socket
+import threading
+import urlparse
+import zlib
+
+# Seconds to wait for a response from the server before giving up on a request
+REQUEST_TIMEOUT = 30
+
+# Maximum number of redirects followed for one page
+MAX_REDIRECTS = 5
+
+# Status codes of redirects to the URL in the Location header
+REDIRECT_STATUS_CODES = frozenset([httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                                   httplib.SEE_OTHER,
+                                   httplib.TEMPORARY_REDIRECT, 308])
+
+# Headers sent with every request
+REQUEST_HEADERS = {
+    'Accept': 'text/html',
+    'Accept-Encoding': 'gzip',
+    'Connection': 'keep-alive',
+    'User-Agent': 'Mozilla/5.0 (compatible; anime-recommender-crawler)',
+}
+
+
+class FetchException(Exception):
+    """Indicates that the server answered a request with an error status."""
+
+    def __init__(self, message, status):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class HTTPConnectionPool:
+    """Object that keeps open HTTP or HTTPS connections to one host so that
+    they can be reused by later requests from any thread instead of
+    connecting again for every page.
+    """
+
+    def __init__(self, host, port=None, max_connections=4,
+                 timeout=REQUEST_TIMEOUT, scheme='http'):
+        """Constructor for a connection pool.
+
+        host - String of the host to connect to.
+        port - Port to connect to. If None, which is the default, 443 for
+               HTTPS and 80 for HTTP.
+        max_connections - Maximum number of connections kept open. Requests
+                          wait for a free connection when all of them are in
+                          use. 4 by default.
+        timeout - Seconds to wait for the server before a request fails.
+                  REQUEST_TIMEOUT by default.
+        scheme - String of the URL scheme, 'https' to connect with TLS or
+                 'http'. 'http' by default.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.connections = Queue.LifoQueue(max_connections)
+        for i in xrange(max_connections):
+            self.connections.put(None)
+
+    def request(self, path):
+        """Sends a GET request for the given path and returns a tuple of the
+        status code, the (decompressed) body, and the Location header (None
+        if there isn't one) of the response.
+
+        Raises an httplib.HTTPException or a socket.error if the request
+        fails.
+        """
+        conn = self.connections.get()
+        try:
+            # A kept alive connection may have been closed by the server, so
+            # a request on a reused connection gets one more try on a new one
+            for attempt in (0, 1):
+                reused = conn is not None
+                if conn is None:
+                    conn = self.connection_class(self.host, self.port,
+                                                 timeout=self.timeout)
+                try:
+                    conn.request('GET', path, headers=REQUEST_HEADERS)
+                    response = conn.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    conn = None
+                    if reused and attempt == 0:
+                        continue
+                    raise
+
+                if response.getheader('content-encoding') == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                if response.will_close:
+                    conn.close()
+                    conn = None
+                return (response.status, body,
+                        response.getheader('location'))
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        """Closes every idle connection in the pool. The pool cannot be used
+        after it is closed.
+        """
+        while True:
+            try:
+                conn = self.connections.get_nowait()
+            except Queue.Empty:
+                return
+            if conn is not None:
+                conn.close()
+
+
+class PageFetcher:
+    """Object that fetches web pages with plain HTTP requests over pooled
+    connections, and renders them in a browser session only when asked to.
+
+    Rendering a page runs its JavaScript in a headless browser, which takes
+    far more time and memory than downloading it, so callers should fetch
+    pages and only render the ones whose HTML is missing what they need.
+    """
+
+    def __init__(self, max_connections=4, session_factory=None):
+        """Constructor for a page fetcher.
+
+        max_connections - Maximum number of open connections per host. 4 by
+                          default.
+        session_factory - Function with no arguments that returns a new
+                          browser session, such as a dryscrape Session, with
+                          visit(url) and body() methods. Each thread that
+                          renders a page gets its own session. If None, pages
+                          cannot be rendered. None by default.
+        """
+        self.max_connections = max_connections
+        self.session_factory = session_factory
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.sessions = threading.local()
+
+    def fetch(self, url):
+        """Returns the body of the page at the given URL without rendering it,
+        following up to MAX_REDIRECTS redirects.
+
+        Raises a FetchException if the server does not answer with a 200
+        status, and an httplib.HTTPException or a socket.error if the request
+        fails.
+        """
+        for redirects in xrange(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            with self.pools_lock:
+                pool = self.pools.get((parts.scheme, parts.netloc))
+                if pool is None:
+                    pool = HTTPConnectionPool(parts.hostname, parts.port,
+                                              self.max_connections,
+                                              scheme=parts.scheme)
+                    self.pools[(parts.scheme, parts.netloc)] = pool
+
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            status, body, location = pool.request(path)
+            if status in REDIRECT_STATUS_CODES and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status != httplib.OK:
+                raise FetchException('{0} returned {1}'.format(url, status),
+                                     status)
+            return body
+        raise FetchException('{0} redirected more than {1} times'.format(
+                url, MAX_REDIRECTS), status)
+
+    def can_render(self):
+        """Returns whether pages can be rendered by this fetcher."""
+        return self.session_factory is not None
+
+    def render(self, url):
+        """Returns the body of the page at the given URL after rendering it in
+        this thread's browser session.
+        """
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            if self.session_factory is None:
+                raise ValueError('PageFetcher has no session_factory to '
+                                 'render pages with')
+            session = self.session_factory()
+            self.sessions.session = session
+        session.visit(url)
+        return session.body()
+
+    def close(self):
+        """Closes the idle connections to every host. The fetcher cannot be
+        used after it is closed.
+        """
+        with self.pools_lock:
+            for pool in self.pools.itervalues():
+                pool.close()
@@ -0,0 +1,221 @@
+# Objects for writing crawled anime scores to the ratings database in the
+# background.
+
+import Queue
+import sqlite3
+import threading
+import time
+
+from data_acquisition.create_ml_sets import (RATINGS_COLUMN_DEFS,
+                                             init_row_id_table)
+
+
+class ScoreWriter:
+    """Object that writes the scores of crawled users to the ratings database
+    from its own thread, so the crawl never waits on the disk.
+
+    Users are handed to the writer with put() and wait in a bounded queue.
+    The writer thread takes as many waiting users as fit in a batch and
+    writes all of their scores with one executemany() in one transaction, in
+    WAL mode so readers of the database aren't blocked. If the queue is full,
+    put() waits until the writer catches up, and the time spent waiting is
+    reported as backpressure.
+
+    Usage:
+        writer = ScoreWriter('ratings.db', 'MALRatings', frontier)
+        writer.put(mal_user, scores, total_scores)
+        ...
+        writer.close()  # Writes everything still waiting
+        writer.report()
+    """
+
+    def __init__(self, db_path, table_name, frontier=None, queue_size=1000,
+                 batch_rows=5000, max_batch_delay=1.0):
+        """Constructor for a score writer. Starts the writer thread.
+
+        db_path - String of the path to the ratings database.
+        table_name - String of the name of the table to store the scores in.
+        frontier - CrawlFrontier object to record each crawled user in, in
+                   the same transaction as their scores. None to not record
+                   the users anywhere. None by default.
+        queue_size - Maximum number of users waiting to be written. 1000 by
+                     default.
+        batch_rows - Number of scores that ends a batch. A batch takes whole
+                     users, so it can be slightly larger. 5000 by default.
+        max_batch_delay - Maximum number of seconds a user waits in a partial
+                          batch for more users to arrive. 1.0 by default.
+        """
+        self.db_path = db_path
+        self.table_name = table_name
+        self.frontier = frontier
+        self.batch_rows = batch_rows
+        self.max_batch_delay = max_batch_delay
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+
+        self.metrics_lock = threading.Lock()
+        self.total_batches = 0
+        self.total_users = 0
+        self.total_rows = 0
+        self.max_batch_rows = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+        # The incremental data set builds read the ratings table by rowid, and
+        # replacing the ratings of a recrawled user looks them up by user
+        conn = sqlite3.connect(db_path)
+        with conn:
+            cur = conn.cursor()
+            init_row_id_table(cur, table_name, RATINGS_COLUMN_DEFS)
+            cur.execute('''CREATE INDEX IF NOT EXISTS {0}UserIndex
+                           ON {0} (user_id)'''.format(table_name))
+        conn.close()
+
+        self.thread = threading.Thread(target=self._write_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, mal_user, scores, total_scores):
+        """Queues the scores of the given user to be written, waiting if the
+        queue is full.
+
+        mal_user - String of the username of the crawled user.
+        scores - List of MALUserScore objects to store for the user, empty if
+                 the user's scores should not be stored.
+        total_scores - Number of scores found for the user.
+
+        Raises the error that stopped the writer thread, if it stopped.
+        """
+        self._raise_error()
+        item = (mal_user, [s.get_db_row() for s in scores], total_scores)
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            start = time.time()
+            self.queue.put(item)
+            with self.metrics_lock:
+                self.blocked_seconds += time.time() - start
+
+    def flush(self):
+        """Waits until every queued user has been written.
+
+        Raises the error that stopped the writer thread, if it stopped.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes every queued user and stops the writer thread.
+
+        Raises the error that stopped the writer thread, if it stopped.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def get_metrics(self):
+        """Returns a dict of the writer's metrics so far: the totals of
+        'batches', 'users', and 'rows' written, the 'mean_batch_rows' and
+        'max_batch_rows', the 'mean_write_ms' and 'max_write_ms' it took to
+        write a batch, the 'blocked_seconds' put() spent waiting on a full
+        queue, and the current 'queue_depth'.
+        """
+        with self.metrics_lock:
+            batches = max(self.total_batches, 1)
+            return {
+                'batches': self.total_batches,
+                'users': self.total_users,
+                'rows': self.total_rows,
+                'mean_batch_rows': float(self.total_rows) / batches,
+                'max_batch_rows': self.max_batch_rows,
+                'mean_write_ms': 1000 * self.write_seconds / batches,
+                'max_write_ms': 1000 * self.max_write_seconds,
+                'blocked_seconds': self.blocked_seconds,
+                'queue_depth': self.queue.qsize(),
+            }
+
+    def report(self):
+        """Prints the writer's metrics."""
+        print (u'Score writer: {rows} scores from {users} users in {batches} '
+               u'batches (mean {mean_batch_rows:.0f} rows, max '
+               u'{max_batch_rows}), write latency mean {mean_write_ms:.1f} ms '
+               u'max {max_write_ms:.1f} ms, {blocked_seconds:.2f}s blocked, '
+               u'{queue_depth} queued').format(**self.get_metrics())
+
+    def _write_batches(self):
+        """Writes batches of queued users until close() is called."""
+        conn = sqlite3.connect(self.db_path)
+        stopping = False
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            while not stopping:
+                batch, stopping = self._get_batch()
+                try:
+                    if batch:
+                        self._write_batch(conn, batch)
+                finally:
+                    for i in xrange(len(batch) + stopping):
+                        self.queue.task_done()
+        except Exception as e:
+            self.error = e
+            # Keep taking users until close() so that put(), flush(), and
+            # close() don't wait forever
+            if not stopping:
+                for item in iter(self.queue.get, None):
+                    self.queue.task_done()
+                self.queue.task_done()
+        finally:
+            conn.close()
+
+    def _get_batch(self):
+        """Returns a tuple of the next batch of queued users and whether
+        close() was called. Waits for the first user of the batch, then for
+        up to max_batch_delay seconds for more users until the batch is full.
+        """
+        item = self.queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        total_rows = len(item[1])
+        deadline = time.time() + self.max_batch_delay
+        while total_rows < self.batch_rows:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            total_rows += len(item[1])
+        return batch, False
+
+    def _write_batch(self, conn, batch):
+        """Writes the given batch of users in one transaction."""
+        start = time.time()
+        rows = [row for mal_user, user_rows, total_scores in batch
+                for row in user_rows]
+        with conn:
+            cur = conn.cursor()
+            if self.frontier is not None:
+                for mal_user, user_rows, total_scores in batch:
+                    self.frontier.record_crawl(cur, mal_user, total_scores,
+                                               len(user_rows) > 0)
+            cur.executemany(u'''INSERT INTO {0} (user_id, anime_name,
+                               status, score) VALUES(?,?,?,?)'''.format(
+                                   self.table_name), rows)
+        seconds = time.time() - start
+
+        with self.metrics_lock:
+            self.total_batches += 1
+            self.total_users += len(batch)
+            self.total_rows += len(rows)
+            self.max_batch_rows = max(self.max_batch_rows, len(rows))
+            self.write_seconds += seconds
+            self.max_write_seconds = max(self.max_write_seconds, seconds)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,166 @@
+# Objects for predicting scores for users and anime that a model was not
+# trained on.
+
+import numpy as np
+from collections import defaultdict
+
+from models.factor_snapshot import FactorSnapshot
+
+# Tiers of TieredPredictor, from the most to the least personalized
+LATENT_TIER = 'latent'
+BIAS_TIER = 'bias'
+ITEM_AVERAGE_TIER = 'item_average'
+GLOBAL_MEAN_TIER = 'global_mean'
+TIERS = (LATENT_TIER, BIAS_TIER, ITEM_AVERAGE_TIER, GLOBAL_MEAN_TIER)
+
+
+class TieredPredictor:
+    """Object that predicts scores with a trained model and falls back to
+    simpler predictions for users and anime the model was not trained on,
+    instead of raising a ModelException like the models' predict().
+
+    Each prediction uses the first of these tiers that has the user and item:
+        latent - The model's own prediction, for a user and item that are
+                 both in a LatentFactorModel.
+        bias - The rating average of a LatentFactorModel with biases plus
+               the bias of whichever of the user and item is in the model,
+               for a new user rating a known item or a known user rating a
+               new item.
+        item_average - The item's average score in the training ratings,
+                       shrunk toward the global mean for items with few
+                       scores.
+        global_mean - The average of all of the training ratings.
+    All of the tiers are computed into arrays when the predictor is created,
+    so a fallback costs no more than a prediction from the model. The number
+    of predictions made from each tier is counted.
+    """
+
+    def __init__(self, model, train_ratings=None, item_shrinkage=25):
+        """Constructor for a tiered predictor.
+
+        model - Trained LatentFactorModel or SimpleAverageModel object. Only
+                the item_average and global_mean tiers are used for a
+                SimpleAverageModel.
+        train_ratings - List of Rating objects the item averages and global
+                        mean are computed from. If None, the training ratings
+                        of the model are used. None by default.
+        item_shrinkage - Number of scores of the global mean that are averaged
+                         in with the scores of each item, so the average of an
+                         item with few scores stays close to the global mean.
+                         25 by default.
+        """
+        if train_ratings is None:
+            train_ratings = model.train_ratings
+        self.snapshot = None
+        if hasattr(model, 'user_vectors'):
+            self.snapshot = FactorSnapshot.from_model(model)
+            self.use_biases = model.use_biases
+
+        item_totals = defaultdict(int)
+        item_counts = defaultdict(int)
+        for rating in train_ratings:
+            item_totals[rating.item] += rating.score
+            item_counts[rating.item] += 1
+        self.global_mean = (float(sum(item_totals.itervalues())) /
+                            max(sum(item_counts.itervalues()), 1))
+
+        self.item_average_index = dict(
+                (item, i) for i, item in enumerate(item_totals))
+        totals = np.array(item_totals.values(), dtype=np.float64)
+        counts = np.array(item_counts.values(), dtype=np.float64)
+        self.item_averages = ((totals + item_shrinkage * self.global_mean) /
+                              (counts + item_shrinkage))
+
+        self.tier_counts = dict((tier, 0) for tier in TIERS)
+
+    def predict(self, test_user, test_item):
+        """Predicts the score the given user would give the given item with the
+        most personalized tier that has them.
+
+        Returns the predicted score.
+        """
+        tier, guess = self._predict(test_user, test_item)
+        self.tier_counts[tier] += 1
+        return guess
+
+    def get_tier(self, test_user, test_item):
+        """Returns the name of the tier that would predict the score of the
+        given user for the given item.
+        """
+        return self._predict(test_user, test_item)[0]
+
+    def test(self, test_ratings):
+        """Tests the tiered predictor against the given list of test ratings.
+
+        Prints out a summary of the root mean square error on the test ratings,
+        the distribution of the differences between the predicted ratings and
+        the test ratings, and the number of test ratings and RMSE of each tier.
+
+        Returns the root mean square error on the test ratings.
+        """
+        diff_totals = defaultdict(int)
+        tier_errors = defaultdict(float)
+        tier_totals = defaultdict(int)
+
+        for rating in test_ratings:
+            tier, guess = self._predict(rating.user, rating.item)
+            self.tier_counts[tier] += 1
+            tier_errors[tier] += (rating.score - guess) ** 2
+            tier_totals[tier] += 1
+            diff = abs(rating.score - int(round(guess)))
+            diff_totals[diff] += 1
+
+        rmse = np.sqrt(sum(tier_errors.values()) / len(test_ratings))
+        print 'RMSE: {0}'.format(rmse)
+        for k in sorted(diff_totals.keys()):
+            print '{0}: {1} ({2})'.format(
+                    k, diff_totals[k],
+                    100 * (float(diff_totals[k]) / len(test_ratings)))
+        for tier in TIERS:
+            if tier_totals[tier]:
+                print '{0}: {1} ratings, RMSE {2}'.format(
+                        tier, tier_totals[tier],
+                        np.sqrt(tier_errors[tier] / tier_totals[tier]))
+        return rmse
+
+    def get_tier_counts(self):
+        """Returns a dict of the number of predictions made from each tier."""
+        return dict(self.tier_counts)
+
+    def report(self):
+        """Prints the number and share of predictions made from each tier."""
+        total = max(sum(self.tier_counts.itervalues()), 1)
+        print 'Predictions by tier: ' + ', '.join(
+                '{0} {1} ({2:.1f}%)'.format(
+                    tier, self.tier_counts[tier],
+                    100.0 * self.tier_counts[tier] / total)
+                for tier in TIERS)
+
+    def _predict(self, test_user, test_item):
+        """Returns a tuple of the tier used to predict the score of the given
+        user for the given item and the predicted score.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            user_row = snapshot.user_index.get(test_user)
+            item_row = snapshot.item_index.get(test_item)
+            if item_row is not None and user_row is not None:
+                return LATENT_TIER, float(
+                        snapshot.rating_average +
+                        snapshot.user_biases[user_row] +
+                        snapshot.item_biases[item_row] +
+                        np.dot(snapshot.user_factors[user_row],
+                               snapshot.item_factors[item_row]))
+            if self.use_biases and (item_row is not None or
+                                    user_row is not None):
+                guess = snapshot.rating_average
+                if item_row is not None:
+                    guess += snapshot.item_biases[item_row]
+                if user_row is not None:
+                    guess += snapshot.user_biases[user_row]
+                return BIAS_TIER, float(guess)
+
+        item_row = self.item_average_index.get(test_item)
+        if item_row is not None:
+            return ITEM_AVERAGE_TIER, float(self.item_averages[item_row])
+        return GLOBAL_MEAN_TIER, self.global_mean
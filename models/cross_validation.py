@@ -0,0 +1,195 @@
+# Functions for running k-fold cross-validation of the models in parallel.
+
+import multiprocessing
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+
+from models.model_util import Rating
+
+# Regularization of the item and user biases used to warm start the latent
+# factors models, like the baselines of ItemNeighborModel
+ITEM_BIAS_SHRINKAGE = 25
+USER_BIAS_SHRINKAGE = 10
+
+# State of each cross-validation worker process, set by _init_worker
+_worker_state = {}
+
+
+def cross_validate(ratings, Model, configs, total_folds=5, seed=None,
+                   processes=None, warm_start=True, log_file=None):
+    """Runs k-fold cross-validation of the given model class for each of the
+    given configurations, training the folds and configurations in parallel.
+
+    The users and items of the ratings are indexed and every rating is
+    assigned to a fold once. The index arrays are kept in shared memory, so
+    the worker processes read them without copying them. Each fold is trained
+    on the ratings of the other folds and tested on its own ratings that have
+    a user and item in its training ratings.
+
+    ratings - List of Rating objects to cross-validate on.
+    Model - Class of the model to cross-validate. It is constructed as
+            Model(train_ratings, *config) and must have the train() and
+            test(test_ratings) methods of the models in this directory.
+    configs - List of tuples of the parameters after train_ratings to
+              construct the model with, like the valid_params of
+              run_validation, e.g. (total_factors, norm_factor,
+              learning_rate, max_iterations, use_biases) for a
+              LatentFactorModel.
+    total_folds - Number of folds. 5 by default.
+    seed - Seed for assigning the folds and for the warm start factors. If
+           None, they are different every time. None by default.
+    processes - Number of worker processes. The number of CPUs if None,
+                which is the default.
+    warm_start - Boolean indicating whether latent factors models should
+                 start from a shared initialization instead of their own
+                 random one. Every fold starts from the same random factors,
+                 drawn from the same seed, and from user and item biases
+                 computed from the fold's training ratings, so fewer
+                 iterations are spent learning the biases. True by default.
+    log_file - String of the path to a file to append the results to. If
+               None, the results are only printed. None by default.
+
+    Returns a dict mapping each configuration to a tuple of the mean and the
+    standard deviation of its RMSE over the folds and the list of the RMSE
+    of each fold. The RMSE of a fold is -1 if training failed.
+    """
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
+    # Build the index and the fold assignment once for every configuration
+    users = sorted(set(r.user for r in ratings))
+    items = sorted(set(r.item for r in ratings))
+    user_index = dict((user, u) for u, user in enumerate(users))
+    item_index = dict((item, i) for i, item in enumerate(items))
+    folds = np.random.RandomState(seed).permutation(len(ratings)) % total_folds
+
+    shared = {}
+    for name, typecode, values in (
+            ('users', 'i', [user_index[r.user] for r in ratings]),
+            ('items', 'i', [item_index[r.item] for r in ratings]),
+            ('scores', 'd', [r.score for r in ratings]),
+            ('folds', 'i', folds)):
+        shared[name] = RawArray(typecode, len(ratings))
+        _as_array(shared[name])[:] = values
+
+    tasks = [(config, fold) for config in configs
+             for fold in xrange(total_folds)]
+    pool = multiprocessing.Pool(
+            processes, _init_worker,
+            (shared, users, items, Model, seed, warm_start))
+    try:
+        fold_rmses = pool.map(_run_fold, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = {}
+    for config in configs:
+        rmses = [rmse for (c, fold), rmse in zip(tasks, fold_rmses)
+                 if c == config]
+        valid = [rmse for rmse in rmses if rmse >= 0]
+        if valid:
+            results[config] = (np.mean(valid), np.std(valid), rmses)
+        else:
+            results[config] = (-1, 0.0, rmses)
+
+    lines = ['{0}: mean RMSE {1} (std {2}) folds {3}'.format(
+                 config, mean, std, rmses)
+             for config, (mean, std, rmses) in
+             sorted(results.items(), key=lambda i: i[1][0])]
+    for line in lines:
+        print line
+    if log_file is not None:
+        f = open(log_file, 'a')
+        f.write('\n'.join(lines) + '\n\n')
+        f.close()
+    return results
+
+
+def _as_array(raw_array):
+    """Returns a numpy array that shares memory with the given RawArray."""
+    dtype = np.int32 if raw_array._type_._type_ == 'i' else np.float64
+    return np.frombuffer(raw_array, dtype=dtype)
+
+
+def _init_worker(shared, users, items, Model, seed, warm_start):
+    """Stores the shared rating arrays and the index for a worker process."""
+    _worker_state.update(dict((name, _as_array(array))
+                              for name, array in shared.iteritems()))
+    _worker_state.update(user_names=users, item_names=items, Model=Model,
+                         seed=seed, warm_start=warm_start)
+
+
+def _run_fold(task):
+    """Trains the model with the given configuration on every fold except the
+    given one and returns its RMSE on the given fold, or -1 if the training
+    failed.
+    """
+    config, fold = task
+    state = _worker_state
+    in_fold = state['folds'] == fold
+    train = np.flatnonzero(~in_fold)
+    test = np.flatnonzero(in_fold)
+
+    # Only test on ratings whose user and item the model was trained on
+    user_counts = np.bincount(state['users'][train],
+                              minlength=len(state['user_names']))
+    item_counts = np.bincount(state['items'][train],
+                              minlength=len(state['item_names']))
+    test = test[(user_counts[state['users'][test]] > 0) &
+                (item_counts[state['items'][test]] > 0)]
+
+    model = state['Model'](_get_ratings(train), *config)
+    if state['warm_start'] and hasattr(model, 'user_vectors'):
+        _warm_start(model, train)
+    if not model.train():
+        return -1
+    print 'Fold {0} of {1}:'.format(fold, config)
+    return model.test(_get_ratings(test))
+
+
+def _get_ratings(positions):
+    """Returns a list of Rating objects for the ratings at the given positions
+    of the shared arrays.
+    """
+    state = _worker_state
+    users = state['users'][positions].tolist()
+    items = state['items'][positions].tolist()
+    scores = state['scores'][positions].tolist()
+    return [Rating(state['user_names'][u], state['item_names'][i], s)
+            for u, i, s in zip(users, items, scores)]
+
+
+def _warm_start(model, train):
+    """Sets the starting parameters of the given latent factors model to the
+    shared random factors and to biases computed from the training ratings at
+    the given positions.
+    """
+    state = _worker_state
+    user_names = state['user_names']
+    item_names = state['item_names']
+    rng = np.random.RandomState(state['seed'])
+    user_factors = rng.uniform(-1, 1, (len(user_names), model.total_factors))
+    item_factors = rng.uniform(-1, 1, (len(item_names), model.total_factors))
+
+    users = state['users'][train]
+    items = state['items'][train]
+    for u in np.unique(users):
+        model.user_vectors[user_names[u]] = user_factors[u]
+    for i in np.unique(items):
+        model.item_vectors[item_names[i]] = item_factors[i]
+
+    if not model.use_biases:
+        return
+    deviations = state['scores'][train] - model.rating_average
+    item_biases = (np.bincount(items, deviations, len(item_names)) /
+                   (np.bincount(items, minlength=len(item_names)) +
+                    ITEM_BIAS_SHRINKAGE))
+    user_biases = (np.bincount(users, deviations - item_biases[items],
+                               len(user_names)) /
+                   (np.bincount(users, minlength=len(user_names)) +
+                    USER_BIAS_SHRINKAGE))
+    for u in np.unique(users):
+        model.user_biases[user_names[u]] = float(user_biases[u])
+    for i in np.unique(items):
+        model.item_biases[item_names[i]] = float(item_biases[i])
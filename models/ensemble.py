@@ -0,0 +1,193 @@
+# Objects for working with a blended ensemble of models.
+
+import numpy as np
+import time
+from collections import defaultdict
+
+class ModelException(Exception):
+    """Indicates that there was an error within the model"""
+    pass
+
+
+class BlendedEnsembleModel:
+    """Object that encapsulates the parameters for an ensemble model that
+    blends the predictions of other models, such as a SimpleAverageModel, a
+    LatentFactorModel with biases, and an ItemNeighborModel.
+
+    The prediction is a weighted sum of the component models' predictions plus
+    an intercept, with the weights fit by least squares to the validation
+    ratings. Every component scores all of the pairs of a request at once
+    with its predict_batch() method, and the time spent in each component is
+    recorded so the cost of each member can be compared with what it adds.
+    """
+
+    def __init__(self, train_ratings, valid_ratings, models,
+                 train_models=True):
+        """Constructor for a blended ensemble model.
+
+        train_ratings - List of Rating objects the component models are
+                        trained on. Only used to describe the model, since
+                        the components are constructed with their own
+                        training ratings.
+        valid_ratings - List of Rating objects to fit the blend weights to,
+                        such as the ratings in MALRatingsValid. Ratings of
+                        users or items that are not in every component model
+                        are skipped.
+        models - List of model objects to blend. Each must have the train()
+                 and predict_batch(users, items) methods of the models in
+                 this directory.
+        train_models - Boolean indicating whether train() should train the
+                       component models before fitting the weights, or
+                       whether they were already trained. True by default.
+        """
+        self.train_ratings = train_ratings
+        self.valid_ratings = valid_ratings
+        self.models = models
+        self.train_models = train_models
+
+        self.model_names = ['{0}:{1}'.format(n, m.__class__.__name__)
+                            for n, m in enumerate(models)]
+        self.weights = None
+        self.model_seconds = [0.0] * len(models)
+        self.total_pairs = 0
+
+    def train(self):
+        """Trains the component models if train_models is True and fits the
+        blend weights to the validation ratings by least squares.
+
+        Returns True if the training completed successfully, and returns False
+        if a component model could not be trained.
+        """
+        if self.train_models:
+            for name, model in zip(self.model_names, self.models):
+                start = time.time()
+                if not model.train():
+                    print 'Training {0} failed'.format(name)
+                    return False
+                print 'Trained {0} in {1:.1f}s'.format(name,
+                                                        time.time() - start)
+
+        # Only the pairs that every component can score are fit to, like the
+        # validation RMSE of a LatentFactorModel skips unknown users and items
+        valid_ratings = self._get_covered_ratings(self.valid_ratings)
+        if len(valid_ratings) < len(self.valid_ratings):
+            print 'Skipped {0} of {1} validation ratings not in every ' \
+                  'component model'.format(
+                      len(self.valid_ratings) - len(valid_ratings),
+                      len(self.valid_ratings))
+        if not valid_ratings:
+            raise ModelException('No validation ratings are in every '
+                                 'component model')
+
+        predictions = self._predict_components(
+                [r.user for r in valid_ratings],
+                [r.item for r in valid_ratings])
+        scores = np.array([r.score for r in valid_ratings], dtype=np.float64)
+        self.weights = np.linalg.lstsq(predictions, scores, rcond=-1)[0]
+        print 'Blend weights: ' + ', '.join(
+                '{0} {1:.4f}'.format(name, weight) for name, weight in
+                zip(self.model_names + ['intercept'], self.weights))
+        return True
+
+    def test(self, test_ratings):
+        """Tests the ensemble model against the given list of test ratings.
+        Note that this function should only be called after the model has been
+        trained.
+
+        Prints out a summary of the root mean square error of the model on the
+        test ratings, the distribution of the differences between the
+        predicted ratings and the test ratings, and the time spent in each
+        component model.
+
+        Returns the root mean square error of the model on the test ratings.
+        """
+        guesses = self.predict_batch([r.user for r in test_ratings],
+                                     [r.item for r in test_ratings])
+        scores = np.array([r.score for r in test_ratings], dtype=np.float64)
+        rmse = np.sqrt(np.mean((scores - guesses) ** 2))
+        print 'RMSE: {0}'.format(rmse)
+
+        diff_totals = defaultdict(int)
+        for diff in np.abs(scores - np.floor(guesses + 0.5)):
+            diff_totals[diff] += 1
+        for k in sorted(diff_totals.keys()):
+            print '{0}: {1} ({2})'.format(
+                    k, diff_totals[k],
+                    100 * (float(diff_totals[k]) / len(test_ratings)))
+        self.report()
+        return rmse
+
+    def predict(self, test_user, test_item):
+        """Predicts the score the given user would give the given item using
+        the model. Note that this function should only be called after the
+        model has been trained.
+
+        Returns the predicted score.
+        """
+        return float(self.predict_batch([test_user], [test_item])[0])
+
+    def predict_batch(self, test_users, test_items):
+        """Predicts the scores the given users would give the given items for
+        each pair of a user and an item in the two lists, scoring every pair
+        with each component model in one call.
+
+        Returns a numpy array of the predicted scores.
+        """
+        if self.weights is None:
+            raise ModelException('Model has not been trained')
+        return np.dot(self._predict_components(test_users, test_items),
+                      self.weights)
+
+    def report(self):
+        """Prints the time spent in each component model per 1000 predicted
+        pairs and its share of the total time.
+        """
+        total_seconds = max(sum(self.model_seconds), 1e-9)
+        pairs = max(self.total_pairs, 1)
+        print 'Component time over {0} pairs: '.format(self.total_pairs) + \
+            ', '.join('{0} {1:.2f} ms/1000 pairs ({2:.1f}%)'.format(
+                          name, 1e6 * seconds / pairs,
+                          100 * seconds / total_seconds)
+                      for name, seconds in zip(self.model_names,
+                                               self.model_seconds))
+
+    def _get_covered_ratings(self, ratings):
+        """Returns the list of the given ratings whose user and item every
+        component model can score. Each component scores all of the ratings
+        at once, and only scores them one at a time to find the ones it
+        can't if that fails.
+        """
+        for model in self.models:
+            try:
+                model.predict_batch([r.user for r in ratings],
+                                    [r.item for r in ratings])
+                continue
+            except Exception as e:
+                if e.__class__.__name__ != 'ModelException':
+                    raise
+
+            covered = []
+            for rating in ratings:
+                try:
+                    model.predict_batch([rating.user], [rating.item])
+                except Exception as e:
+                    if e.__class__.__name__ != 'ModelException':
+                        raise
+                    continue
+                covered.append(rating)
+            ratings = covered
+        return ratings
+
+    def _predict_components(self, test_users, test_items):
+        """Returns a numpy array with a column of the predictions of each
+        component model for the given pairs and a column of ones for the
+        intercept, timing each component.
+        """
+        columns = []
+        for n, model in enumerate(self.models):
+            start = time.time()
+            columns.append(model.predict_batch(test_users, test_items))
+            self.model_seconds[n] += time.time() - start
+        columns.append(np.ones(len(test_users)))
+        self.total_pairs += len(test_users)
+        return np.column_stack(columns)
@@ -0,0 +1,240 @@
+# Objects for scoring with the parameters of a trained latent factors model
+# stored in numpy arrays.
+
+import numpy as np
+from collections import defaultdict
+
+class ModelException(Exception):
+    """Indicates that there was an error within the model"""
+    pass
+
+
+class FactorSnapshot:
+    """Object that holds the parameters of a trained LatentFactorModel in
+    numpy arrays, so many predictions can be scored at once with matrix
+    products instead of one predict() call at a time.
+
+    The users and items are numbered by their rows in the arrays. Implicit
+    feedback is folded into the user factors when the snapshot is made, so
+    the snapshot scores the same as the model's predict(). The anime each user
+    rated in the model's training ratings are kept as sparse rows, so they can
+    be left out of recommendations.
+    """
+
+    def __init__(self, user_names, item_names, user_factors, item_factors,
+                 user_biases, item_biases, rating_average, seen_indptr=None,
+                 seen_items=None):
+        """Constructor for a factor snapshot.
+
+        user_names - List of the users of the rows of the user arrays.
+        item_names - List of the items of the rows of the item arrays.
+        user_factors - Numpy array of the factors of each user, including any
+                       implicit feedback.
+        item_factors - Numpy array of the factors of each item.
+        user_biases - Numpy array of the bias of each user. Zeros if the model
+                      does not use biases.
+        item_biases - Numpy array of the bias of each item. Zeros if the model
+                      does not use biases.
+        rating_average - Global rating average of the model.
+        seen_indptr - Numpy array of where the seen items of each user start
+                      in seen_items, like the indptr of a CSR matrix. None if
+                      the seen items are not known. None by default.
+        seen_items - Numpy array of the item rows seen by each user in order.
+                     None if the seen items are not known. None by default.
+        """
+        self.user_names = user_names
+        self.item_names = item_names
+        self.user_index = dict((user, u) for u, user in enumerate(user_names))
+        self.item_index = dict((item, i) for i, item in enumerate(item_names))
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.user_biases = user_biases
+        self.item_biases = item_biases
+        self.rating_average = rating_average
+        self.seen_indptr = seen_indptr
+        self.seen_items = seen_items
+
+    @classmethod
+    def from_model(cls, model):
+        """Returns a snapshot of the given trained LatentFactorModel. Only
+        users and items with all of their parameters in the model are kept.
+        """
+        user_names = sorted(u for u in model.user_vectors
+                            if not model.use_biases or u in model.user_biases)
+        item_names = sorted(i for i in model.item_vectors
+                            if not model.use_biases or i in model.item_biases)
+
+        user_factors = np.array(
+                [model._get_imp_user_vector(u, model.user_vectors[u])
+                 for u in user_names], dtype=np.float64).reshape(
+                     len(user_names), model.total_factors)
+        item_factors = np.array(
+                [model.item_vectors[i] for i in item_names],
+                dtype=np.float64).reshape(len(item_names), model.total_factors)
+        if model.use_biases:
+            user_biases = np.array([model.user_biases[u] for u in user_names],
+                                   dtype=np.float64)
+            item_biases = np.array([model.item_biases[i] for i in item_names],
+                                   dtype=np.float64)
+        else:
+            user_biases = np.zeros(len(user_names))
+            item_biases = np.zeros(len(item_names))
+
+        snapshot = cls(user_names, item_names, user_factors, item_factors,
+                       user_biases, item_biases, model.rating_average)
+        if isinstance(model.train_ratings, list):
+            snapshot.set_seen_items(model.train_ratings)
+        return snapshot
+
+    @classmethod
+    def load(cls, file_path):
+        """Loads a snapshot saved with save() from the given file. Only numpy
+        is needed, so this is much faster than loading the pickled model.
+        """
+        arrays = np.load(file_path)
+        seen_indptr = seen_items = None
+        if 'seen_indptr' in arrays.files:
+            seen_indptr = arrays['seen_indptr']
+            seen_items = arrays['seen_items']
+        return cls(arrays['user_names'].tolist(),
+                   arrays['item_names'].tolist(), arrays['user_factors'],
+                   arrays['item_factors'], arrays['user_biases'],
+                   arrays['item_biases'], float(arrays['rating_average']),
+                   seen_indptr, seen_items)
+
+    def save(self, file_path):
+        """Saves the snapshot's arrays to the given .npz file."""
+        arrays = {
+            'user_names': np.array(self.user_names),
+            'item_names': np.array(self.item_names),
+            'user_factors': self.user_factors,
+            'item_factors': self.item_factors,
+            'user_biases': self.user_biases,
+            'item_biases': self.item_biases,
+            'rating_average': np.array(self.rating_average),
+        }
+        if self.seen_indptr is not None:
+            arrays['seen_indptr'] = self.seen_indptr
+            arrays['seen_items'] = self.seen_items
+        np.savez(file_path, **arrays)
+
+    def set_seen_items(self, ratings):
+        """Sets the items seen by each user to the items of the given
+        ratings. Ratings of users or items not in the snapshot are ignored.
+        """
+        rows = [(self.user_index[r.user], self.item_index[r.item])
+                for r in ratings
+                if r.user in self.user_index and r.item in self.item_index]
+        rows = np.array(rows, dtype=np.int32).reshape(len(rows), 2)
+        order = np.lexsort((rows[:, 1], rows[:, 0]))
+        self.seen_items = rows[order, 1]
+        self.seen_indptr = np.zeros(len(self.user_names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[:, 0], minlength=len(self.user_names)),
+                  out=self.seen_indptr[1:])
+
+    def get_seen_items(self, user_row):
+        """Returns a numpy array of the item rows seen by the user of the given
+        row, which is empty if the seen items are not known.
+        """
+        if self.seen_indptr is None:
+            return np.array([], dtype=np.int32)
+        return self.seen_items[self.seen_indptr[user_row]:
+                               self.seen_indptr[user_row + 1]]
+
+    def predict(self, test_user, test_item):
+        """Predicts the score the given user would give the given item, like
+        the predict() of the model the snapshot was made from.
+
+        Returns the predicted score.
+        """
+        user_row = self.user_index.get(test_user)
+        item_row = self.item_index.get(test_item)
+        if user_row is None:
+            raise ModelException('User ({0}) not in model'.format(test_user))
+        if item_row is None:
+            raise ModelException('Item ({0}) not in model'.format(test_item))
+        return float(self.predict_rows(np.array([user_row]),
+                                       np.array([item_row]))[0])
+
+    def test(self, test_ratings):
+        """Tests the snapshot against the given list of test ratings, scoring
+        all of them at once.
+
+        Prints out a summary of the root mean square error of the snapshot on
+        the test ratings as well as the distribution of the differences
+        between the predicted ratings and the test ratings.
+
+        Returns the root mean square error of the snapshot on the test
+        ratings.
+        """
+        for rating in test_ratings:
+            if rating.user not in self.user_index:
+                raise ModelException(
+                        'User ({0}) not in model'.format(rating.user))
+            if rating.item not in self.item_index:
+                raise ModelException(
+                        'Item ({0}) not in model'.format(rating.item))
+
+        guesses = self.predict_rows(
+                np.array([self.user_index[r.user] for r in test_ratings]),
+                np.array([self.item_index[r.item] for r in test_ratings]))
+        scores = np.array([r.score for r in test_ratings], dtype=np.float64)
+        rmse = np.sqrt(np.mean((scores - guesses) ** 2))
+        print 'RMSE: {0}'.format(rmse)
+
+        diff_totals = defaultdict(int)
+        for diff in np.abs(scores - np.floor(guesses + 0.5)):
+            diff_totals[diff] += 1
+        for k in sorted(diff_totals.keys()):
+            print '{0}: {1} ({2})'.format(
+                    k, diff_totals[k],
+                    100 * (float(diff_totals[k]) / len(test_ratings)))
+        return rmse
+
+    def get_memory_bytes(self):
+        """Returns the number of bytes used by the snapshot's factor and bias
+        arrays.
+        """
+        return (self.user_factors.nbytes + self.item_factors.nbytes +
+                self.user_biases.nbytes + self.item_biases.nbytes)
+
+    def predict_rows(self, user_rows, item_rows):
+        """Returns a numpy array of the predicted scores for the pairs of user
+        and item rows in the given arrays.
+        """
+        return (self.rating_average + self.user_biases[user_rows] +
+                self.item_biases[item_rows] +
+                np.einsum('ij,ij->i', self.user_factors[user_rows],
+                          self.item_factors[item_rows]))
+
+    def score_users(self, user_rows):
+        """Returns a numpy array with a row of the predicted scores of every
+        item for each of the given user rows, computed with one matrix
+        product.
+        """
+        scores = np.dot(self.user_factors[user_rows], self.item_factors.T)
+        scores += self.user_biases[user_rows][:, np.newaxis]
+        scores += self.item_biases + self.rating_average
+        return scores
+
+    def top_items(self, user_rows, scores, n, exclude_seen=True):
+        """Returns a tuple of numpy arrays of the item rows and the scores of
+        the n highest scored items for each of the given user rows, best
+        first, given their rows of scores from score_users. The scores are
+        changed in place. If exclude_seen is True, which is the default, items
+        the user has seen are left out, and a user with fewer than n unseen
+        items gets -inf scores at the end of their row.
+        """
+        if exclude_seen:
+            for row, user_row in enumerate(user_rows):
+                scores[row, self.get_seen_items(user_row)] = -np.inf
+        n = min(n, scores.shape[1])
+        if n == 0:
+            empty = np.zeros((len(user_rows), 0))
+            return empty.astype(np.int64), empty
+
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        top_scores = scores[np.arange(len(user_rows))[:, np.newaxis], top]
+        order = np.argsort(-top_scores, axis=1)
+        rows = np.arange(len(user_rows))[:, np.newaxis]
+        return top[rows, order], top_scores[rows, order]
@@ -0,0 +1,258 @@
+# Functions for exchanging rating sets and trained factors with other tools
+# through numpy files.
+
+import numpy as np
+import os
+import sqlite3
+import struct
+import zipfile
+import scipy.sparse as sparse
+
+from models.factor_snapshot import FactorSnapshot
+from models.latent_factors import LatentFactorModel
+from models.model_util import Rating, get_dimension, get_table_columns
+
+# Names of the files that hold the vocabularies of a directory of rating sets
+# and of a directory of factors, which map the row of each user and column or
+# row of each item to its user ID and anime name
+USER_NAMES_FILE_NAME = 'user_names.npy'
+ITEM_NAMES_FILE_NAME = 'item_names.npy'
+
+# Names of the files of a directory of factors
+FACTOR_FILE_NAMES = {
+    'user_factors': 'user_factors.npy',
+    'item_factors': 'item_factors.npy',
+    'user_biases': 'user_biases.npy',
+    'item_biases': 'item_biases.npy',
+    'rating_average': 'rating_average.npy',
+}
+
+# Size of the fixed part of the local file header of a zip file member
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def export_rating_sets(db_path, table_names, out_dir, decode_names=False):
+    """Writes the given tables of ratings, such as MALRatingsTrain,
+    MALRatingsValid, and MALRatingsTest, to sparse user by anime matrices in
+    the given directory.
+
+    Each table is written to <out_dir>/<table_name>.npz as a CSR matrix of
+    float32 scores in the format of scipy.sparse.save_npz, so it can be
+    loaded with scipy.sparse.load_npz or load_rating_set. The tables share
+    one vocabulary, written to user_names.npy and item_names.npy, so the
+    same row and column mean the same user and anime in every matrix. Tables
+    in the compact schema created by create_compact_db keep their integer IDs
+    unless decode_names is True.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        tables = {}
+        dimensions = None
+        for table_name in table_names:
+            compact = 'anime_id' in get_table_columns(cur, table_name)
+            cur.execute('SELECT user_id, {0}, score FROM {1}'.format(
+                        'anime_id' if compact else 'anime_name', table_name))
+            rows = cur.fetchall()
+            if compact and decode_names:
+                if dimensions is None:
+                    dimensions = (get_dimension(cur, 'users'),
+                                  get_dimension(cur, 'anime'))
+                users, anime = dimensions
+                rows = [(users[r[0]], anime[r[1]], r[2]) for r in rows]
+            tables[table_name] = rows
+    finally:
+        conn.close()
+
+    user_names = sorted(set(r[0] for rows in tables.itervalues()
+                            for r in rows))
+    item_names = sorted(set(r[1] for rows in tables.itervalues()
+                            for r in rows))
+    user_index = dict((user, u) for u, user in enumerate(user_names))
+    item_index = dict((item, i) for i, item in enumerate(item_names))
+    np.save(os.path.join(out_dir, USER_NAMES_FILE_NAME), np.array(user_names))
+    np.save(os.path.join(out_dir, ITEM_NAMES_FILE_NAME), np.array(item_names))
+
+    for table_name, rows in tables.iteritems():
+        matrix = sparse.csr_matrix(
+                (np.array([r[2] for r in rows], dtype=np.float32),
+                 (np.array([user_index[r[0]] for r in rows], dtype=np.int32),
+                  np.array([item_index[r[1]] for r in rows],
+                           dtype=np.int32))),
+                shape=(len(user_names), len(item_names)))
+        matrix.sort_indices()
+        # Stored uncompressed so load_rating_set can memory map the arrays
+        np.savez(os.path.join(out_dir, table_name + '.npz'),
+                 format='csr', shape=np.array(matrix.shape),
+                 data=matrix.data, indices=matrix.indices,
+                 indptr=matrix.indptr)
+
+
+def load_rating_set(out_dir, table_name, mmap=True):
+    """Returns a tuple of the sparse CSR matrix of the given table written by
+    export_rating_sets to the given directory, and the lists of the user IDs
+    of its rows and the anime names of its columns.
+
+    If mmap is True, which is the default, the arrays of the matrix are
+    memory mapped from the file instead of read into memory.
+    """
+    arrays = load_npz(os.path.join(out_dir, table_name + '.npz'), mmap)
+    matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=tuple(arrays['shape']), copy=False)
+    return (matrix, _load_names(out_dir, USER_NAMES_FILE_NAME),
+            _load_names(out_dir, ITEM_NAMES_FILE_NAME))
+
+
+def get_ratings_from_rating_set(out_dir, table_name):
+    """Returns a list of Rating objects for the ratings of the given table
+    written by export_rating_sets to the given directory, like
+    get_ratings_from_db does for the table in the database, so the models can
+    be trained without loading the database.
+    """
+    matrix, user_names, item_names = load_rating_set(out_dir, table_name)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return [Rating(user_names[u], item_names[i], int(s))
+            for u, i, s in zip(rows.tolist(), matrix.indices.tolist(),
+                               matrix.data.tolist())]
+
+
+def export_factors(model, out_dir):
+    """Writes the factors of the given trained LatentFactorModel or
+    FactorSnapshot to raw .npy files in the given directory: user_factors.npy
+    and item_factors.npy with a row per user and item, user_biases.npy,
+    item_biases.npy, and rating_average.npy, and the user IDs and anime names
+    of the rows in user_names.npy and item_names.npy.
+
+    Factors trained by other tools can be written in the same layout to be
+    loaded with load_factors.
+    """
+    if hasattr(model, 'user_vectors'):
+        model = FactorSnapshot.from_model(model)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    arrays = {
+        'user_factors': model.user_factors,
+        'item_factors': model.item_factors,
+        'user_biases': model.user_biases,
+        'item_biases': model.item_biases,
+        'rating_average': np.array(model.rating_average),
+    }
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(out_dir, FACTOR_FILE_NAMES[name]), array)
+    np.save(os.path.join(out_dir, USER_NAMES_FILE_NAME),
+            np.array(model.user_names))
+    np.save(os.path.join(out_dir, ITEM_NAMES_FILE_NAME),
+            np.array(model.item_names))
+
+
+def load_factors(out_dir, mmap_mode='r'):
+    """Returns a FactorSnapshot of the factors in the given directory, written
+    by export_factors or by another tool in the same layout. The biases and
+    rating average are optional and default to 0.
+
+    The factor and bias arrays are memory mapped with the given mode, 'r' by
+    default, so they are shared between processes serving the same factors
+    instead of copied into each of them. None reads them into memory.
+    """
+    def load(name, default=None):
+        path = os.path.join(out_dir, FACTOR_FILE_NAMES[name])
+        if not os.path.exists(path):
+            return default
+        return np.load(path, mmap_mode=mmap_mode)
+
+    user_factors = load('user_factors')
+    item_factors = load('item_factors')
+    return FactorSnapshot(
+            _load_names(out_dir, USER_NAMES_FILE_NAME),
+            _load_names(out_dir, ITEM_NAMES_FILE_NAME),
+            user_factors, item_factors,
+            load('user_biases', np.zeros(len(user_factors))),
+            load('item_biases', np.zeros(len(item_factors))),
+            float(load('rating_average', 0.0)))
+
+
+def build_model_from_factors(user_names, item_names, user_factors,
+                             item_factors, user_biases=None, item_biases=None,
+                             rating_average=0.0):
+    """Returns a LatentFactorModel with the given factors, such as factors
+    trained by another collaborative filtering library, ready to predict,
+    test, pickle, and serve like a model trained with train().
+
+    user_names - List of the user IDs of the rows of user_factors.
+    item_names - List of the anime names of the rows of item_factors.
+    user_factors - Numpy array with a row of factors for each user.
+    item_factors - Numpy array with a row of factors for each anime.
+    user_biases - Numpy array of the bias of each user. If None, along with
+                  item_biases, the model does not use biases. None by
+                  default.
+    item_biases - Numpy array of the bias of each anime. None by default.
+    rating_average - Global rating average added to every prediction. 0.0 by
+                     default.
+    """
+    use_biases = user_biases is not None or item_biases is not None
+    model = LatentFactorModel([], user_factors.shape[1], 0.0, 0.0, 0, False)
+    model.user_vectors = dict(zip(user_names, np.array(user_factors)))
+    model.item_vectors = dict(zip(item_names, np.array(item_factors)))
+    model.use_biases = use_biases
+    model.rating_average = float(rating_average)
+    if use_biases:
+        if user_biases is None:
+            user_biases = np.zeros(len(user_names))
+        if item_biases is None:
+            item_biases = np.zeros(len(item_names))
+        model.user_biases = dict(zip(user_names, np.asarray(user_biases,
+                                                            dtype=float)))
+        model.item_biases = dict(zip(item_names, np.asarray(item_biases,
+                                                            dtype=float)))
+    return model
+
+
+def load_npz(file_path, mmap=True):
+    """Returns a dict of the arrays in the given .npz file. If mmap is True,
+    which is the default, arrays stored uncompressed are memory mapped from
+    the file, since np.load() can only memory map .npy files.
+    """
+    if not mmap:
+        arrays = np.load(file_path)
+        return dict((name, arrays[name]) for name in arrays.files)
+
+    arrays = {}
+    with open(file_path, 'rb') as f:
+        for info in zipfile.ZipFile(f).infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(file_path)[name]
+                continue
+
+            # The member's data starts after its local header, whose name and
+            # extra field lengths can differ from the central directory's
+            f.seek(info.header_offset)
+            header = f.read(_ZIP_LOCAL_HEADER_SIZE)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + _ZIP_LOCAL_HEADER_SIZE +
+                   name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_2_0(f)
+
+            if dtype.hasobject or not shape or 0 in shape:
+                arrays[name] = np.load(file_path)[name]
+            else:
+                arrays[name] = np.memmap(
+                        file_path, dtype=dtype, mode='r', offset=f.tell(),
+                        shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+def _load_names(out_dir, file_name):
+    """Returns the list of names in the given vocabulary file."""
+    return np.load(os.path.join(out_dir, file_name)).tolist()
@@ -0,0 +1,354 @@
+# Objects for working with an item-item neighborhood model.
+
+import numpy as np
+import scipy.sparse as sparse
+from collections import defaultdict
+
+class ModelException(Exception):
+    """Indicates that there was an error within the model"""
+    pass
+
+
+class ItemNeighborModel:
+    """Object that encapsulates the parameters for an item-item neighborhood
+    model.
+
+    The model predicts the score a user would give an item from the scores
+    the user gave to the item's most similar items. Similarities between
+    items are shrunk adjusted cosine similarities: the cosine similarity of
+    the items' scores after removing a baseline prediction from each score,
+    shrunk toward 0 for items that few users have scored together. Only the
+    total_neighbors most similar items are kept for each item, so training is
+    a few sparse matrix products and predicting is a sparse dot product over
+    the items the user has scored.
+    """
+    # Regularization of the item and user biases in the baseline predictions
+    ITEM_BIAS_SHRINKAGE = 25
+    USER_BIAS_SHRINKAGE = 10
+
+    # Number of items whose similarities are computed at once during training
+    SIMILARITY_BLOCK_SIZE = 500
+
+    def __init__(self, train_ratings, total_neighbors=40, shrinkage=100,
+                 min_support=2, min_similarity=0.0, use_biases=True,
+                 save_path=None):
+        """Constructor for an item-item neighborhood model.
+
+        train_ratings - List of Rating objects that should be used for the
+                        training of the model.
+        total_neighbors - Total number of most similar items to keep for each
+                          item in the model. 40 by default.
+        shrinkage - Amount to shrink the similarity between two items by
+                    based on the number of users that scored both of them.
+                    The similarity is multiplied by n / (n + shrinkage) where
+                    n is the number of those users. 100 by default.
+        min_support - Minimum number of users that must have scored both of
+                      two items for them to be considered neighbors. 2 by
+                      default.
+        min_similarity - Items must be more similar than this to be
+                         considered neighbors. 0.0 by default.
+        use_biases - Boolean indicating whether the baseline predictions
+                     removed from each score should be the global average
+                     plus user and item biases (True) or just the average
+                     score of the user (False). True by default.
+        save_path - String of the path to save the trained model to. If None,
+                    the model will not be saved after training. None by
+                    default.
+        """
+        self.train_ratings = train_ratings
+        self.total_neighbors = total_neighbors
+        self.shrinkage = shrinkage
+        self.min_support = min_support
+        self.min_similarity = min_similarity
+        self.use_biases = use_biases
+        self.save_path = save_path
+
+    @classmethod
+    def load_model(cls, file_path):
+        """Loads an ItemNeighborModel object saved by the save() method from
+        the given file. The loaded model can predict scores but does not keep
+        the training ratings.
+        """
+        data = np.load(file_path)
+        params = data['params']
+        model = cls(None, int(params[0]), params[1], int(params[2]),
+                    params[3], bool(params[4]))
+        model._set_index(data['users'].tolist(), data['items'].tolist())
+        model.rating_average = float(params[5])
+        model.user_baselines = data['user_baselines']
+        model.item_baselines = data['item_baselines']
+        model.residuals = sparse.csr_matrix(
+                (data['residuals_data'], data['residuals_indices'],
+                 data['residuals_indptr']),
+                shape=(len(model.users), len(model.items)))
+        model.similarities = sparse.csr_matrix(
+                (data['similarities_data'], data['similarities_indices'],
+                 data['similarities_indptr']),
+                shape=(len(model.items), len(model.items)))
+        return model
+
+    def train(self):
+        """Trains the item-item neighborhood model by computing the baseline
+        predictions and the most similar items for each item in the training
+        ratings.
+
+        Returns True if the training completed successfully, and returns False
+        if the training could not be completed successfully because of some
+        issue.
+        """
+        if not self.train_ratings:
+            return False
+
+        users = sorted(set(r.user for r in self.train_ratings))
+        items = sorted(set(r.item for r in self.train_ratings))
+        self._set_index(users, items)
+
+        rows = np.array([self.user_index[r.user] for r in self.train_ratings])
+        cols = np.array([self.item_index[r.item] for r in self.train_ratings])
+        scores = np.array([r.score for r in self.train_ratings],
+                          dtype=np.float64)
+
+        self._init_baselines(rows, cols, scores)
+        residuals = scores - self._get_baselines(rows, cols)
+        self.residuals = sparse.csr_matrix(
+                (residuals, (rows, cols)), shape=(len(users), len(items)))
+        self.residuals.sort_indices()
+
+        self.similarities = self._get_neighbor_similarities()
+
+        if self.save_path is not None:
+            self.save(self.save_path)
+        return True
+
+    def test(self, test_ratings):
+        """Tests the item-item neighborhood model against the given list of
+        test ratings. Note that this function should only be called after the
+        model has been trained.
+
+        Prints out a summary of the root mean square error of the model on the
+        test ratings as well as the distribution of the differences between the
+        predicted ratings and the test ratings.
+
+        Returns the root mean square error of the model on the test ratings.
+        """
+        diff_totals = defaultdict(int)
+        total_squared_error = 0
+
+        for rating in test_ratings:
+            guess = self.predict(rating.user, rating.item)
+            total_squared_error += (rating.score - guess) ** 2
+            diff = abs(rating.score - int(round(guess)))
+            diff_totals[diff] += 1
+
+        rmse = np.sqrt(float(total_squared_error) / len(test_ratings))
+        print 'RMSE: {0}'.format(rmse)
+        for k in sorted(diff_totals.keys()):
+            print '{0}: {1} ({2})'.format(
+                    k, diff_totals[k],
+                    100 * (float(diff_totals[k]) / len(test_ratings)))
+        return rmse
+
+    def predict(self, test_user, test_item):
+        """Predicts the score the given user would give the given item using
+        the model. Note that this function should only be called after the
+        model has been trained.
+
+        Returns the predicted score which is the baseline prediction plus the
+        similarity weighted average of the user's residual scores on the
+        neighbors of the item that the user has scored.
+        """
+        u = self.user_index.get(test_user)
+        if u is None:
+            raise ModelException('User ({0}) not in model'.format(test_user))
+        i = self.item_index.get(test_item)
+        if i is None:
+            raise ModelException('Item ({0}) not in model'.format(test_item))
+
+        baseline = (self.rating_average + self.user_baselines[u] +
+                    self.item_baselines[i])
+
+        # Find which neighbors of the item the user has scored. The user's
+        # scored items are sorted, so they can be searched directly.
+        sims = self.similarities
+        neighbors = sims.indices[sims.indptr[i]:sims.indptr[i + 1]]
+        neighbor_sims = sims.data[sims.indptr[i]:sims.indptr[i + 1]]
+        res = self.residuals
+        user_items = res.indices[res.indptr[u]:res.indptr[u + 1]]
+        user_residuals = res.data[res.indptr[u]:res.indptr[u + 1]]
+        if len(neighbors) == 0 or len(user_items) == 0:
+            return baseline
+
+        positions = np.searchsorted(user_items, neighbors)
+        positions[positions == len(user_items)] = 0
+        scored = user_items[positions] == neighbors
+        weight_total = np.abs(neighbor_sims[scored]).sum()
+        if weight_total == 0:
+            return baseline
+
+        return baseline + (np.dot(neighbor_sims[scored],
+                                  user_residuals[positions[scored]]) /
+                           weight_total)
+
+    def predict_batch(self, test_users, test_items):
+        """Predicts the scores the given users would give the given items, like
+        predict() for each pair of a user and an item in the two lists, with
+        sparse matrix products instead of a loop over the pairs.
+
+        Returns a numpy array of the predicted scores.
+
+        Raises a ModelException if a user or item is not in the model.
+        """
+        rows = self._get_rows(self.user_index, test_users, 'User')
+        cols = self._get_rows(self.item_index, test_items, 'Item')
+        baselines = self._get_baselines(rows, cols)
+
+        # Each pair's weighted residual total and weight total are the row
+        # sums of the elementwise products of the user's residuals and the
+        # item's neighbor similarities
+        res = self.residuals
+        scored = sparse.csr_matrix(
+                (np.ones(len(res.data)), res.indices, res.indptr),
+                shape=res.shape)
+        sims = self.similarities[cols]
+        weighted_totals = np.asarray(
+                res[rows].multiply(sims).sum(axis=1)).ravel()
+        weight_totals = np.asarray(
+                scored[rows].multiply(abs(sims)).sum(axis=1)).ravel()
+
+        neighbor_scores = np.zeros(len(rows))
+        has_weight = weight_totals != 0
+        neighbor_scores[has_weight] = (weighted_totals[has_weight] /
+                                       weight_totals[has_weight])
+        return baselines + neighbor_scores
+
+    def save(self, file_path):
+        """Saves the trained model to the given .npz file so that it can be
+        loaded later with load_model().
+        """
+        np.savez(file_path,
+                 params=np.array([self.total_neighbors, self.shrinkage,
+                                  self.min_support, self.min_similarity,
+                                  self.use_biases, self.rating_average],
+                                 dtype=np.float64),
+                 users=np.array(self.users), items=np.array(self.items),
+                 user_baselines=self.user_baselines,
+                 item_baselines=self.item_baselines,
+                 residuals_data=self.residuals.data,
+                 residuals_indices=self.residuals.indices,
+                 residuals_indptr=self.residuals.indptr,
+                 similarities_data=self.similarities.data,
+                 similarities_indices=self.similarities.indices,
+                 similarities_indptr=self.similarities.indptr)
+
+    def _get_rows(self, index, keys, kind):
+        """Returns a numpy array of the rows of the given users or items in the
+        given index, raising a ModelException if one is not in the model.
+        """
+        rows = np.empty(len(keys), dtype=np.int64)
+        for n, key in enumerate(keys):
+            row = index.get(key)
+            if row is None:
+                raise ModelException('{0} ({1}) not in model'.format(kind,
+                                                                     key))
+            rows[n] = row
+        return rows
+
+    def _set_index(self, users, items):
+        """Sets the ordered lists of users and items in the model and the
+        dicts mapping them to their row and column in the model's matrices.
+        """
+        self.users = users
+        self.items = items
+        self.user_index = dict((user, u) for u, user in enumerate(users))
+        self.item_index = dict((item, i) for i, item in enumerate(items))
+
+    def _init_baselines(self, rows, cols, scores):
+        """Computes the baseline prediction terms for every user and item from
+        the training scores given by user row, item column, and score arrays.
+        """
+        total_users = len(self.users)
+        total_items = len(self.items)
+        user_counts = np.bincount(rows, minlength=total_users)
+        item_counts = np.bincount(cols, minlength=total_items)
+
+        if not self.use_biases:
+            # The baseline is just the average score of each user
+            self.rating_average = 0.0
+            self.item_baselines = np.zeros(total_items)
+            self.user_baselines = (np.bincount(rows, scores, total_users) /
+                                   np.maximum(user_counts, 1))
+            return
+
+        self.rating_average = scores.mean()
+        self.item_baselines = (
+                np.bincount(cols, scores - self.rating_average, total_items) /
+                (item_counts + self.ITEM_BIAS_SHRINKAGE))
+        user_deviations = (scores - self.rating_average -
+                           self.item_baselines[cols])
+        self.user_baselines = (
+                np.bincount(rows, user_deviations, total_users) /
+                (user_counts + self.USER_BIAS_SHRINKAGE))
+
+    def _get_baselines(self, rows, cols):
+        """Returns the baseline predictions for the given arrays of user rows
+        and item columns.
+        """
+        return (self.rating_average + self.user_baselines[rows] +
+                self.item_baselines[cols])
+
+    def _get_neighbor_similarities(self):
+        """Computes the shrunk adjusted cosine similarities between all items
+        and keeps the total_neighbors most similar items for each item.
+
+        Returns an items X items CSR matrix where row i holds the similarities
+        of the neighbors of item i.
+        """
+        total_items = len(self.items)
+        residuals = self.residuals.tocsc()
+        residuals_t = self.residuals.T.tocsr()
+        scored = residuals.copy()
+        scored.data = np.ones_like(scored.data)
+        scored_t = scored.T.tocsr()
+        norms = np.sqrt(np.asarray(
+                residuals.multiply(residuals).sum(axis=0)).ravel())
+        norms[norms == 0] = 1
+
+        # Compute the similarities a block of items at a time so only a block
+        # of the dense similarity matrix is held in memory at once
+        neighbor_rows = []
+        neighbor_cols = []
+        neighbor_sims = []
+        for start in xrange(0, total_items, self.SIMILARITY_BLOCK_SIZE):
+            block = np.arange(start,
+                              min(start + self.SIMILARITY_BLOCK_SIZE,
+                                  total_items))
+            products = residuals_t.dot(residuals[:, block]).toarray()
+            support = scored_t.dot(scored[:, block]).toarray()
+
+            sims = (products / np.outer(norms, norms[block]) *
+                    (support / (support + float(self.shrinkage))))
+            sims[support < self.min_support] = 0
+            sims[block, np.arange(len(block))] = 0  # Items aren't neighbors
+                                                    # of themselves
+
+            # Select the most similar items in each column of the block
+            k = min(self.total_neighbors, total_items - 1)
+            if k <= 0:
+                continue
+            top = np.argpartition(-sims, k - 1, axis=0)[:k]
+            top_sims = sims[top, np.arange(len(block))]
+            keep = top_sims > self.min_similarity
+            neighbor_rows.append(np.tile(block, (k, 1))[keep])
+            neighbor_cols.append(top[keep])
+            neighbor_sims.append(top_sims[keep])
+
+        if not neighbor_rows:
+            return sparse.csr_matrix((total_items, total_items))
+
+        similarities = sparse.csr_matrix(
+                (np.concatenate(neighbor_sims),
+                 (np.concatenate(neighbor_rows),
+                  np.concatenate(neighbor_cols))),
+                shape=(total_items, total_items))
+        similarities.sort_indices()
+        return similarities
@@ -1,12 +1,26 @@
 # Objects for working with a latent factors model.
 
-import dill
 import math
 import os
 import random
 import numpy as np
 from collections import defaultdict
 
+# Optimizers for the stochastic gradient descent. SGD steps every parameter
+# by the same learning rate, while AdaGrad and Adam scale the step of each
+# parameter by the history of its gradients, kept in an accumulator array for
+# each user and item vector and bias
+SGD_OPTIMIZER = 'sgd'
+ADAGRAD_OPTIMIZER = 'adagrad'
+ADAM_OPTIMIZER = 'adam'
+
+# Decay rates of Adam's averages of the gradients and squared gradients
+ADAM_BETA1 = 0.9
+ADAM_BETA2 = 0.999
+
+# Term added to the denominator of the adaptive steps to avoid dividing by 0
+ADAPTIVE_EPSILON = 1e-8
+
 class ModelException(Exception):
     """Indicates that there was an error within the model"""
     pass
@@ -20,11 +34,14 @@ class LatentFactorModel:
     def __init__(self, train_ratings, total_factors, norm_factor,
                  learning_rate, max_iterations, use_biases=True,
                  implicit_feedback=None, pickle_freq=None,
-                 pickle_dir=''):
+                 pickle_dir='', optimizer=SGD_OPTIMIZER,
+                 learning_rate_decay=None, valid_ratings=None, valid_freq=1,
+                 patience=None):
         """Constructor for a latent factors model.
 
         train_ratings - List of Rating objects that should be used for the
-                        training of the model.
+                        training of the model. Can also be a RatingStream to
+                        train on ratings that don't fit in memory.
         total_factors - Total number of latent factors to use in the model.
         norm_factor - Normalization factor (lambda) to use in the model.
         learning_rate - Learning rate to use for the training of the model.
@@ -44,21 +61,65 @@ class LatentFactorModel:
                       during training. None by default.
         pickle_dir - String of the directory to save the pickle files to for
                      this model. Unused if pickle_freq is None.
+        optimizer - String of the optimizer to use for the stochastic gradient
+                    descent: SGD_OPTIMIZER, ADAGRAD_OPTIMIZER, or
+                    ADAM_OPTIMIZER. The adaptive optimizers usually need a
+                    larger learning rate than SGD, around 0.1 for AdaGrad and
+                    0.01 for Adam. SGD_OPTIMIZER by default.
+        learning_rate_decay - Factor the learning rate is multiplied by after
+                              each iteration, such as 0.95. If None, the
+                              learning rate is constant. None by default.
+        valid_ratings - List of Rating objects to compute the validation RMSE
+                        on during training, such as the ratings in
+                        MALRatingsValid. When training ends, the parameters
+                        with the lowest validation RMSE are kept and the
+                        ratings are released. If None,
+                        the model is not validated during training. None by
+                        default.
+        valid_freq - Integer of the interval of iterations at which the
+                     validation RMSE is computed. Unused if valid_ratings is
+                     None. 1 by default.
+        patience - Integer of the number of iterations without a lower
+                   validation RMSE after which training stops early. If None,
+                   training runs for all of the iterations. Unused if
+                   valid_ratings is None. None by default.
         """
+        if optimizer not in (SGD_OPTIMIZER, ADAGRAD_OPTIMIZER,
+                             ADAM_OPTIMIZER):
+            raise ModelException('Unknown optimizer ({0})'.format(optimizer))
         self.train_ratings = train_ratings
         self.total_factors = total_factors
         self.norm_factor = norm_factor
+        self.start_learning_rate = learning_rate
         self.learning_rate = learning_rate
         self.max_iterations = max_iterations
         self.use_biases = use_biases
         self.implicit_feedback = implicit_feedback
         self.pickle_freq = pickle_freq
         self.pickle_dir = pickle_dir
+        self.optimizer = optimizer
+        self.learning_rate_decay = learning_rate_decay
+        self.valid_ratings = valid_ratings
+        self.valid_freq = valid_freq
+        self.patience = patience
 
         self.user_vectors = {}
         self.item_vectors = {}
         self.completed_iterations = 0
 
+        # Optimizer accumulators of each user and item, unused by SGD
+        self.user_vector_states = {}
+        self.item_vector_states = {}
+        self.user_bias_states = {}
+        self.item_bias_states = {}
+        self.negative_imp_states = {}
+
+        # Validation RMSE history and the best parameters found so far
+        self.valid_rmses = []
+        self.best_valid_rmse = None
+        self.best_iteration = None
+        self._best_params = None
+
         if use_biases:
             self.user_biases = {}
             self.item_biases = {}
@@ -73,12 +134,23 @@ class LatentFactorModel:
     @classmethod
     def load_model(cls, file_path):
         """Loads a pickled LatentFactorModel object from the given file."""
+        import dill
         return dill.load(open(file_path, 'rb'))
 
+    def save_model(self, file_path):
+        """Pickles the LatentFactorModel object to the given file."""
+        import dill
+        dill.dump(self, open(file_path, 'wb'), 2)
+
     def train(self):
         """Trains the latent factors model using stochastic gradient descent
         with the parameters specified in the constructor.
 
+        If validation ratings were given, the validation RMSE is computed
+        every valid_freq iterations, training stops early once it hasn't
+        improved for patience iterations, and the parameters from the
+        iteration with the lowest validation RMSE are kept.
+
         Returns True if the training completed successfully, and returns False
         if the training was unable to complete due to some issue.
         """
@@ -86,6 +158,9 @@ class LatentFactorModel:
             # Print progress
             print i
 
+            if self.learning_rate_decay is not None:
+                self.learning_rate = (self.start_learning_rate *
+                                      self.learning_rate_decay ** (i - 1))
             for rating in self.train_ratings:
                 successful = self._update_model(rating, self.learning_rate)
                 if not successful:
@@ -96,6 +171,25 @@ class LatentFactorModel:
             # object
             if self.pickle_freq is not None and i % self.pickle_freq == 0:
                 self._pickle_model(i)
+
+            if self.valid_ratings is not None and i % self.valid_freq == 0:
+                self._validate(i)
+                if (self.patience is not None and
+                        i - self.best_iteration >= self.patience):
+                    print 'Stopping early at iteration {0}'.format(i)
+                    break
+
+        if self._best_params is not None:
+            self._restore_best_params()
+
+        # The validation ratings and optimizer accumulators are only needed
+        # while training, so they aren't pickled with the trained model
+        self.valid_ratings = None
+        self.user_vector_states = {}
+        self.item_vector_states = {}
+        self.user_bias_states = {}
+        self.item_bias_states = {}
+        self.negative_imp_states = {}
         return True
 
     def test(self, test_ratings):
@@ -166,6 +260,118 @@ class LatentFactorModel:
         guess = self.rating_average + ub + ib + np.dot(imp_uv, iv)
         return guess
 
+    def predict_batch(self, test_users, test_items):
+        """Predicts the scores the given users would give the given items, like
+        predict() for each pair of a user and an item in the two lists, with
+        the dot products of all of the pairs computed at once.
+
+        Returns a numpy array of the predicted scores.
+        """
+        user_vectors = {}
+        for test_user in set(test_users):
+            uv = self.user_vectors.get(test_user)
+            if uv is None or (self.use_biases and
+                              test_user not in self.user_biases):
+                raise ModelException(
+                        'User ({0}) not in model'.format(test_user))
+            user_vectors[test_user] = self._get_imp_user_vector(test_user, uv)
+        for test_item in set(test_items):
+            if test_item not in self.item_vectors or (
+                    self.use_biases and test_item not in self.item_biases):
+                raise ModelException(
+                        'Item ({0}) not in model'.format(test_item))
+
+        uvs = np.array([user_vectors[u] for u in test_users],
+                       dtype=np.float64).reshape(len(test_users),
+                                                 self.total_factors)
+        ivs = np.array([self.item_vectors[i] for i in test_items],
+                       dtype=np.float64).reshape(len(test_items),
+                                                 self.total_factors)
+        guesses = self.rating_average + np.einsum('ij,ij->i', uvs, ivs)
+        if self.use_biases:
+            guesses += np.array([self.user_biases[u] for u in test_users])
+            guesses += np.array([self.item_biases[i] for i in test_items])
+        return guesses
+
+    def get_valid_rmse(self, valid_ratings):
+        """Returns the root mean square error of the model on the given list of
+        ratings, without printing anything. Ratings of users or items that
+        are not in the model yet are skipped.
+        """
+        ratings = [r for r in valid_ratings
+                   if r.user in self.user_vectors and
+                   r.item in self.item_vectors]
+        if not ratings:
+            return float('inf')
+        guesses = self.predict_batch([r.user for r in ratings],
+                                     [r.item for r in ratings])
+        scores = np.array([r.score for r in ratings], dtype=np.float64)
+        return np.sqrt(np.mean((scores - guesses) ** 2))
+
+    def _validate(self, iteration):
+        """Computes the validation RMSE after the given iteration and keeps a
+        copy of the parameters if it is the lowest so far.
+        """
+        rmse = self.get_valid_rmse(self.valid_ratings)
+        self.valid_rmses.append((iteration, rmse))
+        print 'Validation RMSE: {0} (learning rate {1})'.format(
+                rmse, self.learning_rate)
+        if self.best_valid_rmse is None or rmse < self.best_valid_rmse:
+            self.best_valid_rmse = rmse
+            self.best_iteration = iteration
+
+            # Updates replace the vectors instead of changing them in place,
+            # so copying the dicts is enough to keep the parameters
+            self._best_params = {
+                'user_vectors': dict(self.user_vectors),
+                'item_vectors': dict(self.item_vectors),
+            }
+            if self.use_biases:
+                self._best_params['user_biases'] = dict(self.user_biases)
+                self._best_params['item_biases'] = dict(self.item_biases)
+            if self.implicit_feedback is not None:
+                self._best_params['negative_imp_vectors'] = dict(
+                        self.negative_imp_vectors)
+
+    def _restore_best_params(self):
+        """Restores the parameters with the lowest validation RMSE, along with
+        the number of iterations they were trained for.
+        """
+        if self.best_iteration != self.completed_iterations:
+            print 'Restoring parameters from iteration {0} (RMSE {1})'.format(
+                    self.best_iteration, self.best_valid_rmse)
+        for name, params in self._best_params.iteritems():
+            setattr(self, name, params)
+        self.completed_iterations = self.best_iteration
+        self._best_params = None
+
+    def _get_step(self, states, key, grad, learning_rate):
+        """Returns the step to add to the parameter with the given key for the
+        given gradient, scaled by the learning rate and, for the adaptive
+        optimizers, by the accumulator of the parameter in the given dict of
+        states, which is updated.
+        """
+        if self.optimizer == SGD_OPTIMIZER:
+            return np.multiply(learning_rate, grad)
+
+        if self.optimizer == ADAGRAD_OPTIMIZER:
+            squared_grads = states.get(key, 0) + np.square(grad)
+            states[key] = squared_grads
+            return (learning_rate * grad /
+                    (np.sqrt(squared_grads) + ADAPTIVE_EPSILON))
+
+        # Adam, with the bias correction of each parameter's averages based on
+        # the number of times it was updated
+        mean, squared_mean, updates = states.get(key, (0, 0, 0))
+        mean = ADAM_BETA1 * mean + (1 - ADAM_BETA1) * grad
+        squared_mean = (ADAM_BETA2 * squared_mean +
+                        (1 - ADAM_BETA2) * np.square(grad))
+        updates += 1
+        states[key] = (mean, squared_mean, updates)
+        return (learning_rate * (mean / (1 - ADAM_BETA1 ** updates)) /
+                (np.sqrt(squared_mean / (1 - ADAM_BETA2 ** updates)) +
+                 ADAPTIVE_EPSILON))
+
     def _pickle_model(self, training_iterations):
         """Pickles the LatentFactorModel object to a file. The file will be
         labelled with the given number training iterations.
@@ -177,8 +383,7 @@ class LatentFactorModel:
                 norm_factor=self.norm_factor,
                 learning_rate=self.start_learning_rate,
                 iterations=training_iterations)
-        file_path = os.path.join(self.pickle_dir, file_name)
-        dill.dump(self, open(file_path, 'wb'), 2)
+        self.save_model(os.path.join(self.pickle_dir, file_name))
 
     def _get_item_rating_average(self):
         """Returns the global rating average across all items in the training
@@ -228,23 +433,29 @@ class LatentFactorModel:
         imp_user_vector = self._get_imp_user_vector(rating.user, user_vector)
         error = (rating.score - self.rating_average - user_bias -
                  item_bias - np.dot(imp_user_vector, item_vector))
-        userv_grad = (np.multiply(learning_rate,
+        userv_grad = self._get_step(
+            self.user_vector_states, rating.user,
             np.subtract(
                 np.multiply(error, item_vector),
                 np.multiply(self.norm_factor, user_vector)
-            )
-        ))
-        itemv_grad = (np.multiply(learning_rate,
+            ),
+            learning_rate
+        )
+        itemv_grad = self._get_step(
+            self.item_vector_states, rating.item,
             np.subtract(
                 np.multiply(error, user_vector),
                 np.multiply(self.norm_factor, item_vector)
-            )
-        ))
+            ),
+            learning_rate
+        )
         if self.use_biases:
-            userb_grad = (learning_rate *
-                    (error - self.norm_factor * user_bias))
-            itemb_grad = (learning_rate *
-                    (error - self.norm_factor * item_bias))
+            userb_grad = float(self._get_step(
+                    self.user_bias_states, rating.user,
+                    error - self.norm_factor * user_bias, learning_rate))
+            itemb_grad = float(self._get_step(
+                    self.item_bias_states, rating.item,
+                    error - self.norm_factor * item_bias, learning_rate))
 
         # Update parameters with their gradients
         user_vector = np.add(user_vector, userv_grad)
@@ -315,12 +526,14 @@ class LatentFactorModel:
                     float(1) / np.sqrt(len(imp_items['negative'])))
             for neg_item in imp_items['negative']:
                 neg_vector = self.negative_imp_vectors[neg_item]
-                item_grad = (np.multiply(learning_rate,
+                item_grad = self._get_step(
+                    self.negative_imp_states, neg_item,
                     np.subtract(
                         np.multiply(error * neg_norm_factor, item_vector),
                         np.multiply(self.norm_factor, neg_vector)
-                    )
-                ))
+                    ),
+                    learning_rate
+                )
                 self.negative_imp_vectors[neg_item] = np.add(neg_vector, item_grad)
 
     def _make_random_vector(self, dimension):
@@ -0,0 +1,264 @@
+# Functions and objects for measuring how much memory the models and the
+# loaded data sets use.
+
+import resource
+import sys
+import threading
+import time
+import types
+from collections import defaultdict, deque
+
+import numpy as np
+
+from models.model_util import (get_implicit_feedback_from_db,
+                               get_ratings_from_db)
+
+# Types that are shared code rather than data, so they are not walked
+_CODE_TYPES = (type, types.ClassType, types.FunctionType, types.LambdaType,
+               types.MethodType, types.BuiltinFunctionType, types.ModuleType)
+
+
+def get_deep_size(obj, seen=None):
+    """Returns a tuple of the total number of bytes used by the given object
+    and everything it refers to, and a dict of the number of objects of each
+    type found.
+
+    Each object is only counted once, so strings shared between ratings, such
+    as the user IDs and anime names, are only counted the first time they are
+    found. Numpy arrays are counted with their data. Classes, functions, and
+    modules are not counted.
+
+    obj - Object to measure.
+    seen - Set of the ids of objects that were already counted, which is
+           updated with the objects found. If None, a new set is used. None by
+           default.
+    """
+    if seen is None:
+        seen = set()
+    total_bytes = 0
+    type_counts = defaultdict(int)
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _CODE_TYPES):
+            continue
+        seen.add(id(obj))
+        total_bytes += sys.getsizeof(obj)
+        type_counts[getattr(obj, '__class__', type(obj)).__name__] += 1
+
+        if isinstance(obj, np.ndarray):
+            # Views don't own their data, so count the array that does
+            if obj.base is not None:
+                stack.append(obj.base)
+        elif isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif not isinstance(obj, basestring):
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for slot in getattr(obj.__class__, '__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return total_bytes, dict(type_counts)
+
+
+def get_memory_profile(components):
+    """Returns a list of tuples of the name, deep size in bytes, and object
+    counts of each of the given components.
+
+    The components are measured in order with the same set of seen objects,
+    so an object shared by several components, like the training ratings
+    kept by a model, is only counted in the first one.
+
+    components - List of tuples of the name of each component and the object
+                 to measure.
+    """
+    seen = set()
+    return [(name, ) + get_deep_size(obj, seen) for name, obj in components]
+
+
+def print_memory_profile(model=None, ratings=None, implicit_feedback=None):
+    """Prints the deep size and object counts of the given ratings, implicit
+    feedback, and model, with the size of each attribute of the model
+    listed separately, and the bytes used per rating.
+
+    model - LatentFactorModel, SimpleAverageModel, or other model object. None
+            to not measure a model. None by default.
+    ratings - List of Rating objects, such as from get_ratings_from_db. If
+              None, the model's train_ratings are measured if it has them.
+              None by default.
+    implicit_feedback - List of ImplicitFeedback objects, such as from
+                        get_implicit_feedback_from_db. None by default.
+
+    Returns the list of tuples of the name, deep size, and object counts of
+    each component.
+    """
+    if ratings is None and model is not None:
+        ratings = getattr(model, 'train_ratings', None)
+
+    components = []
+    if ratings is not None:
+        components.append(('ratings', ratings))
+    if implicit_feedback is not None:
+        components.append(('implicit_feedback', implicit_feedback))
+    if model is not None:
+        for name, value in sorted(vars(model).iteritems()):
+            components.append(('model.' + name, value))
+    profile = [p for p in get_memory_profile(components) if p[1] > 0]
+
+    total_ratings = len(ratings) if ratings is not None else 0
+    total_bytes = sum(p[1] for p in profile)
+    print 'Memory profile:'
+    for name, size, type_counts in profile:
+        top_types = sorted(type_counts.iteritems(), key=lambda t: -t[1])[:3]
+        line = '  {0}: {1:.2f} MB, {2} objects ({3})'.format(
+                name, size / 1e6, sum(type_counts.itervalues()),
+                ', '.join('{0} {1}'.format(t, n) for t, n in top_types))
+        if total_ratings:
+            line += ', {0:.1f} bytes/rating'.format(
+                    float(size) / total_ratings)
+        print line
+    line = '  total: {0:.2f} MB'.format(total_bytes / 1e6)
+    if total_ratings:
+        line += ', {0:.1f} bytes/rating'.format(
+                float(total_bytes) / total_ratings)
+    print line
+    return profile
+
+
+def get_rss_kb():
+    """Returns the resident set size of this process in kilobytes, or the peak
+    resident set size if the current one can't be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakMemoryTracker:
+    """Object that tracks the peak resident set size of this process while a
+    block of code runs, by sampling it from a background thread.
+
+    The peak resident set size reported by the operating system only ever
+    grows, so it can't show the peak of one step after an earlier step used
+    more memory. The sampling can miss short spikes between samples.
+
+    Usage:
+        with PeakMemoryTracker('train') as tracker:
+            model.train()
+        tracker.report()
+    """
+
+    def __init__(self, label='', interval=0.01):
+        """Constructor for a peak memory tracker.
+
+        label - String naming the tracked code in the report. Empty by
+                default.
+        interval - Number of seconds between samples. 0.01 by default.
+        """
+        self.label = label
+        self.interval = interval
+        self.start_kb = None
+        self.peak_kb = None
+        self.end_kb = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.start_kb = self.peak_kb = get_rss_kb()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.end_kb = get_rss_kb()
+        self.peak_kb = max(self.peak_kb, self.end_kb)
+        self.seconds = time.time() - self.start_time
+        return False
+
+    def get_stats(self):
+        """Returns a dict of the 'start_kb', 'peak_kb', and 'end_kb' resident
+        set size, the 'peak_increase_kb' over the start, and the 'seconds'
+        taken.
+        """
+        return {
+            'start_kb': self.start_kb,
+            'peak_kb': self.peak_kb,
+            'end_kb': self.end_kb,
+            'peak_increase_kb': self.peak_kb - self.start_kb,
+            'seconds': self.seconds,
+        }
+
+    def report(self):
+        """Prints the resident set size at the start, peak, and end."""
+        print ('{0}: RSS {1:.1f} MB -> peak {2:.1f} MB (+{3:.1f} MB) -> '
+               '{4:.1f} MB in {5:.1f}s').format(
+                   self.label, self.start_kb / 1024.0, self.peak_kb / 1024.0,
+                   (self.peak_kb - self.start_kb) / 1024.0,
+                   self.end_kb / 1024.0, self.seconds)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, get_rss_kb())
+
+
+def benchmark_memory(db_path, table_name, Model, model_params=(),
+                     implicit_db_path=None, implicit_table_name=None,
+                     decode_names=False):
+    """Loads the given ratings and implicit feedback, trains a model on them,
+    and prints the peak resident set size of each step and the memory profile
+    of the loaded data and the trained model.
+
+    db_path - String of the path to the database of ratings.
+    table_name - String of the name of the table of training ratings.
+    Model - Class of the model to train, such as LatentFactorModel or
+            SimpleAverageModel. It is constructed as
+            Model(train_ratings, *model_params), with implicit_feedback as a
+            keyword argument if implicit feedback is loaded.
+    model_params - Tuple of the parameters after train_ratings to construct
+                   the model with. Empty by default.
+    implicit_db_path - String of the path to the database of implicit
+                       feedback. If None, implicit feedback is not loaded.
+                       None by default.
+    implicit_table_name - String of the name of the table of implicit
+                          feedback. None by default.
+    decode_names - Boolean passed to the loaders. False by default.
+
+    Returns a dict mapping 'load_ratings', 'load_implicit_feedback' if it was
+    loaded, and 'train' to the stats of their PeakMemoryTrackers, and
+    'profile' to the memory profile.
+    """
+    results = {}
+    with PeakMemoryTracker('load_ratings') as tracker:
+        ratings = get_ratings_from_db(db_path, table_name, decode_names)
+    tracker.report()
+    results['load_ratings'] = tracker.get_stats()
+
+    kwargs = {}
+    implicit_feedback = None
+    if implicit_db_path is not None:
+        with PeakMemoryTracker('load_implicit_feedback') as tracker:
+            implicit_feedback = get_implicit_feedback_from_db(
+                    implicit_db_path, implicit_table_name, decode_names)
+        tracker.report()
+        results['load_implicit_feedback'] = tracker.get_stats()
+        kwargs['implicit_feedback'] = implicit_feedback
+
+    model = Model(ratings, *model_params, **kwargs)
+    with PeakMemoryTracker('train') as tracker:
+        model.train()
+    tracker.report()
+    results['train'] = tracker.get_stats()
+
+    results['profile'] = print_memory_profile(model, ratings,
+                                              implicit_feedback)
+    return results
@@ -1,5 +1,6 @@
 # Utility functions and objects for working with model objects.
 
+import numpy as np
 import sqlite3
 from collections import defaultdict
 
@@ -9,6 +10,14 @@ COMPLETED_STATUS = 'Completed'
 ON_HOLD_STATUS = 'On-Hold'
 WATCHING_STATUS = 'Watching'
 
+# Integer codes for the statuses in the compact schema for the data sets
+STATUS_CODES = {
+    COMPLETED_STATUS: 0,
+    WATCHING_STATUS: 1,
+    ON_HOLD_STATUS: 2,
+    DROPPED_STATUS: 3,
+}
+
 
 class Rating:
     """Encapsulates the information for a user rating on an item."""
@@ -48,7 +57,8 @@ class ImplicitFeedback:
         return self.status == DROPPED_STATUS
 
 
-def topk_test(topk_data_db_path, topk_data_table_name, model, rand_anime_total):
+def topk_test(topk_data_db_path, topk_data_table_name, model, rand_anime_total,
+              decode_names=False):
     """Runs the top-k test proposed by Yehuda Koren in his "Factorization Meets
     the Neighborhood: a Multifaceted Collaborative Filtering Model" paper.
 
@@ -56,11 +66,18 @@ def topk_test(topk_data_db_path, topk_data_table_name, model, rand_anime_total):
                         with the data for the top-k test.
     topk_data_db_path - String of the name of the table with the top rated
                         anime and selected random anime for the top-k test.
+                        The table can be in either the plain or the compact
+                        form created by create_topk_test_db.
     model - Model object to use for the top-k test. Must have a
             predict(user, item) method to predict the score a user would give
             an item.
     rand_anime_total - Amount of random anime selected for each top rated anime
                        in the top-k data set.
+    decode_names - Boolean indicating whether to use the user IDs and anime
+                   names instead of their integer IDs when the table is in the
+                   compact schema created by create_compact_db. This should
+                   match how the model's training ratings were loaded. False
+                   by default.
 
     Returns two lists. The first list is an ordered list of the possible ranks
     in the top-k test, and the second list is an ordered list of cummulative
@@ -69,19 +86,8 @@ def topk_test(topk_data_db_path, topk_data_table_name, model, rand_anime_total):
     second list is the y-axis values for the top-k test results.
     """
     anime_ranks = defaultdict(int)
-    user_anime_pairs = defaultdict(list)
-    conn = sqlite3.connect(topk_data_db_path)
-
-    # Load all of the top-k test data into memory
-    with conn:
-        cur = conn.cursor()
-        cur.execute('''SELECT user_id, anime_name, rand_anime_name
-                       FROM {0}'''.format(topk_data_table_name))
-        while True:
-            row = cur.fetchone()
-            if row is None:
-                break
-            user_anime_pairs[(row[0], row[1])].append(row[2])
+    user_anime_pairs = load_topk_data(topk_data_db_path, topk_data_table_name,
+                                      decode_names)
 
     cntr = 0
     for user_anime_pair, rand_anime in user_anime_pairs.iteritems():
@@ -127,33 +133,140 @@ def topk_test(topk_data_db_path, topk_data_table_name, model, rand_anime_total):
     return (rank_distribution_x, rank_distribution_y)
 
 
-def get_ratings_from_db(db_path, table_name):
+def load_topk_data(topk_data_db_path, topk_data_table_name, decode_names=False):
+    """Loads the top-k test data from the given table in the given database.
+    Returns a dict mapping (user, top rated anime) pairs to the list of random
+    anime selected for them.
+
+    The table can be in the plain form, with one row per random anime, or in
+    the compact form, with one row per top rated anime and the IDs of its
+    random anime packed into a blob of 32-bit integers. The anime names for
+    the IDs in the compact form are in the table with the same name plus
+    'Anime'. The table can also be in the compact schema created by
+    create_compact_db, in which case the users and anime are given by their
+    integer IDs unless decode_names is True.
+    """
+    user_anime_pairs = defaultdict(list)
+    conn = sqlite3.connect(topk_data_db_path)
+
+    # Load all of the top-k test data into memory
+    with conn:
+        cur = conn.cursor()
+        columns = get_table_columns(cur, topk_data_table_name)
+
+        if 'anime_id' in columns:
+            if decode_names:
+                users = get_dimension(cur, 'users')
+                anime = get_dimension(cur, 'anime')
+            cur.execute('''SELECT user_id, anime_id, rand_anime_ids
+                           FROM {0}'''.format(topk_data_table_name))
+            if decode_names:
+                for row in cur.fetchall():
+                    rand_ids = np.frombuffer(row[2], dtype='<i4')
+                    user_anime_pairs[(users[row[0]], anime[row[1]])].extend(
+                            anime[i] for i in rand_ids)
+            else:
+                for row in cur:
+                    rand_ids = np.frombuffer(row[2], dtype='<i4')
+                    user_anime_pairs[(row[0], row[1])].extend(
+                            rand_ids.tolist())
+        elif 'rand_anime_ids' in columns:
+            cur.execute('''SELECT anime_name FROM {0}Anime
+                           ORDER BY anime_id'''.format(topk_data_table_name))
+            all_anime = [r[0] for r in cur.fetchall()]
+            cur.execute('''SELECT user_id, anime_name, rand_anime_ids
+                           FROM {0}'''.format(topk_data_table_name))
+            for row in cur:
+                rand_ids = np.frombuffer(row[2], dtype='<i4')
+                user_anime_pairs[(row[0], row[1])].extend(
+                        all_anime[i] for i in rand_ids)
+        else:
+            cur.execute('''SELECT user_id, anime_name, rand_anime_name
+                           FROM {0}'''.format(topk_data_table_name))
+            for row in cur:
+                user_anime_pairs[(row[0], row[1])].append(row[2])
+
+    return user_anime_pairs
+
+def get_ratings_from_db(db_path, table_name, decode_names=False):
     """Loads ratings from the given table in the given database. Returns a list
     of Rating objects for the ratings in the table.
+
+    If the table is in the compact schema created by create_compact_db, the
+    users and items of the ratings are their integer IDs, unless decode_names
+    is True, in which case they are the user IDs and anime names like for the
+    other tables.
     """
     conn = sqlite3.connect(db_path)
     with conn:
         cur = conn.cursor()
-        cur.execute('SELECT user_id, anime_name, score FROM {0}'.format(
-                    table_name))
-        ratings = [Rating(r[0], r[1], r[2]) for r in cur.fetchall()]
+        if 'anime_id' not in get_table_columns(cur, table_name):
+            cur.execute('SELECT user_id, anime_name, score FROM {0}'.format(
+                        table_name))
+            ratings = [Rating(r[0], r[1], r[2]) for r in cur.fetchall()]
+        elif decode_names:
+            users = get_dimension(cur, 'users')
+            anime = get_dimension(cur, 'anime')
+            cur.execute('SELECT user_id, anime_id, score FROM {0}'.format(
+                        table_name))
+            ratings = [Rating(users[r[0]], anime[r[1]], r[2])
+                       for r in cur.fetchall()]
+        else:
+            cur.execute('SELECT user_id, anime_id, score FROM {0}'.format(
+                        table_name))
+            ratings = [Rating(r[0], r[1], r[2]) for r in cur.fetchall()]
 
     return ratings
 
-def get_implicit_feedback_from_db(db_path, table_name):
+def get_implicit_feedback_from_db(db_path, table_name, decode_names=False):
     """Loads implicit feedback data from the given table in the given database.
     Returns a list of ImplicitFeedback objects for the implicit feedback data
     in the table.
+
+    If the table is in the compact schema created by create_compact_db, the
+    users and items are handled like in get_ratings_from_db, and the status
+    codes are converted back to the status labels.
     """
     conn = sqlite3.connect(db_path)
     with conn:
         cur = conn.cursor()
-        cur.execute('SELECT user_id, anime_name, status FROM {0}'.format(
-                    table_name))
-        imps = [ImplicitFeedback(f[0], f[1], f[2]) for f in cur.fetchall()]
+        if 'anime_id' not in get_table_columns(cur, table_name):
+            cur.execute('SELECT user_id, anime_name, status FROM {0}'.format(
+                        table_name))
+            imps = [ImplicitFeedback(f[0], f[1], f[2])
+                    for f in cur.fetchall()]
+            return imps
+
+        statuses = get_dimension(cur, 'statuses')
+        if decode_names:
+            users = get_dimension(cur, 'users')
+            anime = get_dimension(cur, 'anime')
+            cur.execute('SELECT user_id, anime_id, status_id FROM {0}'.format(
+                        table_name))
+            imps = [ImplicitFeedback(users[f[0]], anime[f[1]], statuses[f[2]])
+                    for f in cur.fetchall()]
+        else:
+            cur.execute('SELECT user_id, anime_id, status_id FROM {0}'.format(
+                        table_name))
+            imps = [ImplicitFeedback(f[0], f[1], statuses[f[2]])
+                    for f in cur.fetchall()]
 
     return imps
 
+def get_table_columns(cur, table_name):
+    """Returns a list of the names of the columns in the given table using the
+    given cursor.
+    """
+    cur.execute('PRAGMA table_info({0})'.format(table_name))
+    return [r[1] for r in cur.fetchall()]
+
+def get_dimension(cur, table_name):
+    """Returns a list of the values in the given dimension table of the compact
+    schema indexed by their integer IDs, using the given cursor.
+    """
+    cur.execute('SELECT * FROM {0} ORDER BY 1'.format(table_name))
+    return [r[1] for r in cur.fetchall()]
+
 def run_validation(train_ratings, valid_ratings, Model, use_bias, valid_params,
                    log_file):
     """Runs validation testing for the given models using the given set of
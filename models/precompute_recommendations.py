@@ -0,0 +1,138 @@
+# Functions for precomputing the top-N recommendations of every user with a
+# trained latent factors model.
+
+import multiprocessing
+import numpy as np
+import resource
+import sqlite3
+import time
+
+from models.factor_snapshot import FactorSnapshot
+from models.latent_factors import LatentFactorModel
+from models.model_util import get_ratings_from_db
+
+# Training tables of the anime users have rated when only the database with
+# them is given
+DEFAULT_SEEN_TABLE_NAMES = ['MALRatingsTrain']
+
+# Snapshot scored by the worker processes, which inherit it when they are
+# forked instead of having it pickled to them
+_worker_snapshot = None
+
+
+def precompute_top_n(model, db_path, table_name, n=10, block_size=1000,
+                     processes=None, seen_db_path=None, seen_table_names=None,
+                     decode_names=False):
+    """Computes the top-N recommendations of every user in the given latent
+    factors model and writes them to a table of a SQLite database.
+
+    The users are split into blocks, and the scores of every anime for a block
+    of users are computed with one matrix product in a worker process. The
+    anime each user has rated are masked out, the N best are picked with
+    argpartition, and the blocks are written to the table in bulk as they
+    finish. The number of users per second and the peak memory of this
+    process and the workers are printed when the job finishes.
+
+    model - Trained LatentFactorModel object, or string of the path to a
+            pickled one.
+    db_path - String of the path to the database to write the
+              recommendations to.
+    table_name - String of the name of the table to write the
+                 recommendations to. It is replaced if it exists, and has the
+                 columns user_id, rank (from 0 for the best anime),
+                 anime_name, and score.
+    n - Number of recommendations per user. 10 by default.
+    block_size - Number of users scored at once. Each worker needs memory for
+                 block_size times the number of anime scores. 1000 by default.
+    processes - Number of worker processes. The number of CPUs if None,
+                which is the default.
+    seen_db_path - String of the path to the database with the training
+                   tables of the anime users have rated. If None, the training
+                   ratings of the model are used. None by default.
+    seen_table_names - List of the names of the training tables in
+                       seen_db_path, e.g. ['MALRatingsTrain',
+                       'MALRatingsValid']. If None, only MALRatingsTrain is
+                       used. None by default.
+    decode_names - Boolean indicating whether the user and item IDs of
+                   training tables in the compact schema should be decoded
+                   to names, like with get_ratings_from_db. False by default.
+
+    Returns a dict of the total 'users', the 'users_per_second', the
+    'peak_memory_kb' of this process, and the 'peak_worker_memory_kb' of the
+    largest worker.
+    """
+    global _worker_snapshot
+    start = time.time()
+    if isinstance(model, basestring):
+        model = LatentFactorModel.load_model(model)
+    snapshot = FactorSnapshot.from_model(model)
+    if seen_db_path is not None:
+        if seen_table_names is None:
+            seen_table_names = DEFAULT_SEEN_TABLE_NAMES
+        seen_ratings = []
+        for seen_table_name in seen_table_names:
+            seen_ratings.extend(get_ratings_from_db(
+                    seen_db_path, seen_table_name, decode_names))
+        snapshot.set_seen_items(seen_ratings)
+        del seen_ratings
+    elif snapshot.seen_indptr is None:
+        print 'Seen anime unknown; rated anime will not be masked'
+    del model
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS {0}'.format(table_name))
+        conn.execute('''CREATE TABLE {0} (user_id TEXT, rank INTEGER,
+                        anime_name TEXT, score REAL,
+                        PRIMARY KEY (user_id, rank))'''.format(table_name))
+
+    total_users = len(snapshot.user_names)
+    blocks = [(first, min(first + block_size, total_users), n)
+              for first in xrange(0, total_users, block_size)]
+    _worker_snapshot = snapshot
+    pool = multiprocessing.Pool(processes)
+    try:
+        finished_users = 0
+        for first, top, top_scores in pool.imap(_score_block, blocks):
+            rows = [(snapshot.user_names[first + row], rank,
+                     snapshot.item_names[i], float(s))
+                    for row in xrange(len(top))
+                    for rank, (i, s) in enumerate(zip(top[row],
+                                                      top_scores[row]))
+                    if s > -np.inf]
+            with conn:
+                conn.executemany(u'INSERT INTO {0} VALUES(?,?,?,?)'.format(
+                                 table_name), rows)
+            finished_users += len(top)
+            print '{0} / {1} users'.format(finished_users, total_users)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_snapshot = None
+        conn.close()
+
+    seconds = time.time() - start
+    stats = {
+        'users': total_users,
+        'users_per_second': total_users / seconds,
+        'peak_memory_kb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_memory_kb': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    print ('Top-{0}: {users} users in {1:.1f}s ({users_per_second:.1f} '
+           'users/sec), peak memory {peak_memory_kb} KB, peak worker memory '
+           '{peak_worker_memory_kb} KB').format(n, seconds, **stats)
+    return stats
+
+
+def _score_block(block):
+    """Returns a tuple of the first user row of the given block of users and
+    the item rows and scores of the top-N anime for each user in it.
+    """
+    first, last, n = block
+    user_rows = np.arange(first, last)
+    scores = _worker_snapshot.score_users(user_rows)
+    top, top_scores = _worker_snapshot.top_items(user_rows, scores, n)
+    return first, top.astype(np.int32), top_scores.astype(np.float32)
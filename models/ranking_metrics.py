@@ -0,0 +1,146 @@
+# Functions for evaluating how well a model ranks the anime each user rated
+# in the held-out data sets.
+
+import multiprocessing
+import numpy as np
+import time
+
+from models.factor_snapshot import FactorSnapshot
+
+# Model and relevant items used by the worker processes, which inherit them
+# when they are forked instead of having them pickled to them
+_worker_state = {}
+
+
+def evaluate_ranking(model, relevant_ratings, k=10, train_ratings=None,
+                     min_score=None, block_size=1000, processes=None):
+    """Computes precision@k, recall@k, MAP@k, NDCG@k, and catalog coverage of
+    the top k anime the given model recommends to every user, treating the
+    anime each user rated in the held-out ratings as the relevant anime.
+
+    The users are split into blocks, and every block is scored against the
+    whole catalog with the model's batched scoring in a worker process. The
+    anime each user rated in the training ratings are masked out and the top
+    k anime are picked with argpartition, so no scores are computed pair by
+    pair. Only users with a relevant anime in the model are evaluated, and
+    relevant anime that are not in the model are ignored since they can't be
+    ranked.
+
+    model - Trained LatentFactorModel, or an object with batched scoring like
+            a FactorSnapshot or QuantizedSnapshot: user_index and item_index
+            dicts, item_names, score_users(user_rows), and
+            top_items(user_rows, scores, n).
+    relevant_ratings - List of Rating objects of the held-out ratings, such as
+                       the ratings in MALRatingsValid or MALRatingsTest.
+    k - Number of recommended anime evaluated for each user. 10 by default.
+    train_ratings - List of Rating objects of the anime to mask for each user.
+                    If None, the training ratings kept by the model's
+                    snapshot are masked. None by default.
+    min_score - Lowest held-out score of a relevant anime. If None, every
+                held-out anime is relevant. None by default.
+    block_size - Number of users scored at once. 1000 by default.
+    processes - Number of worker processes. The number of CPUs if None,
+                which is the default.
+
+    Returns a dict of the mean 'precision', 'recall', 'map', and 'ndcg' over
+    the evaluated users, the catalog 'coverage' as the fraction of anime
+    recommended to at least one user, and the number of 'users' evaluated.
+    """
+    start = time.time()
+    if hasattr(model, 'user_vectors'):
+        model = FactorSnapshot.from_model(model)
+    if train_ratings is not None:
+        model.set_seen_items(train_ratings)
+    elif getattr(model, 'seen_indptr', None) is None:
+        print 'Training ratings unknown; rated anime will not be masked'
+
+    # Relevant item rows of each user, in the same form as the seen items
+    pairs = sorted(set(
+            (model.user_index[r.user], model.item_index[r.item])
+            for r in relevant_ratings
+            if (min_score is None or r.score >= min_score) and
+            r.user in model.user_index and r.item in model.item_index))
+    pairs = np.array(pairs, dtype=np.int64).reshape(len(pairs), 2)
+    relevant_items = pairs[:, 1]
+    relevant_indptr = np.zeros(len(model.user_index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs[:, 0], minlength=len(model.user_index)),
+              out=relevant_indptr[1:])
+    users = np.flatnonzero(np.diff(relevant_indptr))
+
+    _worker_state.update(model=model, k=k, relevant_items=relevant_items,
+                         relevant_indptr=relevant_indptr)
+    blocks = [users[i:i + block_size]
+              for i in xrange(0, len(users), block_size)]
+    totals = np.zeros(4)
+    recommended = np.zeros(len(model.item_names), dtype=np.int64)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for block_totals, block_recommended in pool.imap_unordered(
+                _evaluate_block, blocks):
+            totals += block_totals
+            recommended += block_recommended
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state.clear()
+
+    total_users = max(len(users), 1)
+    results = {
+        'precision': totals[0] / total_users,
+        'recall': totals[1] / total_users,
+        'map': totals[2] / total_users,
+        'ndcg': totals[3] / total_users,
+        'coverage': (float(np.count_nonzero(recommended)) /
+                     max(len(model.item_names), 1)),
+        'users': len(users),
+    }
+    print ('Ranking@{0} over {users} users: precision {precision:.4f}, '
+           'recall {recall:.4f}, MAP {map:.4f}, NDCG {ndcg:.4f}, coverage '
+           '{coverage:.4f} ({1:.1f}s)').format(k, time.time() - start,
+                                               **results)
+    return results
+
+
+def _evaluate_block(user_rows):
+    """Returns a tuple of the sums of the precision, recall, average
+    precision, and NDCG over the given user rows, and the number of times
+    each item was recommended to them.
+    """
+    model = _worker_state['model']
+    k = _worker_state['k']
+    relevant_items = _worker_state['relevant_items']
+    relevant_indptr = _worker_state['relevant_indptr']
+
+    top, top_scores = model.top_items(user_rows, model.score_users(user_rows),
+                                      k)
+    top_k = top.shape[1]
+
+    # Mark the relevant items of each user in a dense block and look up
+    # whether each recommendation is one of them
+    relevant = np.zeros((len(user_rows), len(model.item_names)), dtype=bool)
+    counts = relevant_indptr[user_rows + 1] - relevant_indptr[user_rows]
+    rows = np.repeat(np.arange(len(user_rows)), counts)
+    relevant[rows, np.concatenate([
+        relevant_items[relevant_indptr[u]:relevant_indptr[u + 1]]
+        for u in user_rows])] = True
+    hits = relevant[np.arange(len(user_rows))[:, np.newaxis], top]
+    hits &= top_scores > -np.inf
+
+    total_hits = hits.sum(axis=1)
+    cumulative_hits = np.cumsum(hits, axis=1)
+    ranks = np.arange(1, top_k + 1)
+    discounts = 1 / np.log2(ranks + 1)
+    ideal_hits = np.minimum(counts, k)
+    ideal_dcg = np.cumsum(discounts)[np.minimum(counts, top_k) - 1] \
+        if top_k else np.ones(len(user_rows))
+
+    precision = total_hits / float(k)
+    recall = total_hits / counts.astype(np.float64)
+    average_precision = ((cumulative_hits / ranks.astype(np.float64)) *
+                         hits).sum(axis=1) / ideal_hits
+    ndcg = (hits * discounts).sum(axis=1) / ideal_dcg
+
+    recommended = np.bincount(top[top_scores > -np.inf],
+                              minlength=len(model.item_names))
+    return (np.array([precision.sum(), recall.sum(), average_precision.sum(),
+                      ndcg.sum()]), recommended)
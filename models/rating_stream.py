@@ -0,0 +1,286 @@
+# Objects for streaming ratings to the models without loading them all into
+# memory.
+
+import numpy as np
+import os
+import Queue
+import sqlite3
+import threading
+
+from models.model_util import Rating, get_dimension, get_table_columns
+
+# Names of the files of a columnar rating set, which hold the users, items, and
+# scores of the ratings and the names of the users and items in the same order
+COLUMNAR_FILE_NAMES = {
+    'users': 'users.npy',
+    'items': 'items.npy',
+    'scores': 'scores.npy',
+    'user_names': 'user_names.npy',
+    'item_names': 'item_names.npy',
+}
+
+
+class RatingStream:
+    """Object that streams Rating objects from a SQLite table or a columnar
+    rating set on disk, so models can be trained on more ratings than fit in
+    memory.
+
+    A RatingStream can be iterated any number of times, so it can be used as
+    the train_ratings of a LatentFactorModel. Each iteration reads the
+    ratings in chunks and shuffles them within windows of window_size
+    ratings, using a different order every time. A background thread reads
+    the next chunks while the ratings from the current window are used, so at
+    most window_size + prefetch_chunks * chunk_size ratings are in memory.
+    """
+
+    def __init__(self, source, chunk_size=100000, window_size=1000000,
+                 prefetch_chunks=2, seed=None):
+        """Constructor for a rating stream.
+
+        source - SQLiteRatingSource or ColumnarRatingSource object to read the
+                 ratings from.
+        chunk_size - Number of ratings read from the source at once. 100000
+                     by default.
+        window_size - Number of ratings shuffled together. Ratings are only
+                      moved within a window, so a larger window mixes the
+                      ratings better but uses more memory. 1000000 by
+                      default.
+        prefetch_chunks - Number of chunks the background thread reads ahead.
+                          2 by default.
+        seed - Seed for the shuffling. If None, every stream is shuffled
+               differently. None by default.
+        """
+        self.source = source
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self.prefetch_chunks = prefetch_chunks
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.rng.randint(2 ** 31))
+        window = []
+        for chunk in self._prefetch(self.source.iter_chunks(self.chunk_size,
+                                                            rng)):
+            window.extend(chunk)
+            if len(window) >= self.window_size:
+                for rating in self._shuffle(window, rng):
+                    yield rating
+                window = []
+        for rating in self._shuffle(window, rng):
+            yield rating
+
+    def _shuffle(self, window, rng):
+        """Returns the ratings of the given window in a random order."""
+        return [window[i] for i in rng.permutation(len(window))]
+
+    def _prefetch(self, chunks):
+        """Yields the chunks of the given generator, which is run in a
+        background thread up to prefetch_chunks chunks ahead.
+        """
+        chunk_queue = Queue.Queue(self.prefetch_chunks)
+        stopped = threading.Event()
+
+        def read_chunks():
+            try:
+                for chunk in chunks:
+                    # Stop reading if the ratings stop being used, such as
+                    # when training fails partway through an iteration
+                    while not stopped.is_set():
+                        try:
+                            chunk_queue.put((chunk, None), timeout=0.1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stopped.is_set():
+                        return
+                chunk_queue.put((None, None))
+            except Exception as e:
+                chunk_queue.put((None, e))
+
+        thread = threading.Thread(target=read_chunks)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                chunk, error = chunk_queue.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            stopped.set()
+
+
+class SQLiteRatingSource:
+    """Object that reads the ratings in a SQLite table in chunks with
+    fetchmany().
+
+    The table can be a ratings table like MALRatingsTrain or one in the
+    compact schema created by create_compact_db, in which case the users and
+    items are their integer IDs unless decode_names is True, like with
+    get_ratings_from_db. Rows are read in the order they are stored, since
+    reading them in a random order would make SQLite sort the whole table.
+    """
+
+    def __init__(self, db_path, table_name, decode_names=False):
+        self.db_path = db_path
+        self.table_name = table_name
+        self.decode_names = decode_names
+
+    def __len__(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM {0}'.format(
+                                self.table_name)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def iter_chunks(self, chunk_size, rng=None):
+        """Yields lists of up to chunk_size Rating objects from the table.
+        Each call opens its own connection, so it can be run in any thread.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cur = conn.cursor()
+            users = None
+            if 'anime_id' not in get_table_columns(cur, self.table_name):
+                item_column = 'anime_name'
+            else:
+                item_column = 'anime_id'
+                if self.decode_names:
+                    users = get_dimension(cur, 'users')
+                    items = get_dimension(cur, 'anime')
+
+            cur.execute('SELECT user_id, {0}, score FROM {1}'.format(
+                        item_column, self.table_name))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    return
+                if users is None:
+                    yield [Rating(r[0], r[1], r[2]) for r in rows]
+                else:
+                    yield [Rating(users[r[0]], items[r[1]], r[2])
+                           for r in rows]
+        finally:
+            conn.close()
+
+
+class ColumnarRatingSource:
+    """Object that reads the ratings of a columnar rating set written by
+    write_columnar_ratings in chunks.
+
+    The user, item, and score columns are memory mapped, so only the chunks
+    being read are loaded into memory. The chunks are read in a random order.
+    The users and items of the ratings are integer IDs, unless decode_names is
+    True, in which case they are the names stored with the rating set.
+    """
+
+    def __init__(self, set_dir, decode_names=False):
+        self.set_dir = set_dir
+        self.decode_names = decode_names
+        self.users = self._load('users', 'r')
+        self.items = self._load('items', 'r')
+        self.scores = self._load('scores', 'r')
+        if decode_names:
+            self.user_names = self._load('user_names').tolist()
+            self.item_names = self._load('item_names').tolist()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def iter_chunks(self, chunk_size, rng=None):
+        """Yields lists of up to chunk_size Rating objects from the rating set,
+        starting the chunks in a random order if a numpy RandomState is given.
+        """
+        starts = np.arange(0, len(self.scores), chunk_size)
+        if rng is not None:
+            starts = starts[rng.permutation(len(starts))]
+
+        for start in starts:
+            users = self.users[start:start + chunk_size].tolist()
+            items = self.items[start:start + chunk_size].tolist()
+            scores = self.scores[start:start + chunk_size].tolist()
+            if self.decode_names:
+                users = [self.user_names[u] for u in users]
+                items = [self.item_names[i] for i in items]
+            yield [Rating(u, i, s) for u, i, s in zip(users, items, scores)]
+
+    def _load(self, column, mmap_mode=None):
+        return np.load(os.path.join(self.set_dir,
+                                    COLUMNAR_FILE_NAMES[column]),
+                       mmap_mode=mmap_mode)
+
+
+def write_columnar_ratings(db_path, table_name, set_dir, chunk_size=100000):
+    """Writes the ratings in the given SQLite table to a columnar rating set in
+    the given directory that can be read with ColumnarRatingSource.
+
+    The users and items are stored as integer IDs in 32-bit integer columns,
+    with the scores in an 8-bit integer column, and their names are stored
+    in separate files. The columns are written through memory maps a chunk at
+    a time, so the ratings never have to fit in memory. If the table is in
+    the compact schema created by create_compact_db, its integer IDs are kept
+    and the names come from its dimension tables.
+    """
+    if not os.path.exists(set_dir):
+        os.makedirs(set_dir)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        total_ratings = cur.execute('SELECT COUNT(*) FROM {0}'.format(
+                                    table_name)).fetchone()[0]
+        compact = 'anime_id' in get_table_columns(cur, table_name)
+        if compact:
+            user_names = get_dimension(cur, 'users')
+            item_names = get_dimension(cur, 'anime')
+            item_column = 'anime_id'
+        else:
+            user_ids = {}
+            item_ids = {}
+            item_column = 'anime_name'
+
+        columns = {}
+        for column, dtype in (('users', np.int32), ('items', np.int32),
+                              ('scores', np.int8)):
+            columns[column] = np.lib.format.open_memmap(
+                    os.path.join(set_dir, COLUMNAR_FILE_NAMES[column]),
+                    mode='w+', dtype=dtype, shape=(total_ratings,))
+
+        cur.execute('SELECT user_id, {0}, score FROM {1}'.format(
+                    item_column, table_name))
+        start = 0
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            end = start + len(rows)
+            if compact:
+                columns['users'][start:end] = [r[0] for r in rows]
+                columns['items'][start:end] = [r[1] for r in rows]
+            else:
+                columns['users'][start:end] = [
+                        user_ids.setdefault(r[0], len(user_ids))
+                        for r in rows]
+                columns['items'][start:end] = [
+                        item_ids.setdefault(r[1], len(item_ids))
+                        for r in rows]
+            columns['scores'][start:end] = [r[2] for r in rows]
+            start = end
+    finally:
+        conn.close()
+
+    for column in columns.itervalues():
+        column.flush()
+    if not compact:
+        user_names = sorted(user_ids, key=user_ids.get)
+        item_names = sorted(item_ids, key=item_ids.get)
+    np.save(os.path.join(set_dir, COLUMNAR_FILE_NAMES['user_names']),
+            np.array(user_names))
+    np.save(os.path.join(set_dir, COLUMNAR_FILE_NAMES['item_names']),
+            np.array(item_names))
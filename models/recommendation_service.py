@@ -0,0 +1,432 @@
+# Objects for serving predictions and recommendations from a trained latent
+# factors model in a long-running process.
+
+import BaseHTTPServer
+import collections
+import json
+import numpy as np
+import os
+import Queue
+import SocketServer
+import threading
+import time
+import urlparse
+
+from models.factor_snapshot import FactorSnapshot
+from models.latent_factors import LatentFactorModel
+from models.quantized_factors import QuantizedSnapshot, load_snapshot
+
+PREDICT_REQUEST = 'predict'
+RECOMMEND_REQUEST = 'recommend'
+
+
+class ServiceException(Exception):
+    """Indicates that a request to the recommendation service failed"""
+    pass
+
+
+class _ServiceRequest:
+    """A predict or recommend request waiting to be scored in a batch."""
+
+    def __init__(self, kind, user, item=None, n=None):
+        self.kind = kind
+        self.user = user
+        self.item = item
+        self.n = n
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.version = None
+
+
+class RecommendationService:
+    """Object that serves predictions and top-N recommendations from a trained
+    LatentFactorModel loaded once.
+
+    Requests made at the same time from different threads are coalesced into
+    micro-batches by a scoring thread, which scores each batch with matrix
+    products on a FactorSnapshot of the model. The top-N lists of recent users
+    are kept in an LRU cache. swap() loads a newer model and switches to it
+    while requests keep being served; batches already being scored finish with
+    the model they started with, and the cache is cleared.
+
+    Usage:
+        service = RecommendationService('lf_model.pickle')
+        service.predict('some_user', 'Cowboy Bebop')
+        service.recommend('some_user', 10)
+        service.swap('lf_model_newer.pickle')
+        service.report()
+        service.close()
+    """
+
+    def __init__(self, model_path, max_batch_size=64, max_batch_delay=0.002,
+                 cache_size=10000, latency_window=10000, quantize=False):
+        """Constructor for a recommendation service. Loads the model and starts
+        the scoring thread.
+
+        model_path - String of the path to a pickled LatentFactorModel, to
+                     a .npz file of a FactorSnapshot or QuantizedSnapshot, or
+                     to a directory of factors from
+                     interchange.export_factors.
+        max_batch_size - Maximum number of requests scored in one batch. 64
+                         by default.
+        max_batch_delay - Maximum number of seconds the first request of a
+                          batch waits for more requests to arrive. 0.002 by
+                          default.
+        cache_size - Maximum number of top-N lists kept in the cache. 10000 by
+                     default.
+        latency_window - Number of most recent requests the latency
+                         percentiles are computed over. 10000 by default.
+        quantize - Boolean indicating whether to serve the models with their
+                   factors quantized to int8, which uses about an eighth of
+                   the memory. False by default.
+        """
+        self.max_batch_size = max_batch_size
+        self.quantize = quantize
+        self.max_batch_delay = max_batch_delay
+        self.cache_size = cache_size
+        self.queue = Queue.Queue()
+
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.model_path = None
+        self.version = 0
+        self.cache = collections.OrderedDict()
+        self.swap(model_path)
+
+        self.start_time = time.time()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.total_requests = 0
+        self.total_batches = 0
+        self.total_batched_requests = 0
+        self.cache_hits = 0
+
+        self.thread = threading.Thread(target=self._score_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict(self, user, item):
+        """Returns the score the given user is predicted to give the given
+        item.
+
+        Raises a ServiceException if the user or item is not in the model.
+        """
+        return self._submit(_ServiceRequest(PREDICT_REQUEST, user, item=item))
+
+    def recommend(self, user, n=10):
+        """Returns a list of tuples of the n anime with the highest predicted
+        scores for the given user that they have not rated, and the predicted
+        scores, best first.
+
+        Raises a ServiceException if the user is not in the model.
+        """
+        start = time.time()
+        with self.lock:
+            result = self.cache.pop((user, n), None)
+            if result is not None:
+                self.cache[(user, n)] = result
+                self.cache_hits += 1
+        if result is not None:
+            self._record_latency(start)
+            return result
+
+        request = _ServiceRequest(RECOMMEND_REQUEST, user, n=n)
+        result = self._submit(request, start)
+        with self.lock:
+            # Results scored with a model that has since been swapped out are
+            # not cached
+            if request.version == self.version:
+                self.cache[(user, n)] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+    def swap(self, model_path):
+        """Loads the pickled LatentFactorModel or the snapshot at the given
+        path and serves it in place of the current model. Requests keep being
+        served with the current model while the new one loads.
+        """
+        if is_snapshot_path(model_path):
+            snapshot = load_snapshot(model_path)
+        else:
+            snapshot = FactorSnapshot.from_model(
+                    LatentFactorModel.load_model(model_path))
+        if self.quantize and not isinstance(snapshot, QuantizedSnapshot):
+            snapshot = QuantizedSnapshot.from_snapshot(snapshot)
+        with self.lock:
+            self.snapshot = snapshot
+            self.model_path = model_path
+            self.version += 1
+            self.cache.clear()
+
+    def get_stats(self):
+        """Returns a dict of the service's stats so far: the total 'requests',
+        the 'qps' since the service started, the 'p50_ms' and 'p99_ms'
+        latency of the recent requests, the 'mean_batch_size', the
+        'cache_hit_rate' as the fraction of requests answered from the cache,
+        and the 'model_version' and 'model_path' of the model being served.
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+            batches = max(self.total_batches, 1)
+            total_requests = max(self.total_requests, 1)
+            return {
+                'requests': self.total_requests,
+                'qps': self.total_requests / (time.time() - self.start_time),
+                'p50_ms': (1000 * np.percentile(latencies, 50)
+                           if latencies else 0.0),
+                'p99_ms': (1000 * np.percentile(latencies, 99)
+                           if latencies else 0.0),
+                'mean_batch_size': (float(self.total_batched_requests) /
+                                    batches),
+                'cache_hit_rate': float(self.cache_hits) / total_requests,
+                'model_version': self.version,
+                'model_path': self.model_path,
+            }
+
+    def report(self):
+        """Prints the service's stats."""
+        print ('Recommendation service: {requests} requests, {qps:.1f} QPS, '
+               'latency p50 {p50_ms:.2f} ms p99 {p99_ms:.2f} ms, mean batch '
+               '{mean_batch_size:.1f}, cache hit rate {cache_hit_rate:.2f}, '
+               'model {model_version} ({model_path})').format(
+                   **self.get_stats())
+
+    def close(self):
+        """Stops the scoring thread after the waiting requests are scored."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _submit(self, request, start=None):
+        """Queues the given request to be scored, waits for it, and returns its
+        result.
+        """
+        if start is None:
+            start = time.time()
+        self.queue.put(request)
+        request.done.wait()
+        self._record_latency(start)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _record_latency(self, start):
+        with self.lock:
+            self.latencies.append(time.time() - start)
+            self.total_requests += 1
+
+    def _score_batches(self):
+        """Scores batches of queued requests until close() is called."""
+        stopping = False
+        while not stopping:
+            batch, stopping = self._get_batch()
+            if not batch:
+                continue
+            with self.lock:
+                snapshot = self.snapshot
+                version = self.version
+                self.total_batches += 1
+                self.total_batched_requests += len(batch)
+            try:
+                self._score_batch(snapshot, batch)
+            except Exception as e:
+                for request in batch:
+                    if request.result is None and request.error is None:
+                        request.error = e
+            for request in batch:
+                request.version = version
+                request.done.set()
+
+    def _get_batch(self):
+        """Returns a tuple of the next batch of queued requests and whether
+        close() was called. Waits for the first request of the batch, then for
+        up to max_batch_delay seconds for more requests until the batch is
+        full.
+        """
+        request = self.queue.get()
+        if request is None:
+            return [], True
+
+        batch = [request]
+        deadline = time.time() + self.max_batch_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self.queue.get(
+                        timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _score_batch(self, snapshot, batch):
+        """Sets the results of the given batch of requests, scoring all of the
+        predictions with one product and all of the recommendations with
+        another.
+        """
+        predictions = []
+        recommendations = []
+        for request in batch:
+            user_row = snapshot.user_index.get(request.user)
+            if user_row is None:
+                request.error = ServiceException(
+                        'User ({0}) not in model'.format(request.user))
+            elif request.kind == RECOMMEND_REQUEST:
+                recommendations.append((request, user_row))
+            elif request.item not in snapshot.item_index:
+                request.error = ServiceException(
+                        'Item ({0}) not in model'.format(request.item))
+            else:
+                predictions.append((request, user_row,
+                                    snapshot.item_index[request.item]))
+
+        if predictions:
+            scores = snapshot.predict_rows(
+                    np.array([p[1] for p in predictions]),
+                    np.array([p[2] for p in predictions]))
+            for (request, user_row, item_row), score in zip(predictions,
+                                                             scores):
+                request.result = float(score)
+
+        if recommendations:
+            user_rows = np.array([r[1] for r in recommendations])
+            top, top_scores = snapshot.top_items(
+                    user_rows, snapshot.score_users(user_rows),
+                    max(r[0].n for r in recommendations))
+            for row, (request, user_row) in enumerate(recommendations):
+                request.result = [
+                        (snapshot.item_names[i], float(s))
+                        for i, s in zip(top[row, :request.n],
+                                        top_scores[row, :request.n])
+                        if s > -np.inf]
+
+
+class RecommendationServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """Local HTTP server for a RecommendationService. Each connection is
+    handled in its own thread, so concurrent requests are batched together by
+    the service.
+
+    Requests are answered with JSON:
+        GET /predict?user=<user>&item=<anime> - {"score": <score>}
+        GET /recommend?user=<user>&n=<n> - {"items": [[<anime>, <score>], ...]}
+        GET /stats - The dict from RecommendationService.get_stats()
+        POST /swap?path=<snapshot_path> - Swaps to the given .npz snapshot
+                                          or directory of factors and
+                                          returns the stats. Pickled models
+                                          are refused, since unpickling runs
+                                          code from the file, and can only be
+                                          swapped in with swap().
+    Requests that fail get status 404 if the user or item is not in the model
+    and 400 otherwise, with {"error": <message>}.
+
+    Usage:
+        service = RecommendationService('lf_model.pickle')
+        server = RecommendationServer(service, 8080)
+        ...
+        server.stop()
+        service.close()
+    """
+    daemon_threads = True
+
+    def __init__(self, service, port=0):
+        """Starts serving the given service in a background thread on the
+        given port of localhost. A free port is picked if the port is 0, which
+        is the default.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           _RecommendationHandler)
+        self.service = service
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the server and waits for it to shut down."""
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class _RecommendationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers requests to a RecommendationServer."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[0]) for k, v in
+                      urlparse.parse_qs(url.query).iteritems())
+        service = self.server.service
+        try:
+            if self.command == 'GET' and url.path == '/predict':
+                body = {'score': service.predict(params['user'],
+                                                 params['item'])}
+            elif self.command == 'GET' and url.path == '/recommend':
+                body = {'items': service.recommend(
+                            params['user'], int(params.get('n', 10)))}
+            elif self.command == 'GET' and url.path == '/stats':
+                body = service.get_stats()
+            elif self.command == 'POST' and url.path == '/swap':
+                if not is_snapshot_path(params['path']):
+                    self._send(400, {'error': 'Only snapshots can be swapped '
+                                              'in over HTTP'})
+                    return
+                service.swap(params['path'])
+                body = service.get_stats()
+            else:
+                self._send(404, {'error': 'Unknown request'})
+                return
+        except ServiceException as e:
+            self._send(404, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send(400, {'error': repr(e)})
+            return
+        self._send(200, body)
+
+    def _send(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def is_snapshot_path(model_path):
+    """Returns whether the given path is of a snapshot, either a .npz file or
+    a directory of factors, rather than of a pickled model.
+    """
+    return model_path.endswith('.npz') or os.path.isdir(model_path)
+
+
+def serve_model(model_path, port=8080, report_interval=60, **kwargs):
+    """Serves the given pickled LatentFactorModel or snapshot over HTTP on the given port
+    of localhost until interrupted, printing the service's stats every
+    report_interval seconds. Other keyword arguments are passed to the
+    RecommendationService.
+    """
+    service = RecommendationService(model_path, **kwargs)
+    server = RecommendationServer(service, port)
+    print 'Serving {0} at {1}'.format(model_path, server.url)
+    try:
+        while True:
+            time.sleep(report_interval)
+            service.report()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        service.close()
+        service.report()
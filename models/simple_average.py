@@ -81,3 +81,17 @@ class SimpleAverageModel:
                     'Item ({0}) is not in the model'.format(test_item))
         return guess
 
+    def predict_batch(self, test_users, test_items):
+        """Predicts the scores the given users would give the given items, like
+        predict() for each pair of a user and an item in the two lists.
+
+        Returns a numpy array of the predicted scores.
+        """
+        guesses = np.empty(len(test_items))
+        for n, test_item in enumerate(test_items):
+            guess = self.item_ratings.get(test_item)
+            if guess is None:
+                raise ModelException(
+                        'Item ({0}) is not in the model'.format(test_item))
+            guesses[n] = guess
+        return guesses
@@ -0,0 +1,353 @@
+# Command-line entry point for the data acquisition and recommender system
+# workflows.
+#
+# Each subcommand imports the modules it needs when it runs, so that
+# commands like recommend don't pay for importing dill, lxml, or dryscrape.
+
+import time
+_START_TIME = time.time()
+
+import argparse
+import importlib
+import os
+import sys
+
+# Seconds taken by each module imported by a subcommand, in import order
+_import_times = []
+
+
+def _import(module_name):
+    """Imports and returns the given module, timing the import for
+    --profile-startup.
+    """
+    start = time.time()
+    module = importlib.import_module(module_name)
+    _import_times.append((module_name, time.time() - start))
+    return module
+
+
+def split(args):
+    """Splits the crawled ratings into the training, validation, and test
+    sets, and optionally the implicit feedback and top-k data sets.
+    """
+    create_ml_sets = _import('data_acquisition.create_ml_sets')
+    create_ml_sets.create_ml_sets(
+            args.source_db, args.dest_db, args.table, args.train_percent,
+            args.valid_percent, max_users=args.max_users,
+            split_seed=args.seed, incremental=args.incremental)
+    if args.implicit_db is not None:
+        create_ml_sets.create_implicit_feedback_set(
+                args.source_db, args.implicit_db, args.table,
+                incremental=args.incremental)
+
+
+def crawl(args):
+    """Crawls MAL ratings with crawl_mal_ratings or a CrawlEngine."""
+    if args.requests_per_second is None:
+        crawl_mal = _import('data_acquisition.crawl_mal')
+        crawl_mal.crawl_mal_ratings(args.delay, args.iterations,
+                                    args.render_all_pages, args.refresh_days)
+    else:
+        crawl_engine = _import('data_acquisition.crawl_engine')
+        engine = crawl_engine.CrawlEngine(
+                args.requests_per_second, fetch_threads=args.fetch_threads,
+                refresh_days=args.refresh_days)
+        engine.crawl(args.iterations)
+
+
+def train(args):
+    """Trains a latent factors model and pickles it, and optionally saves a
+    snapshot of it for fast loading.
+    """
+    model_util = _import('models.model_util')
+    latent_factors = _import('models.latent_factors')
+    train_ratings = model_util.get_ratings_from_db(args.db, args.table,
+                                                   args.decode_names)
+    implicit_feedback = None
+    if args.implicit_table is not None:
+        implicit_feedback = model_util.get_implicit_feedback_from_db(
+                args.implicit_db or args.db, args.implicit_table,
+                args.decode_names)
+    valid_ratings = None
+    if args.valid_table is not None:
+        valid_ratings = model_util.get_ratings_from_db(
+                args.db, args.valid_table, args.decode_names)
+
+    model = latent_factors.LatentFactorModel(
+            train_ratings, args.factors, args.norm_factor,
+            args.learning_rate, args.iterations, not args.no_biases,
+            implicit_feedback, optimizer=args.optimizer,
+            learning_rate_decay=args.learning_rate_decay,
+            valid_ratings=valid_ratings, valid_freq=args.valid_freq,
+            patience=args.patience)
+    if not model.train():
+        sys.exit('Training failed')
+    model.save_model(args.model)
+    if args.snapshot is not None:
+        factor_snapshot = _import('models.factor_snapshot')
+        factor_snapshot.FactorSnapshot.from_model(model).save(args.snapshot)
+
+
+def test(args):
+    """Tests a pickled model on a table of ratings."""
+    model_util = _import('models.model_util')
+    model = _load_model(args.model)
+    model.test(model_util.get_ratings_from_db(args.db, args.table,
+                                              args.decode_names))
+
+
+def topk(args):
+    """Runs the top-k test for a pickled model."""
+    model_util = _import('models.model_util')
+    model = _load_model(args.model)
+    model_util.topk_test(args.db, args.table, model, args.random_anime,
+                         args.decode_names)
+
+
+def snapshot(args):
+    """Saves a snapshot of a pickled latent factors model for fast loading,
+    optionally with its factors quantized to int8.
+    """
+    if args.quantize:
+        quantized_factors = _import('models.quantized_factors')
+        Snapshot = quantized_factors.QuantizedSnapshot
+    else:
+        Snapshot = _import('models.factor_snapshot').FactorSnapshot
+    Snapshot.from_model(_load_model(args.model)).save(args.snapshot)
+
+
+def export(args):
+    """Exports the factors of a pickled latent factors model as .npy files,
+    or tables of ratings as sparse .npz matrices with --db.
+    """
+    if (args.model is None) == (args.db is None):
+        sys.exit('Give exactly one of --model and --db')
+    interchange = _import('models.interchange')
+    if args.db is not None:
+        interchange.export_rating_sets(args.db, args.tables, args.out_dir,
+                                       args.decode_names)
+    else:
+        interchange.export_factors(_load_model(args.model), args.out_dir)
+
+
+def recommend(args):
+    """Prints the top-N anime for a user from a model snapshot or a pickled
+    model.
+    """
+    np = _import('numpy')
+    quantized_factors = _import('models.quantized_factors')
+    if args.model.endswith('.npz') or os.path.isdir(args.model):
+        model_snapshot = quantized_factors.load_snapshot(args.model)
+    else:
+        model_snapshot = quantized_factors.FactorSnapshot.from_model(
+                _load_model(args.model))
+
+    user_row = model_snapshot.user_index.get(args.user.decode('utf-8'))
+    if user_row is None:
+        sys.exit('User ({0}) not in model'.format(args.user))
+    user_rows = np.array([user_row])
+    top, top_scores = model_snapshot.top_items(
+            user_rows, model_snapshot.score_users(user_rows), args.n)
+    for rank, (item_row, score) in enumerate(zip(top[0], top_scores[0])):
+        if score > -np.inf:
+            print u'{0}\t{1:.3f}\t{2}'.format(
+                    rank + 1, score,
+                    model_snapshot.item_names[item_row]).encode('utf-8')
+
+
+def serve(args):
+    """Serves a pickled latent factors model or snapshot over HTTP."""
+    recommendation_service = _import('models.recommendation_service')
+    recommendation_service.serve_model(args.model, args.port,
+                                       quantize=args.quantize)
+
+
+def bench(args):
+    """Benchmarks parsing saved MAL pages."""
+    crawl_engine = _import('data_acquisition.crawl_engine')
+    crawl_engine.benchmark_parsing(args.pages_dir, not args.no_render)
+
+
+def memory(args):
+    """Loads a training table, trains a model on it, and prints the peak
+    memory of each step and the memory used by the ratings and the model.
+    """
+    memory_profile = _import('models.memory_profile')
+    if args.model_type == 'simple':
+        Model = _import('models.simple_average').SimpleAverageModel
+        params = ()
+    else:
+        Model = _import('models.latent_factors').LatentFactorModel
+        params = (args.factors, args.norm_factor, args.learning_rate,
+                  args.iterations, not args.no_biases)
+    memory_profile.benchmark_memory(
+            args.db, args.table, Model, params,
+            args.implicit_db or (args.db if args.implicit_table else None),
+            args.implicit_table, args.decode_names)
+
+
+def _load_model(model_path):
+    """Loads a pickled model. ItemNeighborModel files end in .npz, and every
+    other model is a dill pickle.
+    """
+    if model_path.endswith('.npz'):
+        item_neighbors = _import('models.item_neighbors')
+        return item_neighbors.ItemNeighborModel.load_model(model_path)
+    dill = _import('dill')
+    return dill.load(open(model_path, 'rb'))
+
+
+def _print_startup_profile(parsed_time, end_time):
+    """Prints how long the CLI took to start, to import each module, and to
+    run the command, to standard error.
+    """
+    import_seconds = sum(seconds for name, seconds in _import_times)
+    lines = ['Startup profile:',
+             '  argument parsing: {0:.1f} ms'.format(
+                 1000 * (parsed_time - _START_TIME))]
+    for name, seconds in _import_times:
+        lines.append('  import {0}: {1:.1f} ms'.format(name, 1000 * seconds))
+    lines.append('  command: {0:.1f} ms'.format(
+        1000 * (end_time - parsed_time - import_seconds)))
+    lines.append('  total: {0:.1f} ms'.format(
+        1000 * (end_time - _START_TIME)))
+    print >> sys.stderr, '\n'.join(lines)
+
+
+def get_parser():
+    """Returns the argument parser for the command-line interface."""
+    parser = argparse.ArgumentParser(
+            description='Anime recommender system workflows.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time spent on imports and the '
+                             'command to standard error')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('split', help=split.__doc__)
+    p.add_argument('source_db')
+    p.add_argument('dest_db')
+    p.add_argument('table', help='table of crawled ratings, e.g. MALRatings')
+    p.add_argument('--train-percent', type=float, default=0.8)
+    p.add_argument('--valid-percent', type=float, default=0.1)
+    p.add_argument('--max-users', type=int)
+    p.add_argument('--seed', help='hash the ratings into the sets with this '
+                                  'seed instead of shuffling them')
+    p.add_argument('--incremental', action='store_true')
+    p.add_argument('--implicit-db',
+                   help='also create the implicit feedback set in this '
+                        'database')
+    p.set_defaults(func=split)
+
+    p = subparsers.add_parser('crawl', help=crawl.__doc__)
+    p.add_argument('iterations', type=int)
+    p.add_argument('--delay', type=float, default=60,
+                   help='seconds between requests of crawl_mal_ratings')
+    p.add_argument('--requests-per-second', type=float,
+                   help='crawl with a CrawlEngine at this rate')
+    p.add_argument('--fetch-threads', type=int, default=4)
+    p.add_argument('--render-all-pages', action='store_true')
+    p.add_argument('--refresh-days', type=float, default=90)
+    p.set_defaults(func=crawl)
+
+    p = subparsers.add_parser('train', help=train.__doc__)
+    p.add_argument('db')
+    p.add_argument('table')
+    p.add_argument('model', help='path to pickle the trained model to')
+    p.add_argument('--factors', type=int, default=100)
+    p.add_argument('--norm-factor', type=float, default=0.11)
+    p.add_argument('--learning-rate', type=float, default=0.01)
+    p.add_argument('--iterations', type=int, default=100)
+    p.add_argument('--no-biases', action='store_true')
+    p.add_argument('--implicit-db')
+    p.add_argument('--implicit-table')
+    p.add_argument('--optimizer', choices=['sgd', 'adagrad', 'adam'],
+                   default='sgd')
+    p.add_argument('--learning-rate-decay', type=float,
+                   help='factor to multiply the learning rate by after each '
+                        'iteration')
+    p.add_argument('--valid-table',
+                   help='table of validation ratings to stop early on and '
+                        'keep the best iteration of, e.g. MALRatingsValid')
+    p.add_argument('--valid-freq', type=int, default=1)
+    p.add_argument('--patience', type=int,
+                   help='iterations without a better validation RMSE before '
+                        'stopping')
+    p.add_argument('--snapshot', help='path to save a .npz snapshot to')
+    p.add_argument('--decode-names', action='store_true')
+    p.set_defaults(func=train)
+
+    for name, func in (('test', test), ('topk', topk)):
+        p = subparsers.add_parser(name, help=func.__doc__)
+        p.add_argument('model')
+        p.add_argument('db')
+        p.add_argument('table')
+        p.add_argument('--decode-names', action='store_true')
+        if name == 'topk':
+            p.add_argument('--random-anime', type=int, default=1000)
+        p.set_defaults(func=func)
+
+    p = subparsers.add_parser('snapshot', help=snapshot.__doc__)
+    p.add_argument('model')
+    p.add_argument('snapshot', help='path of the .npz file to save')
+    p.add_argument('--quantize', action='store_true',
+                   help='store the factors as int8')
+    p.set_defaults(func=snapshot)
+
+    p = subparsers.add_parser('export', help=export.__doc__)
+    p.add_argument('out_dir')
+    p.add_argument('--model', help='pickled model to export the factors of')
+    p.add_argument('--db', help='database to export the ratings of')
+    p.add_argument('--tables', nargs='+',
+                   default=['MALRatingsTrain', 'MALRatingsValid',
+                            'MALRatingsTest'])
+    p.add_argument('--decode-names', action='store_true')
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser('recommend', help=recommend.__doc__)
+    p.add_argument('model',
+                   help='.npz snapshot, factor directory, or pickled model')
+    p.add_argument('user')
+    p.add_argument('-n', type=int, default=10)
+    p.set_defaults(func=recommend)
+
+    p = subparsers.add_parser('serve', help=serve.__doc__)
+    p.add_argument('model')
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--quantize', action='store_true',
+                   help='serve the factors quantized to int8')
+    p.set_defaults(func=serve)
+
+    p = subparsers.add_parser('memory', help=memory.__doc__)
+    p.add_argument('db')
+    p.add_argument('table')
+    p.add_argument('--model-type', choices=('latent', 'simple'),
+                   default='latent')
+    p.add_argument('--factors', type=int, default=100)
+    p.add_argument('--norm-factor', type=float, default=0.11)
+    p.add_argument('--learning-rate', type=float, default=0.01)
+    p.add_argument('--iterations', type=int, default=1)
+    p.add_argument('--no-biases', action='store_true')
+    p.add_argument('--implicit-db')
+    p.add_argument('--implicit-table')
+    p.add_argument('--decode-names', action='store_true')
+    p.set_defaults(func=memory)
+
+    p = subparsers.add_parser('bench', help=bench.__doc__)
+    p.add_argument('pages_dir')
+    p.add_argument('--no-render', action='store_true')
+    p.set_defaults(func=bench)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    parsed_time = time.time()
+    try:
+        args.func(args)
+    finally:
+        if args.profile_startup:
+            _print_startup_profile(parsed_time, time.time())
+
+
+if __name__ == '__main__':
+    main()